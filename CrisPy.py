@@ -1,23 +1,597 @@
-from Bio import SeqIO, pairwise2, Seq
+# Biopython is imported where it is used, so short-lived processes that only parse
+# traces don't pay for importing it
+import numpy as np
 import copy
+import csv
+import functools
+import hashlib
+import io
+import json
 import math
+import mmap
+import os
 import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+from multiprocessing import shared_memory
 
 # List of bases to loop over
 TRACE_LIST = ['A','G','C','T']
+# Row of each base in a Trace's channel array
+CHANNEL_INDEX = {letter: row for row, letter in enumerate(TRACE_LIST)}
+# Integer type a Trace keeps its channels in: ABIF channels are 16-bit and
+# normalized values stay well inside 32 bits (sums over them are done in 64 bits)
+CHANNEL_DTYPE = np.int32
+# ABIF data tag holding each base's channel
+CHANNEL_TAGS = {'A': 'DATA10', 'G': 'DATA9', 'C': 'DATA12', 'T': 'DATA11'}
+# Number of datapoints per block of cached window scores used while aligning
+ALIGN_CHUNK = 256
+# Number of leading datapoints a partial alignment for the offset search can use
+OFFSET_WINDOW = 1600
+# Number of datapoints per chunk of difference traces given by SeqDoc.stream_differences
+STREAM_CHUNK = 8192
+# Kinds of pool a SampleExecutor can hand the pieces of one sample's analysis to
+EXECUTOR_KINDS = ('thread', 'process')
+# Traces shorter than this (in datapoints) are analyzed serially even with a
+# SampleExecutor, since handing the pieces out takes longer than doing them
+PARALLEL_MIN_DATAPOINTS = 12000
+# Fewest sites in each group Sequalizer hands to a SampleExecutor
+PARALLEL_MIN_SITES = 256
+# Ways SeqDoc.get_best_align can search for the starting offset
+OFFSET_SEARCH_MODES = ('batched', 'stepped')
+# Ways SeqDoc can trim the unreliable ends off the traces before comparing them: by
+# the per-base quality values (PCON) of the ab1 file, by peak height, or by quality
+# where the file has it and peak height otherwise
+TRIM_MODES = ('quality', 'signal', 'auto')
+# Error probability of a base worth keeping (0.05 is about Q13, as in Mott's trimming)
+TRIM_ERROR_LIMIT = 0.05
+# A base whose tallest peak is under this fraction of the trace's median is weak
+TRIM_SIGNAL_FRACTION = 0.2
+# Datapoints kept either side of the first and last good base
+TRIM_PAD = 20
+# Fewest datapoints of good signal the two traces need in common
+TRIM_MIN_LENGTH = 500
+# Datapoints kept either side of each site in region-of-interest mode
+ROI_PAD = 200
+# How far (in datapoints) the local offset search of each ROI window looks either side
+# of the offset estimated from the base calls
+ROI_MARGIN = 150
+# Fraction of the reference that ROI windows can cover before the whole trace is used
+ROI_MAX_COVERAGE = 0.5
+# Scores used to align the target to the reference: match, mismatch, gap open, extend
+LOCAL_ALIGN_SCORES = (2, -1, -1, -0.1)
+# Number of reference sequences whose target locations are kept
+MAX_LOCATORS = 32
+# Weight of a mismatch at each distance from the PAM (index 1 is next to it), from
+# the model by the Howard M. Salis Lab
+POS_WEIGHTS = (0.554111551727719,0.999999999999958,0.999859588152223,0.999997460325925,0.414113900546951,
+               0.999495056671895,0.0220208959410121,0.589953049071977,0.324385855364402,2.26201959820539e-06,
+               0.0825699665148698,0.0890566149734565,0.234751499655325,3.77820298630600e-14,0.214631126793305,
+               7.04574142003494e-06,0.156869096216009,0.129156230982504,0.0428145130615625,1.58135744395507e-05,
+               0.100000000000000)
+# Fields of each scored off-target site: guide index, strand (1 sense, -1 antisense),
+# signed start position (as used by Sequalizer's match_override) and score
+OFFTARGET_DTYPE = np.dtype([('guide', np.int32), ('strand', np.int8), ('position', np.int64), ('score', np.float64)])
+# Fields of each site scored from a PamIndex: guide index, site (row of the index),
+# FASTA record index, strand, forward-strand start of the protospacer and PAM, and score
+PAM_SITE_DTYPE = np.dtype([('guide', np.int32), ('site', np.int64), ('record', np.int32),
+                           ('strand', np.int8), ('position', np.int64), ('score', np.float64)])
+# Number of protospacer bases kept for each site of a PamIndex
+PROTOSPACER_LENGTH = 20
+# Version of the PamIndex file layout, checked when an index is opened
+PAM_INDEX_VERSION = 2
+# Columns of the long-format results (one row per sample, site and base): sample,
+# site (0 is the target, then off-targets in order), strand, position, score (1 is a
+# perfect match), base index in the target and mutation frequency. position is the
+# first forward-strand index of the reference sequence the site covers, protospacer
+# and PAM, as in PamIndex (see site_position): the protospacer start for the target
+# and sense sites, the start of the CCN for antisense ones
+RESULT_COLUMNS = [('sample', np.int32), ('site', np.int32), ('strand', np.int8), ('position', np.int64),
+                  ('score', np.float64), ('base_index', np.int32), ('frequency', np.float64)]
+# Ways ResultsWriter can store results
+RESULT_FORMATS = ('csv', 'columnar')
+# Version of the columnar results and difference trace layouts
+RESULTS_VERSION = 1
+# ABIF tags read from each ab1 file: the four channels, base calls and base positions
+ABIF_TAGS = [CHANNEL_TAGS[letter] for letter in TRACE_LIST] + ['PBAS2', 'PLOC2']
+# ABIF tags read when the file has them: the per-base quality values
+ABIF_OPTIONAL_TAGS = ['PCON2']
+# numpy type of each numeric ABIF element type (ABIF files are big-endian). Element
+# type 2 is char data, returned as bytes
+ABIF_TYPES = {1: '>u1', 3: '>u2', 4: '>i2', 5: '>i4', 7: '>f4', 8: '>f8'}
+# Ways ABIparse can read an ab1 file
+ABIF_READERS = ('lean', 'biopython')
+# Version of the parsing/normalization code, part of every trace cache key. Bump it
+# whenever either one changes what it produces, so old cache entries are not reused
+TRACE_CACHE_VERSION = 2
 
-# Simple class to parse out ab1 file format data
+# Channel values as a new CHANNEL_DTYPE array (at least 2-D), or int64 for values
+# that don't fit in it
+def _channel_array(values):
+    values = np.asarray(values)
+    dtype = CHANNEL_DTYPE
+    if values.dtype.kind not in 'iub' or values.dtype.itemsize > np.dtype(dtype).itemsize:
+        info = np.iinfo(dtype)
+        if values.size and (values.min() < info.min or values.max() > info.max):
+            dtype = np.int64
+    return np.array(values, dtype=dtype, ndmin=2)
+
+# Compact trace container: the four channels are stored as one 4xN CHANNEL_DTYPE
+# array (rows in TRACE_LIST order), with the base calls and their peak positions
+# kept alongside. Dict-style access ('A', 'sequence', 'base_pos', 'seq_length', ...)
+# is kept so callers written against the old trace dict still work.
+class Trace(object):
+    def __init__(self, channels, sequence, base_pos):
+        self.data = _channel_array(channels)
+        if self.data.shape[0] != len(TRACE_LIST):
+            raise ValueError('trace needs one channel per base')
+        if isinstance(sequence, bytes):
+            sequence = sequence.decode()
+        self.sequence = sequence
+        self.base_pos = np.array(base_pos, dtype=np.int64)
+        # any other per-trace values (e.g. the alignment offset)
+        self.extra = {}
+
+    @classmethod
+    def from_dict(cls, trace_dict):
+        # builds a Trace from an old-style dict of per-base lists
+        trace = cls([trace_dict[letter] for letter in TRACE_LIST],
+                    trace_dict['sequence'], trace_dict['base_pos'])
+        for key, value in trace_dict.items():
+            if key not in trace:
+                trace.extra[key] = value
+        return trace
+
+    @classmethod
+    def view(cls, data, sequence, base_pos):
+        # builds a Trace around existing arrays without copying them (e.g. arrays
+        # in shared memory); the caller makes sure nothing writes to them
+        trace = cls.__new__(cls)
+        trace.data = data
+        trace.sequence = sequence
+        trace.base_pos = base_pos
+        trace.extra = {}
+        return trace
+
+    @property
+    def seq_length(self):
+        return self.data.shape[1]
+
+    def __getitem__(self, key):
+        if key in CHANNEL_INDEX:
+            return self.data[CHANNEL_INDEX[key]]
+        elif key == 'sequence':
+            return self.sequence
+        elif key == 'base_pos':
+            return self.base_pos
+        elif key == 'seq_length':
+            return self.seq_length
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in CHANNEL_INDEX:
+            value = _channel_array(value)
+            if value.dtype.itemsize > self.data.dtype.itemsize:
+                # (values that don't fit widen the whole array)
+                self.data = self.data.astype(value.dtype)
+            self.data[CHANNEL_INDEX[key]] = value[0]
+        elif key == 'sequence':
+            self.sequence = value.decode() if isinstance(value, bytes) else value
+        elif key == 'base_pos':
+            self.base_pos = np.array(value, dtype=np.int64)
+        elif key == 'seq_length':
+            raise KeyError('seq_length is set by the channel data')
+        else:
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return TRACE_LIST + ['sequence', 'base_pos', 'seq_length'] + list(self.extra)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def copy(self):
+        trace = Trace(self.data, self.sequence, self.base_pos)
+        trace.extra = copy.deepcopy(self.extra)
+        return trace
+# End Trace Class
+
+# On-disk cache of parsed and normalized traces, keyed by the hash of the ab1 file's
+# contents plus TRACE_CACHE_VERSION. Each entry is a directory of .npy files (raw
+# channels, base calls, base positions and, once worked out, normalized channels)
+# that are memory-mapped on load. Entries are evicted least recently used first once
+# the cache grows past max_bytes: the cache is measured on the first store, the bytes
+# stored since are added to that, and it is only measured (and trimmed) again once
+# the total passes max_bytes. Settings come from the environment by default:
+# CRISPY_CACHE=0 turns it off, CRISPY_CACHE_DIR moves it and CRISPY_CACHE_MB sizes it.
+class TraceCache(object):
+    def __init__(self, cache_dir=None, max_bytes=None, enabled=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get('CRISPY_CACHE_DIR',
+                                       os.path.join(os.path.expanduser('~'), '.cache', 'crispy'))
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get('CRISPY_CACHE_MB', 512)) * 1024 * 1024)
+        if enabled is None:
+            enabled = os.environ.get('CRISPY_CACHE', '1').lower() not in ('0', 'false', 'no', 'off')
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        # bytes in the cache as of the last evict() plus those stored since (None
+        # until it has been measured)
+        self.size = None
+
+    def key(self, content):
+        # cache key for the raw contents of an ab1 file
+        return '%s-v%d' % (hashlib.sha1(content).hexdigest(), TRACE_CACHE_VERSION)
+
+    def load(self, key, name):
+        # returns the named array of an entry (memory-mapped, read only), or None
+        if not self.enabled:
+            return None
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            array = np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+            # mark the entry as recently used
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        return array
+
+    def store(self, key, name, array):
+        # saves an array into an entry. Files are written under a temporary name and
+        # moved into place, so several processes can fill the same cache
+        if not self.enabled:
+            return
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            os.makedirs(entry, exist_ok=True)
+            handle, temp_path = tempfile.mkstemp(dir=entry, suffix='.tmp')
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, array)
+                written = f.tell()
+            os.replace(temp_path, os.path.join(entry, name + '.npy'))
+        except OSError:
+            # the cache is only an optimization, so carry on without it
+            return
+        # (a file that replaces one of the same name is counted again, and other
+        # processes' files are only counted once the cache is measured again, so
+        # this errs on the side of measuring too often)
+        if self.size is not None:
+            self.size += written
+        if self.size is None or self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # removes least recently used entries until the cache fits in max_bytes
+        entries = []
+        total_size = 0
+        try:
+            for entry in os.scandir(self.cache_dir):
+                if not entry.is_dir():
+                    continue
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                entries.append((entry.stat().st_mtime, size, entry.path))
+                total_size += size
+        except OSError:
+            self.size = None
+            return
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+        self.size = total_size
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.size = None
+# End TraceCache Class
+
+# Cache used by ABIparse and SeqDoc (set enabled to False, or replace it, to change it)
+trace_cache = TraceCache()
+
+# Per-stage instrumentation. When enabled, every profiled stage (parsing, normalizing,
+# the offset search, alignment, differences, target location, off-target scoring and
+# mutation frequencies) makes one record: stage name, enclosing stage, wall and CPU
+# seconds, input sizes and, with memory set, the peak memory it allocated (from
+# tracemalloc, which slows allocation down while on). Records are passed to each
+# callable in hooks and appended as JSON lines to path, if set; anything in context
+# (e.g. the sample being analyzed) is added to every record. Several processes can
+# append to the same file, and summarize_profile adds the records up by stage.
+# Settings come from the environment by default: CRISPY_PROFILE names the file and
+# CRISPY_PROFILE_MEMORY=1 records memory. When disabled, stages run as they are.
+class StageProfiler(object):
+    def __init__(self, path=None, memory=None, hooks=None):
+        if path is None:
+            path = os.environ.get('CRISPY_PROFILE') or None
+        if memory is None:
+            memory = os.environ.get('CRISPY_PROFILE_MEMORY', '0').lower() in ('1', 'true', 'yes', 'on')
+        self.path = path
+        self.memory = memory
+        self.hooks = list(hooks or [])
+        self.context = {}
+        self.enabled = path is not None or bool(self.hooks)
+        self._local = threading.local()
+        self._file = None
+        self._file_pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the open file, lock and per-thread stage stacks stay with this process
+        state = self.__dict__.copy()
+        for name in ('_local', '_file', '_file_pid', '_lock'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._file = None
+        self._file_pid = None
+        self._lock = threading.Lock()
+
+    def stage(self, name, **sizes):
+        # context manager that records one run of the named stage
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name, sizes)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def emit(self, record):
+        for hook in self.hooks:
+            hook(record)
+        if self.path is None:
+            return
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            # a forked worker opens the file for itself
+            if self._file is None or self._file_pid != os.getpid():
+                self._file = open(self.path, 'a')
+                self._file_pid = os.getpid()
+            # one write per record, so lines from several processes don't mix
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None and self._file_pid == os.getpid():
+            self._file.close()
+        self._file = None
+# End StageProfiler Class
+
+# One run of a profiled stage, see StageProfiler
+class _Stage(object):
+    def __init__(self, profiler, name, sizes):
+        self.profiler = profiler
+        self.name = name
+        self.sizes = sizes
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        self.parent = stack[-1].name if stack else None
+        if self.profiler.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            # the enclosing stage keeps the peak so far before it is reset for this one
+            if stack and stack[-1].profiler.memory:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = self.peak = current
+        stack.append(self)
+        self.start = time.time()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        stack = self.profiler._stack()
+        stack.pop()
+        record = dict(self.profiler.context)
+        record.update(stage=self.name, parent=self.parent, start=self.start, wall=wall, cpu=cpu,
+                      pid=os.getpid())
+        if self.profiler.memory and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record['peak_bytes'] = self.peak - self.start_memory
+            # (the enclosing stage's peak includes this one's)
+            if stack and stack[-1].profiler.memory:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+        record.update(self.sizes)
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        self.profiler.emit(record)
+        return False
+# End _Stage Class
+
+# What StageProfiler.stage gives when profiling is off
+class _NoStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NO_STAGE = _NoStage()
+
+# Profiler used by every profiled stage (set enabled, path, hooks or memory on it,
+# or replace it, to change it)
+profiler = StageProfiler()
+
+# Decorator that runs a method or function as a profiled stage. sizes, if given, is
+# called with the same arguments and gives the input sizes to record
+def _profiled(name, sizes=None):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with profiler.stage(name, **(sizes(*args, **kwargs) if sizes is not None else {})):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Reads back the records of a profile file
+def read_profile(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+# Adds up profile records (e.g. from every worker of a batch run) by stage: number
+# of runs, total and longest wall time, total CPU time and largest peak memory
+def summarize_profile(records):
+    summary = {}
+    for record in records:
+        stage = summary.setdefault(record['stage'], {'count': 0, 'wall': 0.0, 'max_wall': 0.0, 'cpu': 0.0})
+        stage['count'] += 1
+        stage['wall'] += record['wall']
+        stage['max_wall'] = max(stage['max_wall'], record['wall'])
+        stage['cpu'] += record['cpu']
+        if 'peak_bytes' in record:
+            stage['peak_bytes'] = max(stage.get('peak_bytes', 0), record['peak_bytes'])
+    return summary
+
+# Smallest integer type that holds all of the values, for compact cache files
+def _compact(array):
+    for dtype in (np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if not array.size or (array.min() >= info.min and array.max() <= info.max):
+            return array.astype(dtype)
+    return array
+
+# Reads just the given tags (e.g. 'DATA9', 'PBAS2') out of the contents of an ABIF
+# file, without decoding the rest of its directory. Numeric tags come back as numpy
+# arrays and char tags as bytes. Raises ValueError if the file isn't ABIF or a tag
+# is missing; tags in optional are just left out when missing.
+def read_abif_tags(content, tags, optional=()):
+    if len(content) < 34 or content[:4] != b'ABIF':
+        raise ValueError('not an ABIF file')
+    # the header holds the directory's own entry: element count and data offset
+    dir_count, dir_size, dir_offset = struct.unpack_from('>iii', content, 18)
+    if dir_offset < 0 or dir_offset + dir_count * 28 > len(content):
+        raise ValueError('ABIF directory is out of range')
+    wanted = {}
+    for tag in list(tags) + list(optional):
+        wanted[(tag[:4].encode(), int(tag[4:]))] = tag
+
+    values = {}
+    for entry in range(dir_count):
+        entry_offset = dir_offset + entry * 28
+        (name, number, elem_type, elem_size, elem_count,
+         data_size, data_offset) = struct.unpack_from('>4sihhiii', content, entry_offset)
+        tag = wanted.get((name, number))
+        if tag is None or tag in values:
+            continue
+        # data of 4 bytes or less is kept in the entry itself
+        if elem_count < 0 or data_size < 0:
+            raise ValueError('ABIF tag ' + tag + ' has a negative size')
+        if data_size <= 4:
+            data_offset = entry_offset + 20
+        if data_offset < 0 or data_offset + data_size > len(content):
+            raise ValueError('ABIF tag ' + tag + ' is out of range')
+        if elem_type == 2:
+            values[tag] = bytes(content[data_offset:data_offset + data_size])
+        elif elem_type in ABIF_TYPES:
+            dtype = np.dtype(ABIF_TYPES[elem_type])
+            if dtype.itemsize * elem_count > data_size:
+                raise ValueError('ABIF tag ' + tag + ' is truncated')
+            values[tag] = np.frombuffer(content, dtype, elem_count, data_offset).astype(dtype.newbyteorder('='))
+        else:
+            raise ValueError('ABIF tag ' + tag + ' has unsupported type ' + str(elem_type))
+    for tag in tags:
+        if tag not in values:
+            raise ValueError('ABIF tag ' + tag + ' is missing')
+    return values
+
+# Simple class to parse out ab1 file format data. The lean reader only decodes the
+# tags CrisPy uses; Biopython's full parser is used if it can't read the file, or
+# if reader='biopython' is given (which also bypasses the trace cache).
 class ABIparse(object):
-    def __init__(self, file_name):
-        record = SeqIO.read(file_name,"abi")
-        self.trace = {}
-        self.trace['A'] = list(record.annotations['abif_raw']['DATA10'])
-        self.trace['G'] = list(record.annotations['abif_raw']['DATA9'])
-        self.trace['C'] = list(record.annotations['abif_raw']['DATA12'])
-        self.trace['T'] = list(record.annotations['abif_raw']['DATA11'])
-        self.trace['sequence'] = record.annotations['abif_raw']['PBAS2'] 
-        self.trace['base_pos'] = record.annotations['abif_raw']['PLOC2']
-        self.trace['seq_length'] = len(self.trace['A'])
+    def __init__(self, file_name, reader='lean'):
+        if reader not in ABIF_READERS:
+            raise ValueError('unknown ab1 reader: ' + str(reader))
+        with open(file_name, 'rb') as f:
+            try:
+                content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file can't be mapped
+                content = b''
+        try:
+            self._read(content, reader)
+        finally:
+            if isinstance(content, mmap.mmap):
+                content.close()
+
+    @_profiled('parse', lambda self, content, reader: {'bytes': len(content), 'reader': reader})
+    def _read(self, content, reader):
+        # a parsed copy of the same file may already be cached (reader='biopython'
+        # skips the cache, so it always cross-checks the lean reader)
+        key = trace_cache.key(content) if trace_cache.enabled and reader == 'lean' else None
+        if key is not None:
+            channels = trace_cache.load(key, 'channels')
+            sequence = trace_cache.load(key, 'sequence')
+            base_pos = trace_cache.load(key, 'base_pos')
+            quality = trace_cache.load(key, 'quality')
+            if channels is not None and sequence is not None and base_pos is not None and quality is not None:
+                self.trace = Trace(channels, bytes(sequence), base_pos)
+                self.trace['cache_key'] = key
+                # (a file without quality values is cached with none)
+                if len(quality):
+                    self.trace['quality'] = np.array(quality)
+                return
+
+        self.trace = None
+        if reader == 'lean':
+            # (tags that read but don't make a trace, e.g. channels of different
+            # lengths, go to Biopython as well)
+            try:
+                self.trace = self._trace(read_abif_tags(content, ABIF_TAGS, ABIF_OPTIONAL_TAGS))
+            except (ValueError, struct.error):
+                self.trace = None
+        if self.trace is None:
+            from Bio import SeqIO
+            record = SeqIO.read(io.BytesIO(bytes(content)),"abi")
+            self.trace = self._trace(record.annotations['abif_raw'])
+        if key is not None:
+            self.trace['cache_key'] = key
+            trace_cache.store(key, 'channels', _compact(self.trace.data))
+            trace_cache.store(key, 'sequence', np.frombuffer(self.trace.sequence.encode(), dtype=np.uint8))
+            trace_cache.store(key, 'base_pos', _compact(self.trace.base_pos))
+            trace_cache.store(key, 'quality', self.trace.get('quality', np.zeros(0, dtype=np.uint8)))
+
+    def _trace(self, abif_raw):
+        trace = Trace([abif_raw[CHANNEL_TAGS[letter]] for letter in TRACE_LIST],
+                      abif_raw['PBAS2'], abif_raw['PLOC2'])
+        quality = abif_raw.get('PCON2')
+        if quality is not None:
+            trace['quality'] = np.frombuffer(bytes(quality), dtype=np.uint8).copy()
+        return trace
 
     def get_trace(self):
         return self.trace
@@ -29,156 +603,457 @@ class ABIparse(object):
         return self.trace['base_pos']
 # End ABIparse Class
 
+# Runs the independent pieces of one sample's analysis side by side on a pool of
+# threads or processes, to cut the time a single large sample takes (e.g. in
+# CrisPyApp): SeqDoc normalizes the two traces and scores the offset candidates on
+# it, and Sequalizer splits many sites into groups. Results come back in order and
+# are the same as serial ones. Work on traces shorter than min_datapoints, and
+# everything with one worker, is done serially. The pool is started the first time
+# it is needed and kept until close().
+class SampleExecutor(object):
+    def __init__(self, workers=None, kind='thread', min_datapoints=PARALLEL_MIN_DATAPOINTS):
+        if kind not in EXECUTOR_KINDS:
+            raise ValueError('unknown executor kind: ' + str(kind))
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = max(1, workers)
+        self.kind = kind
+        self.min_datapoints = min_datapoints
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def parallel(self, datapoints, count=2):
+        # whether count pieces of work on a trace of datapoints are worth handing out
+        return self.workers > 1 and count > 1 and datapoints >= self.min_datapoints
+
+    def map(self, function, items, datapoints):
+        # [function(item) for item in items], on the pool if it is worth it. In a
+        # process pool, function and items have to be picklable
+        items = list(items)
+        if not self.parallel(datapoints, len(items)):
+            return [function(item) for item in items]
+        return list(self._executor().map(function, items))
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                from concurrent import futures
+                if self.kind == 'thread':
+                    self._pool = futures.ThreadPoolExecutor(self.workers)
+                else:
+                    self._pool = futures.ProcessPoolExecutor(self.workers)
+            return self._pool
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+# End SampleExecutor Class
+
+# The pieces of work SeqDoc and Sequalizer hand to a SampleExecutor (module level,
+# so that a process pool can pickle them)
+def _normalize_job(trace):
+    # a trace's normalized channels
+    SeqDoc.__new__(SeqDoc).normalize_data(trace)
+    return trace.data
+
+def _offset_scores_job(job):
+    # SeqDoc._offset_scores for some of the offsets
+    ref_window, test_window, offsets = job
+    return SeqDoc.__new__(SeqDoc)._offset_scores(ref_window, test_window, offsets)
+
+def _partial_align_job(job):
+    # the score of a partial alignment of the first 1000 datapoints at one offset
+    ref_window, test_window, offset = job
+    seqdoc = SeqDoc.__new__(SeqDoc)
+    temp_ref, temp_test = seqdoc._align(ref_window.copy(), test_window.copy(), offset, 1000)
+    return seqdoc._get_score(200, 1000, 0, temp_ref, temp_test)
+
+def _site_freqs_job(job):
+    # Sequalizer.get_mutation_freqs for a group of sites
+    ref_data, test_data, diff_data, target_sequence, target_range, sites = job
+    return Sequalizer(ref_data, test_data, diff_data, target_sequence, target_range).get_mutation_freqs(sites)
+
 # This class is a modified version of SeqDoc (Crowe, M. L. (2005). BMC Bioinformatics, 6(1), 133)
 # its purpose is to normalize, align, and find the difference of two sanger sequence traces
 # the script was converted to python and updated for integration with Sequalizer
 class SeqDoc(object):
-    def __init__(self, ref_file, test_file):
-        ref_abi = ABIparse(ref_file)
-        test_abi = ABIparse(test_file)      
-        self.ref_trace = ref_abi.trace
-        self.test_trace = test_abi.trace 
+    def __init__(self, ref_file, test_file, offset_search='batched', trim=None, executor=None):
+        # either file can also be given as an already parsed (or normalized) Trace,
+        # e.g. a reference shared by many test files
+        if isinstance(ref_file, Trace):
+            self.ref_trace = ref_file
+        else:
+            self.ref_trace = ABIparse(ref_file).trace
+        if isinstance(test_file, Trace):
+            self.test_trace = test_file
+        else:
+            self.test_trace = ABIparse(test_file).trace
+        # how get_best_align picks the starting offset, see OFFSET_SEARCH_MODES
+        if offset_search not in OFFSET_SEARCH_MODES:
+            raise ValueError('unknown offset search mode: ' + str(offset_search))
+        self.offset_search = offset_search
+        # with trim set (see TRIM_MODES), get_all_data only compares the stretch
+        # where both traces are good
+        if trim is not None and trim not in TRIM_MODES:
+            raise ValueError('unknown trim mode: ' + str(trim))
+        self.trim = trim
+        self.trimmed = None
+        # a SampleExecutor to do independent pieces of the work side by side, if any
+        self.executor = executor
+
+    def prepare_trace(self, trace_data):
+        # Normalizes a trace unless that was already done. The normalized channels of
+        # a trace read from an ab1 file are cached, so the same file is only ever
+        # normalized once
+        if self._load_normalized(trace_data):
+            return
+        self.normalize_data(trace_data)
+        self._store_normalized(trace_data)
 
+    def prepare_traces(self, *traces):
+        # prepare_trace for each of the traces, normalizing them side by side if
+        # there is an executor
+        executor = getattr(self, 'executor', None)
+        if executor is None:
+            for trace_data in traces:
+                self.prepare_trace(trace_data)
+            return
+        pending = [trace_data for trace_data in traces if not self._load_normalized(trace_data)]
+        datapoints = min([trace_data['seq_length'] for trace_data in pending] or [0])
+        for trace_data, normalized in zip(pending, executor.map(_normalize_job, pending, datapoints)):
+            # (a process pool's worker normalized a copy)
+            if normalized is not trace_data.data:
+                trace_data.data = _channel_array(normalized)
+            trace_data['normalized'] = True
+            self._store_normalized(trace_data)
+
+    def _load_normalized(self, trace_data):
+        # True if the trace is normalized already or its normalized channels were
+        # in the cache (and are now in the trace)
+        if trace_data.get('normalized'):
+            return True
+        key = trace_data.get('cache_key')
+        if key is not None:
+            normalized = trace_cache.load(key, 'normalized')
+            if normalized is not None and normalized.shape == trace_data.data.shape:
+                trace_data.data = _channel_array(normalized)
+                trace_data['normalized'] = True
+                return True
+        return False
+
+    def _store_normalized(self, trace_data):
+        key = trace_data.get('cache_key')
+        if key is not None:
+            trace_cache.store(key, 'normalized', _compact(trace_data.data))
+
+    @_profiled('normalize', lambda self, trace_data: {'datapoints': trace_data['seq_length']})
     def normalize_data(self, trace_data):
 
         # can only normalize for larger sequences
         if trace_data['seq_length'] < 1100:
             raise Exception('sequence too short')
+        # All three regions read only the original values, so they are worked out
+        # first and written back at the end, with no copy of the trace needed
+        trace_data.data = _channel_array(self._normalized_columns(trace_data, np.arange(trace_data['seq_length'])))
+        trace_data['normalized'] = True
 
-        # Need to create new reference arrays, since normalization alters the existing
-        # values in the hash
-        orig_trace = {}
-        for letter in TRACE_LIST:
-            orig_trace[letter] = trace_data[letter].copy()
+    def _normalized_columns(self, trace_data, columns):
+        # Gives the given columns of the trace (any order, repeats allowed) as
+        # normalize_data would leave them, without normalizing the rest. Every window
+        # sum is taken from running totals over the summed channels, kept only from
+        # 500 datapoints before the first column asked for to 500 after the last
+        # (prefix_sums[k - low_sum] is the total of the datapoints before k), so a
+        # few columns of a long trace are cheap to work out.
+        data = trace_data.data
+        seq_length = trace_data['seq_length']
+        columns = np.asarray(columns, dtype=np.int64)
+        # (worked out in 64 bits, whatever type the channels are kept in)
+        normalized = data[:, columns].astype(np.int64)
+        if not len(columns):
+            return normalized
+        low_sum = max(int(columns.min()) - 500, 0)
+        high_sum = min(int(columns.max()) + 501, seq_length)
+        prefix_sums = np.concatenate(([0], np.cumsum(data[:, low_sum:high_sum].sum(axis=0, dtype=np.int64))))
+
+        if seq_length < 1100:
+            # too short for the three regions below (only ROI and trimmed windows get here): each
+            # point is normalized over the up to 500 points either side of it
+            low = np.maximum(columns - 500, 0)
+            high = np.minimum(columns + 500, seq_length)
+            total_sum = prefix_sums[high - low_sum] - prefix_sums[low - low_sum]
+            total_sum[total_sum == 0] = 1000
+            normalized[:] = np.trunc((data[:, columns] / total_sum) * (high - low) * 4 * 100)
+            return normalized
 
         # Calculate normalized datapoints, starting with the middle points
-        for datapoint in range(500, trace_data['seq_length']-501):
-            total_sum =0
-            # Normalize to 100. Divide by sum of all values, multiply by number of  
-            # values, and multiply by 100;
-            # adding up the 1000 values around datapoint
-            for letter in TRACE_LIST:
-                temp_array = orig_trace[letter][datapoint-500:datapoint+500]
-                total_sum += sum(temp_array)
-            for letter in TRACE_LIST:
-                # Blank sequence can cause problems through division by zero errors.
-                # Deleting trailing blank sequence helps, but just put in a default value
-                # for totalsum in case of problems.
-                if total_sum == 0:
-                    total_sum = 1000
-                # Calculate normalized data
-                trace_data[letter][datapoint] = int((orig_trace[letter][datapoint] / total_sum) * 4000 * 100)
-        
+        # Normalize to 100. Divide by sum of all values, multiply by number of  
+        # values, and multiply by 100;
+        # adding up the 1000 values around datapoint
+        middle = (columns >= 500) & (columns < seq_length-501)
+        point = columns[middle]
+        total_sum = prefix_sums[point+500-low_sum] - prefix_sums[point-500-low_sum]
+        # Blank sequence can cause problems through division by zero errors.
+        # Deleting trailing blank sequence helps, but just put in a default value
+        # for totalsum in case of problems.
+        total_sum[total_sum == 0] = 1000
+        normalized[:, middle] = np.trunc((data[:, point] / total_sum) * 4000 * 100)
+
         # Now do first 500 - special case, since can't do 500 before. Instead just 
         # take all points before. Not so critical anyway, since data quality is poor
         # at start so any mismatches will be unreliable anyway.
-        # Start by initialising totalsum
-        total_sum = 0
-        for letter in TRACE_LIST:
-            temp_array = orig_trace[letter][0:500]
-            total_sum += sum(temp_array)
-        # Blank sequence can cause problems through division by zero errors.
-        # Deleting trailing blank sequence helps, but just put in a default value
-        # for totalsum in case of problems.     
-        if total_sum == 0:
-            total_sum = 1000
-
-        for datapoint in range(0,499):
-            #Can do 500 after though
-            end = datapoint + 500
-            # Normalize to 100. Divide by sum of all values, multiply by number of
-            # values, and multiply by 100;
-            for letter in TRACE_LIST:
-                if total_sum == 0:
-                    total_sum = 1000
-                # Calculate normalized data
-                trace_data[letter][datapoint] = int((orig_trace[letter][datapoint] / total_sum) * end * 4 * 100)
-            for letter in TRACE_LIST:
-                # Add next value to totalsum, to keep 500 values after
-                total_sum += orig_trace[letter][end + 1]
+        # Start with the first 500 points, then add next value to totalsum, to keep
+        # 500 values after
+        first = np.arange(0, 499)
+        #Can do 500 after though
+        end = first + 500
+        in_first = columns < 499
+        if in_first.any():
+            point = columns[in_first]
+            total_sum = self._running_totals(int(data[:, :500].sum(dtype=np.int64)),
+                                             data[:, end[0] + 1:end[-1] + 2].sum(axis=0, dtype=np.int64))[point]
+            normalized[:, in_first] = np.trunc((data[:, point] / total_sum) * end[point] * 4 * 100)
 
         # Finally the last 500 - again a special case, as can't do 500 after. Instead 
         # just take all points after. Not so critical anyway, since data quality is
         # poor at end so any mismatches will be unreliable anyway.
-        # Again start by initialising totalsum
-        total_sum = 0
-        for letter in TRACE_LIST:
-            temp_array = orig_trace[letter][trace_data['seq_length'] - 1000: trace_data['seq_length'] - 1]
-            total_sum += sum(temp_array)
-        # Identify start and finish points
-        (first, last) = (trace_data['seq_length']-500, trace_data['seq_length'] - 1)
-        for datapoint in range(first, last):
-            start = datapoint - 500
-            # Normalize to 100. Divide by sum of all values, multiply by number of
-            # values, and multiply by 100;
-            for letter in TRACE_LIST:
-                if total_sum == 0:
-                    total_sum = 1000
-                # Calculate normalized data
-                trace_data[letter][datapoint] = int((orig_trace[letter][datapoint] / total_sum) * (last-start) * 4 *100)
-            # Subtract first value from totalsum, to keep to 500 point before test
-            for letter in TRACE_LIST:
-                total_sum -= abs(orig_trace[letter][start])
+        # Start with the last 1000 points, then subtract first value from totalsum,
+        # to keep to 500 point before test
+        (first_pos, last) = (seq_length-500, seq_length - 1)
+        in_last = (columns >= first_pos) & (columns < last)
+        if in_last.any():
+            last_points = np.arange(first_pos, last)
+            start = last_points - 500
+            total_sum = self._running_totals(int(data[:, seq_length-1000:seq_length-1].sum(dtype=np.int64)),
+                                             -np.abs(data[:, start]).sum(axis=0, dtype=np.int64))
+            point = columns[in_last]
+            normalized[:, in_last] = np.trunc((data[:, point] / total_sum[point - first_pos]) *
+                                              (last - (point - 500)) * 4 * 100)
+        # (datapoints 499, seq_length-501 and the very last one are left as they are)
+        return normalized
+
+    def _running_totals(self, total_sum, steps):
+        # Gives the window total used at each datapoint of an edge region, where
+        # the total starts at total_sum and has steps[k] added after datapoint k.
+        # A total of zero is replaced with 1000 before it is used, and the running
+        # total carries on from that 1000, so the offset is applied from there on.
+        totals = total_sum + np.concatenate(([0], np.cumsum(steps[:-1])))
+        searched = 0
+        while True:
+            blanks = np.flatnonzero(totals[searched:] == 0)
+            if not len(blanks):
+                return totals
+            searched += blanks[0]
+            totals[searched:] += 1000
+            searched += 1
+
+    def get_best_align(self, ref_trace, test_trace, mode=None, refine=True):
+        # Finds the offset between the start of the two sequences, then aligns the
+        # full traces from it. 'batched' (default) scores every offset at once from
+        # the first 1000 datapoints and, if refine is set, checks a few partial
+        # alignments around the best one. 'stepped' is the original SeqDoc search.
+        offset = self._best_offset(ref_trace, test_trace, mode, refine)
+        # Once the best alignment has been determined, then do it for real
+        self._align(ref_trace, test_trace, offset, len(test_trace['A'])+offset)
+
+    def _best_offset(self, ref_trace, test_trace, mode=None, refine=True):
+        if mode is None:
+            mode = getattr(self, 'offset_search', 'batched')
+        if mode == 'batched':
+            return self._batched_offset(ref_trace, test_trace, refine)
+        elif mode == 'stepped':
+            return self._stepped_offset(ref_trace, test_trace)
+        raise ValueError('unknown offset search mode: ' + str(mode))
 
-    def get_best_align(self, ref_trace, test_trace):
+    @_profiled('best_offset', lambda self, ref_trace, test_trace: {
+        'mode': 'stepped', 'ref_datapoints': ref_trace['seq_length'], 'test_datapoints': test_trace['seq_length']})
+    def _stepped_offset(self, ref_trace, test_trace):
         # This does an alignment of the first 1000 datapoints using a range of offsets
         # from -200 to 200. The best alignment is picked on the basis of having the
         # lowest score from datapoint 200 to 1000, and is used to allow for any
-        # variation in start position of the two sequences.
-        scores = {}
-        temp_ref = {}
-        temp_test = {}
-        for offset in range(-200, 200, 20):
-            # Create temporary hashes, since a hash reference is passed to the function
-            # and otherwise the real hash will be modified
-            for letter in TRACE_LIST:
-                temp_ref[letter] = ref_trace[letter].copy()
-                temp_test[letter] = test_trace[letter].copy()
-            # Do a partial alignment (first 1000 datapoints)
-            temp_ref, temp_test = self._align(temp_ref, temp_test, offset, 1000)
-            # Work out the score for that alignment
-            scores[offset] = self._get_score(200, 1000, 0, temp_ref, temp_test)
+        # variation in start position of the two sequences. Each offset's partial
+        # alignment is done on copies of the leading columns (see _offset_window),
+        # so the real traces aren't modified, and the offsets can be done side by
+        # side (see SampleExecutor)
+        offsets = list(range(-200, 200, 20))
+        ref_window = self._offset_window(ref_trace)
+        test_window = self._offset_window(test_trace)
+        # Do a partial alignment (first 1000 datapoints) and work out its score
+        scores = dict(zip(offsets, self._map(_partial_align_job, [(ref_window, test_window, offset)
+                                                                  for offset in offsets], ref_trace)))
         # Sort the scores to find out the lowest, and record the value of that offset
         offset = sorted(scores.items(), key=lambda x:x[1])
-        # Once the best alignment has been determined, then do it for real
-        self._align(ref_trace, test_trace, offset[0][0], len(test_trace['A'])+offset[0][0])
+        return offset[0][0]
+
+    @_profiled('best_offset', lambda self, ref_trace, test_trace, refine: {
+        'mode': 'batched', 'ref_datapoints': ref_trace['seq_length'], 'test_datapoints': test_trace['seq_length']})
+    def _batched_offset(self, ref_trace, test_trace, refine):
+        # Scores every offset from -200 to 200 by the total difference between
+        # datapoints 200 to 1000 of the reference and the offset (unwarped) test
+        # trace. Any drift between the traces blurs that score, so with refine set
+        # the offsets around the best one are re-scored the way 'stepped' does it,
+        # by a partial alignment of the first 1000 datapoints. (Both only read the
+        # leading columns, so with an executor just those are handed out.)
+        ref_window = self._offset_window(ref_trace)
+        test_window = self._offset_window(test_trace)
+        offsets = np.arange(-200, 200)
+        executor = getattr(self, 'executor', None)
+        if executor is not None and executor.parallel(ref_trace['seq_length']):
+            groups = np.array_split(offsets, executor.workers)
+            scores = np.concatenate(self._map(_offset_scores_job, [(ref_window, test_window, group)
+                                                                   for group in groups], ref_trace))
+        else:
+            scores = self._offset_scores(ref_trace, test_trace, offsets)
+        best = int(offsets[np.argmin(scores)])
+        if not refine:
+            return best
+
+        # (nearest first, so a tie keeps the offset closest to the best one)
+        candidates = sorted(range(max(best - 10, -200), min(best + 11, 200), 5), key=lambda x:abs(x-best))
+        scores = {}
+        for offset, score in zip(candidates, self._map(_partial_align_job, [(ref_window, test_window, offset)
+                                                                            for offset in candidates], ref_trace)):
+            if score != 'no_score':
+                scores[offset] = score
+        if scores:
+            best = sorted(scores.items(), key=lambda x:x[1])[0][0]
+        return best
+
+    def _map(self, function, items, trace):
+        # [function(item) for item in items], on the executor if there is one
+        executor = getattr(self, 'executor', None)
+        if executor is None:
+            return [function(item) for item in items]
+        return executor.map(function, items, trace['seq_length'])
+
+    def _offset_scores(self, ref_trace, test_trace, offsets):
+        # Total difference over datapoints 200 to 1000 for each offset at once. The
+        # test trace is read at datapoint + offset (an offset that runs off the end
+        # of the test trace can't be scored, so is never picked)
+        end = min(1000, ref_trace['seq_length'])
+        test_index = np.arange(200, end)[np.newaxis, :] + offsets[:, np.newaxis]
+        in_range = test_index.max(axis=1) < test_trace['seq_length']
+        scores = np.full(len(offsets), np.inf)
+        if in_range.any():
+            test_index = test_index[in_range]
+            totals = np.zeros(len(test_index), dtype=np.int64)
+            for row in range(len(TRACE_LIST)):
+                totals += np.abs(np.subtract(test_trace.data[row][test_index], ref_trace.data[row, 200:end],
+                                             dtype=np.int64)).sum(axis=1)
+            scores[in_range] = totals
+        return scores
+
+    def _offset_window(self, trace):
+        # The columns a partial alignment of the first 1000 datapoints can reach
+        # (1000 datapoints, plus up to 200 offset and one added/deleted column per
+        # three datapoints). The last column is kept as well, since the very first
+        # alignment check wraps round to it.
+        if trace['seq_length'] <= OFFSET_WINDOW:
+            return trace.copy()
+        window = Trace(np.concatenate((trace.data[:, :OFFSET_WINDOW], trace.data[:, -1:]), axis=1),
+                       trace.sequence, trace.base_pos)
+        return window
 
+    @_profiled('align', lambda self, ref, test, min_index, trace_length: {
+        'ref_datapoints': ref['seq_length'], 'test_datapoints': test['seq_length'], 'trace_length': trace_length})
     def _align(self, ref, test, min_index, trace_length):
         # This takes the normalized traces and returns a best alignment of the two.
-        # Rows are added to or deleted from the test trace to keep the alignment.
-        # Best alignment is calculated by minimising the difference between the test
-        # and reference sequence over the next 30 datapoints. It is adjusted every five
-        # bases. Inserted lines are just a duplicate of the previous line.
-
-        # Add/delete the appropriate number of lines to the test sequence to correct
-        # for the offset value
-        if min_index < 0:
-            # Need to add lines to test sequence, since it's behind
-            for i in range(min_index, 0):
-                for letter in TRACE_LIST:
-                    test[letter].insert(0,test[letter][0])
-        elif min_index > 0:
-            # Need to delete lines from test sequence, since it's ahead
-            for letter in TRACE_LIST:
-                del test[letter][:min_index]
+        # Columns are added to or deleted from the test trace to keep the alignment
+        # (see _warp). The test trace is never edited while aligning: the offset and
+        # every added/deleted column are kept as an index map into the original
+        # columns, and the aligned test trace is built from it once at the end.
+        # Add/delete the appropriate number of columns to the test sequence to correct
+        # for the offset value (columns added at the start duplicate the first one)
+        test_length = test['seq_length'] - min_index
         # Make a note of the offset value for datapoint numbering
         test['initial_offset'] = min_index
         ref['initial_offset'] = 0
 
+        offset_index = np.maximum(np.arange(max(test_length, 0)) + min_index, 0)
+
+        change_pos = []
+        change_shift = []
+        for done, shift, positions, shifts in self._warp(lambda first, last: ref.data[:, first:last],
+                                                         lambda first, last: test.data[:, offset_index[first:last]],
+                                                         ref['seq_length'], test_length, trace_length):
+            change_pos += positions
+            change_shift += shifts
+
+        # Build the aligned test trace from the index map
+        aligned_length = max(test_length, 0) - shift
+        changes = np.zeros(aligned_length + 1, dtype=np.int64)
+        changes[change_pos] = change_shift
+        aligned_index = np.arange(aligned_length) + np.cumsum(changes)[:aligned_length]
+        test.data = test.data[:, offset_index[aligned_index]]
+
+        return ref, test
+
+    def _warp(self, ref_columns, test_columns, ref_length, test_length, trace_length):
+        # Works out where columns are added to or deleted from the test trace to keep
+        # it aligned with the reference. Best alignment is calculated by minimising
+        # the difference between the test and reference sequence over the next 30
+        # datapoints. It is adjusted every five bases. Inserted columns are just a
+        # duplicate of the previous column.
+        # ref_columns(first, last) gives the reference's normalized columns first to
+        # last-1 and test_columns(first, last) those of the test trace once it is
+        # offset (test_length columns long). Yields (done, shift, positions, shifts)
+        # every ALIGN_CHUNK datapoints and once at the end: every aligned column
+        # before done is final (done is None at the end), shift counts deleted minus
+        # added columns so far, and positions/shifts are the columns added (-1) or
+        # deleted (+1) since the last yield.
+        # Every column from the one before the current datapoint onwards is still the
+        # offset test column at (position + shift), where shift counts deleted minus
+        # added columns so far. Window scores along each shift are taken from cached
+        # running totals of the column differences, worked out one chunk at a time
+        # (only the current chunk's are kept).
+        diagonal_sums = {}
+
+        def window_score(start_pos, shift):
+            chunk = start_pos // ALIGN_CHUNK
+            if (chunk, shift) not in diagonal_sums:
+                first = chunk * ALIGN_CHUNK
+                last = min(first + ALIGN_CHUNK + 30, ref_length, test_length - shift)
+                lead = max(first, -shift)
+                column_diffs = np.zeros(max(last - first, 0), dtype=np.int64)
+                if last > lead:
+                    column_diffs[lead-first:] = np.abs(np.subtract(ref_columns(lead, last),
+                                                                   test_columns(lead+shift, last+shift),
+                                                                   dtype=np.int64)).sum(axis=0)
+                diagonal_sums[(chunk, shift)] = np.concatenate(([0], np.cumsum(column_diffs)))
+            sums = diagonal_sums[(chunk, shift)]
+            start_pos -= chunk * ALIGN_CHUNK
+            return int(sums[start_pos + 30] - sums[start_pos])
+
         # Now check alignments
-        for i in range(0, trace_length-1):
-            # Each third entry (starting from 1), check alignment
-            if i%3:
-                continue
-            start_pos = i
-            end_pos = i + 30
+        shift = 0
+        change_pos = []
+        change_shift = []
+        for i in range(0, trace_length-1, 3):
+            # Each third entry (starting from 1), check alignment. Stop once the 30
+            # datapoints (plus one either way) run off the end of either trace
+            if i + 30 > ref_length or i + 31 + shift > test_length:
+                break
+            if i and i % ALIGN_CHUNK < 3:
+                diagonal_sums.clear()
+                yield i, shift, change_pos, change_shift
+                change_pos = []
+                change_shift = []
             # Compare the scores in the current alignment with those one data point in 
             # either direction
-            score = self._get_score(start_pos, end_pos, 0, ref, test)
-            pre_score = self._get_score(start_pos, end_pos, -1, ref, test)
-            post_score = self._get_score(start_pos, end_pos, 1, ref, test)
-            if (score == 'no_score') or (pre_score == 'no_score') or (post_score == 'no_score'):
-                break
+            score = window_score(i, shift)
+            pre_score = window_score(i, shift - 1)
+            post_score = window_score(i, shift + 1)
+            if i == 0:
+                # The point before the first one wraps round to the last point
+                pre_score += int(np.abs(np.subtract(ref_columns(0, 1), test_columns(test_length - 1, test_length),
+                                                    dtype=np.int64)).sum())
             # Work out offset
             # Default is 0; score is the lowest of the three
             if (score < pre_score) and (score < post_score):
@@ -192,105 +1067,606 @@ class SeqDoc(object):
             # If in doubt, default to no change
             else:
                 offset = 0
-            # Now insert or delete lines as required
+            # Now note the column to insert or delete as required
             if offset == 1:
-                # The reference sample is behind, need to delete a row from test
-                for letter in TRACE_LIST:
-                    del test[letter][i]
+                # The reference sample is behind, need to delete a column from test
+                change_pos.append(i)
+                change_shift.append(1)
+                shift += 1
             elif offset == -1:
-                # The reference sample is ahead, need to add a row to test
-                for letter in TRACE_LIST:
-                    test[letter].insert(i, test[letter][i])
-
-        # Reset length of test sequence to correct value
-        test['seq_length'] = len(test['A'])
-
-        return ref, test
+                # The reference sample is ahead, need to add a column to test (the
+                # column after it then repeats the one at i)
+                change_pos.append(i+1)
+                change_shift.append(-1)
+                shift -= 1
+        yield None, shift, change_pos, change_shift
 
     def _get_score(self, start, end, offset, ref, test):
         # Subroutine used in alignment testing - it gets the total difference between
         # the two submitted sections of array and returns it.
-        score = 0
-        for i in range(start, end):
-            try:
-                for letter in TRACE_LIST:
-                    score += abs(ref[letter][i] - test[letter][i + offset])
-            except IndexError:
-                return 'no_score'
-        return score
+        if start >= end:
+            return 0
+        # Running off the end of either trace means there is nothing to score
+        if end > ref['seq_length'] or end + offset > test['seq_length']:
+            return 'no_score'
+        # Negative indices wrap around, as they would for a list
+        test_index = np.arange(start + offset, end + offset)
+        return int(np.abs(np.subtract(ref.data[:, start:end], test.data[:, test_index], dtype=np.int64)).sum())
     
+    @_profiled('differences', lambda self, ref, test: {'datapoints': min(ref['seq_length'], test['seq_length'])})
     def differences(self, ref, test):
         # Takes the two traces and calculates the difference between the two. Then 
         # squares this difference to highlight the larger (relevent) changes.
         # Also returns the length of the shortest sequence, so both are aligned on 
         # image generation
         min_index = min(test['seq_length'], ref['seq_length'])
-
-        # Create a hash for the difference values
+        diff_array = self._difference_columns(ref.data[:, :min_index], test.data[:, :min_index])
         diffs = {}
         for letter in TRACE_LIST:
-            diffs[letter] = []
-        # Loop through the traces and calculate the differences
-        for i in range(0, min_index):
-            # Need to do all four traces
-            for letter in TRACE_LIST:
-                # Get the difference
-                diff = ref[letter][i] - test[letter][i]
-                # Is the difference positive or negative (need to record, otherwise will 
-                # be lost on squaring)
-                sign_func = lambda a: (a>0) - (a<0)
-                sign = sign_func(diff)
-                # Stop saturation by cutting off to a max value
-                if abs(diff) > 5000:
-                    diff = 5000 * sign
-                # Highlight differences by multiplying value by total values of OTHER
-                # channels
-                diffs[letter].append(diff)
-
-            # Have now got difference for all four traces. Can accentuate real diffs
-            for letter in TRACE_LIST:
-                diff = diffs[letter][i]
-                # Is the difference positive or negative (need to record, otherwise will 
-                # be lost on squaring)
-                sign_func = lambda a: (a>0) - (a<0)
-                sign = sign_func(diff)
-                otherchannels = 1
-                # Sum all values in the other channels which have the opposite sign
-                for channel in TRACE_LIST:
-                    if channel == letter:
-                        continue
-                    value = diffs[channel][i]
-                    # Ignore if the sign is the same
-                    if value * sign > 0:
-                        continue
-                    otherchannels += value
-                finaldiff = (sign * diff * diff * math.sqrt(abs(otherchannels))) / 5000
-                if abs(finaldiff) > 5000:
-                    finaldiff = sign * 5000
-                diffs[letter][i] = finaldiff
-
+            diffs[letter] = diff_array[CHANNEL_INDEX[letter]]
         return min_index, diffs
 
+    def _difference_columns(self, ref_data, test_data):
+        # The differences of matching columns of two traces' channels (each column
+        # is worked out on its own, so a trace can be done in pieces)
+        min_index = ref_data.shape[1]
+        # Get the difference for all four traces, cutting off to a max value to
+        # stop saturation (the sign is kept, otherwise it would be lost on squaring)
+        raw_diffs = np.clip(np.subtract(ref_data, test_data, dtype=np.int64), -5000, 5000)
+        signs = np.sign(raw_diffs)
+        diff_array = raw_diffs.astype(np.float64)
+
+        # Have now got difference for all four traces. Can accentuate real diffs by
+        # multiplying by the total values of the OTHER channels. Channels are done in
+        # TRACE_LIST order, and a channel that has already been accentuated counts
+        # with its new value, as it always has.
+        for row in range(len(TRACE_LIST)):
+            diff = raw_diffs[row]
+            sign = signs[row]
+            otherchannels = np.ones(min_index)
+            # Sum all values in the other channels which have the opposite sign
+            # (values with the same sign are ignored)
+            for channel in range(len(TRACE_LIST)):
+                if channel == row:
+                    continue
+                value = diff_array[channel]
+                otherchannels += np.where(value * sign > 0, 0, value)
+            finaldiff = (sign * diff * diff * np.sqrt(np.abs(otherchannels))) / 5000
+            diff_array[row] = np.clip(finaldiff, -5000, 5000)
+        return diff_array
+
+    def stream_differences(self, chunk_size=STREAM_CHUNK):
+        # Streaming version of get_all_data, for very long traces (concatenated runs,
+        # contigs). Gives a DiffChunks whose chunks are worked out as they are read:
+        # each step normalizes the columns it needs a block at a time, moves the
+        # alignment on (see _warp) and gives the next chunk_size datapoints of the
+        # difference traces, identical to those of get_all_data. Only the blocks
+        # around the current position are kept, rather than normalized and aligned
+        # copies of both traces and the full difference traces. The reference is
+        # normalized whole first (as get_all_data leaves it, since Sequalizer reads
+        # its peaks), while the test trace is left as it is. Trimming isn't done
+        # here.
+        if getattr(self, 'trim', None) is not None:
+            raise ValueError("trimmed traces can't be streamed")
+        self.prepare_trace(self.ref_trace)
+        return DiffChunks(self._difference_chunks(chunk_size))
+
+    def _difference_chunks(self, chunk_size):
+        ref = self.ref_trace
+        test = self.test_trace
+        ref_columns = _NormalizedColumns(self, ref, chunk_size)
+        test_columns = _NormalizedColumns(self, test, chunk_size)
+        ref_length = ref['seq_length']
+
+        # the offset search only looks at the start of the traces (see _offset_window)
+        offset = self._best_offset(self._offset_window(ref_columns.head()),
+                                   self._offset_window(test_columns.head()))
+        test_length = test['seq_length'] - offset
+        test['initial_offset'] = offset
+        ref['initial_offset'] = 0
+
+        # aligned columns [start, start + chunk_size) are given once the alignment
+        # has moved past them; shift is the total shift before start
+        start = 0
+        shift = 0
+        change_pos = []
+        change_shift = []
+        # (columns before the start of the test trace repeat its first one)
+        offset_columns = lambda first, last: test_columns.range(first + offset, last + offset)
+        for done, total_shift, positions, shifts in self._warp(ref_columns.range, offset_columns,
+                                                               ref_length, test_length,
+                                                               test['seq_length'] + offset):
+            change_pos += positions
+            change_shift += shifts
+            final = done is None
+            if final:
+                # as far as differences would go: the shorter of the two traces
+                done = min(ref_length, max(test_length, 0) - total_shift)
+            while start < done and (final or start + chunk_size <= done):
+                end = min(start + chunk_size, done)
+                changes = np.zeros(end - start, dtype=np.int64)
+                ready = 0
+                while ready < len(change_pos) and change_pos[ready] < end:
+                    changes[change_pos[ready] - start] = change_shift[ready]
+                    ready += 1
+                del change_pos[:ready], change_shift[:ready]
+                aligned_index = np.arange(start, end) + shift + np.cumsum(changes)
+                shift = int(aligned_index[-1]) - (end - 1)
+                diff_array = self._difference_columns(ref_columns.range(start, end),
+                                                      test_columns.get(np.maximum(aligned_index + offset, 0)))
+                # (the warp looks back at most one ALIGN_CHUNK, plus a column either way)
+                ref_columns.release(end - ALIGN_CHUNK - 1)
+                test_columns.release(end + shift + offset - ALIGN_CHUNK - 1)
+                yield start, {letter: diff_array[CHANNEL_INDEX[letter]] for letter in TRACE_LIST}
+                start = end
+
+    @_profiled('get_all_data')
     def get_all_data(self):
-        # normalize data
-        self.normalize_data(self.ref_trace)
-        self.normalize_data(self.test_trace)
+        if getattr(self, 'trim', None) is not None:
+            return self._trimmed_data()
+        # normalize data (a trace that was normalized beforehand is used as it is)
+        self.prepare_traces(self.ref_trace, self.test_trace)
         # align the two sequences
         self.get_best_align(self.ref_trace, self.test_trace)
         # get differece traces
         align_length, diffs = self.differences(self.ref_trace, self.test_trace)
         return align_length, diffs
+
+    def _trimmed_data(self):
+        # get_all_data over just the datapoints where both traces are good (see
+        # trim_interval), cut at the same datapoints in each so their offset is
+        # kept. Only that stretch is normalized, aligned and differenced. The
+        # difference traces cover all of the reference's datapoints (zero outside
+        # the stretch), and the reference is left with the stretch normalized and
+        # zeros elsewhere, so Sequalizer gives nan for sites outside it rather than
+        # frequencies read off junk. self.trimmed is the stretch [start, end).
+        ref = self.ref_trace
+        test = self.test_trace
+        start, end = 0, min(ref['seq_length'], test['seq_length'])
+        for trace in (ref, test):
+            first, last = trim_interval(trace, self.trim)
+            if last <= first:
+                raise ValueError('no good signal in trace')
+            start = max(start, int(trace['base_pos'][first]) - TRIM_PAD)
+            end = min(end, int(trace['base_pos'][last - 1]) + TRIM_PAD + 1)
+        if end - start < TRIM_MIN_LENGTH:
+            raise ValueError('traces have too little good signal in common')
+
+        windows = []
+        for trace in (ref, test):
+            window = trace_window(trace, start, end)
+            if not window.get('normalized'):
+                # (works on a stretch of any length, as get_roi_data does)
+                window.data = _channel_array(self._normalized_columns(window, np.arange(window['seq_length'])))
+                window['normalized'] = True
+            windows.append(window)
+        ref_window, test_window = windows
+        self.get_best_align(ref_window, test_window)
+        window_length, window_diffs = self.differences(ref_window, test_window)
+
+        diffs = {}
+        for letter in TRACE_LIST:
+            diffs[letter] = np.zeros(ref['seq_length'])
+            diffs[letter][start:start + window_length] = window_diffs[letter]
+        full_ref = Trace(np.zeros_like(ref.data), ref.sequence, ref.base_pos)
+        full_ref.data[:, start:end] = ref_window.data
+        full_ref.extra = dict(ref_window.extra, trimmed=(start, end))
+        full_ref['normalized'] = True
+        self.ref_trace = full_ref
+        self.test_trace = test_window
+        self.trimmed = (start, end)
+        return ref['seq_length'], diffs
+
+    def roi_windows(self, target_sequence, sites=(), pad=ROI_PAD):
+        # Datapoint ranges [start, end) of the reference around the target and each
+        # off-target site (positions as given to Sequalizer), padded by pad and merged
+        # where they overlap. Sites that fall off the reference are left out.
+        ref = self.ref_trace
+        sequence = ref['sequence']
+        base_pos = ref['base_pos']
+        windows = []
+        for site in [None] + list(sites):
+            first, last = site_span(sequence, target_sequence, site)
+            if first < 0 or last >= min(len(sequence), len(base_pos)):
+                continue
+            windows.append((max(int(base_pos[first]) - pad, 0),
+                            min(int(base_pos[last]) + pad, ref['seq_length'])))
+        merged = []
+        for start, end in sorted(windows):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [(start, end) for start, end in merged]
+
+    @_profiled('get_roi_data', lambda self, target_sequence, sites=(), pad=ROI_PAD: {'sites': len(sites) + 1})
+    def get_roi_data(self, target_sequence, sites=(), pad=ROI_PAD):
+        # Region-of-interest version of get_all_data, for when only the target and a
+        # few off-target sites are wanted. Only padded windows of the test trace
+        # around those sites (see roi_windows) are normalized, aligned and
+        # differenced; the difference traces are zero everywhere else. Each window
+        # finds its own offset: roughly from where its base calls turn up in the test
+        # sequence, then by the smallest total difference within ROI_MARGIN of that.
+        # When the windows cover most of the reference the whole trace is done as
+        # usual. Short traces (under 1100 datapoints) can be analyzed this way too.
+        ref = self.ref_trace
+        test = self.test_trace
+        ref_length = ref['seq_length']
+        test_length = test['seq_length']
+        windows = self.roi_windows(target_sequence, sites, pad)
+        covered = sum(end - start for start, end in windows)
+        long_enough = min(ref_length, test_length) >= 1100
+        if long_enough and covered > ROI_MAX_COVERAGE * ref_length:
+            self.roi = None
+            return self.get_all_data()
+
+        # the reference is shared by every window (and usually every sample), so
+        # it is normalized in full
+        if ref_length >= 1100:
+            self.prepare_trace(ref)
+        elif not ref.get('normalized'):
+            ref.data = _channel_array(self._normalized_columns(ref, np.arange(ref_length)))
+            ref['normalized'] = True
+        # a test trace normalized before (or in the cache) is used as it is
+        if not test.get('normalized') and test_length >= 1100:
+            key = test.get('cache_key')
+            normalized = trace_cache.load(key, 'normalized') if key is not None else None
+            if normalized is not None and normalized.shape == test.data.shape:
+                test.data = _channel_array(normalized)
+                test['normalized'] = True
+
+        diff_array = np.zeros((len(TRACE_LIST), ref_length))
+        align_length = ref_length
+        # (ref start, ref end, test column the window starts at) of each window
+        self.roi = []
+        for start, end in windows:
+            offset = self._roi_offset(start, end)
+            columns = np.clip(np.arange(start + offset - ROI_MARGIN, end + offset + ROI_MARGIN),
+                              0, max(test_length - 1, 0))
+            if test.get('normalized'):
+                test_columns = test.data[:, columns]
+            else:
+                test_columns = self._normalized_columns(test, columns)
+            ref_window = Trace(ref.data[:, start:end], '', [])
+            test_window = Trace(test_columns, '', [])
+
+            # best start within the margin, by the total difference over the first
+            # 300 datapoints (ties go to the offset nearest the estimate)
+            width = min(300, end - start)
+            candidates = np.lib.stride_tricks.sliding_window_view(test_window.data[:, :2*ROI_MARGIN + width],
+                                                                  width, axis=1)
+            scores = np.abs(candidates - ref_window.data[:, np.newaxis, :width]).sum(axis=(0, 2))
+            order = np.argsort(np.abs(np.arange(len(scores)) - ROI_MARGIN), kind='stable')
+            local_offset = int(order[np.argmin(scores[order])])
+
+            self._align(ref_window, test_window, local_offset, test_window['seq_length'] + local_offset)
+            window_length, window_diffs = self.differences(ref_window, test_window)
+            for letter in TRACE_LIST:
+                diff_array[CHANNEL_INDEX[letter], start:start + window_length] = window_diffs[letter]
+            test_start = start + offset - ROI_MARGIN + local_offset
+            self.roi.append((start, end, test_start))
+            align_length = min(ref_length, test_length - (test_start - start))
+
+        diffs = {}
+        for letter in TRACE_LIST:
+            diffs[letter] = diff_array[CHANNEL_INDEX[letter], :align_length]
+        return align_length, diffs
+
+    def _roi_offset(self, start, end):
+        # Rough test-minus-reference datapoint offset at a window, from where the
+        # window's base calls turn up in the test base calls (0 if none are called)
+        ref = self.ref_trace
+        test = self.test_trace
+        called = np.flatnonzero((ref['base_pos'] >= start) & (ref['base_pos'] < end))
+        called = called[called < len(ref['sequence'])]
+        if not len(called) or not len(test['sequence']):
+            return 0
+        first = int(called[0])
+        align_start, align_end = locate_target(test['sequence'], ref['sequence'][first:int(called[-1]) + 1])
+        if not 0 <= align_start < len(test['base_pos']):
+            return 0
+        return int(test['base_pos'][align_start]) - int(ref['base_pos'][first])
 # End SeqDoc class
 
+# Normalized columns of a trace for SeqDoc's streaming, worked out a block of
+# block_size datapoints at a time as they are asked for and dropped again with
+# release. A trace that is already normalized, or whose normalized channels are in
+# the trace cache (memory-mapped), is just read.
+class _NormalizedColumns(object):
+    def __init__(self, seqdoc, trace, block_size):
+        self.seqdoc = seqdoc
+        self.trace = trace
+        self.block_size = block_size
+        self.blocks = {}
+        self.data = None
+        if trace.get('normalized'):
+            self.data = trace.data
+            return
+        key = trace.get('cache_key')
+        normalized = trace_cache.load(key, 'normalized') if key is not None else None
+        if normalized is not None and normalized.shape == trace.data.shape:
+            self.data = normalized
+        elif trace['seq_length'] < 1100:
+            # as normalize_data
+            raise Exception('sequence too short')
+
+    def _block(self, number):
+        if number not in self.blocks:
+            first = number * self.block_size
+            last = min(first + self.block_size, self.trace['seq_length'])
+            self.blocks[number] = self.seqdoc._normalized_columns(self.trace, np.arange(first, last))
+        return self.blocks[number]
+
+    def get(self, index):
+        # the normalized columns at the given indexes
+        index = np.asarray(index, dtype=np.int64)
+        if self.data is not None:
+            return np.asarray(self.data[:, index], dtype=np.int64)
+        if not len(index):
+            return np.zeros((len(TRACE_LIST), 0), dtype=np.int64)
+        number = int(index.min()) // self.block_size
+        if int(index.max()) // self.block_size == number:
+            # (nearly always: a window within one block)
+            return self._block(number)[:, index - number * self.block_size]
+        columns = np.empty((len(TRACE_LIST), len(index)), dtype=np.int64)
+        numbers = index // self.block_size
+        for number in np.unique(numbers):
+            inside = numbers == number
+            columns[:, inside] = self._block(int(number))[:, index[inside] - number * self.block_size]
+        return columns
+
+    def range(self, first, last):
+        # the normalized columns first to last-1 (any before the first column are
+        # the first one again)
+        if first < 0:
+            return self.get(np.maximum(np.arange(first, last), 0))
+        if self.data is not None:
+            return np.asarray(self.data[:, first:last], dtype=np.int64)
+        number = first // self.block_size
+        if last > first and (last - 1) // self.block_size == number:
+            start = number * self.block_size
+            return self._block(number)[:, first - start:last - start]
+        return self.get(np.arange(first, last))
+
+    def head(self):
+        # the columns the offset search can use (see SeqDoc._offset_window) as a Trace
+        seq_length = self.trace['seq_length']
+        index = np.arange(seq_length)
+        if seq_length > OFFSET_WINDOW:
+            index = np.append(index[:OFFSET_WINDOW], seq_length - 1)
+        head = Trace(self.get(index), self.trace.sequence, self.trace.base_pos)
+        head['normalized'] = True
+        return head
+
+    def release(self, before):
+        # drops the blocks that end before the given column
+        for number in list(self.blocks):
+            if (number + 1) * self.block_size <= before:
+                del self.blocks[number]
+# End _NormalizedColumns Class
+
+# Difference traces given a chunk at a time by SeqDoc.stream_differences, each
+# worked out as it is read. Iterating gives (start, {letter: differences}) for each
+# chunk in order, and a stream can only be read once. length is the number of
+# datapoints read so far (the full length once it has been read to the end).
+# Sequalizer.get_mutation_freqs and DiffStore.add take a DiffChunks in place of the
+# difference traces, and read it through keeping just what they need.
+class DiffChunks(object):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.length = 0
+
+    def __iter__(self):
+        for start, diffs in self.chunks:
+            self.length = start + len(diffs['A'])
+            yield start, diffs
+
+    def gather(self, columns):
+        # Reads the rest of the stream, keeping just the given datapoints. Gives
+        # their values as a channels x columns array (0 for any past the end)
+        columns = np.asarray(columns, dtype=np.int64)
+        values = np.zeros((len(TRACE_LIST), len(columns)))
+        for start, diffs in self:
+            inside = (columns >= start) & (columns < self.length)
+            if inside.any():
+                chunk = np.array([diffs[letter] for letter in TRACE_LIST])
+                values[:, inside] = chunk[:, columns[inside] - start]
+        return values
+
+    def collect(self):
+        # Reads the rest of the stream into full difference traces, as
+        # get_all_data gives them: (length, {letter: differences})
+        chunks = [np.array([diffs[letter] for letter in TRACE_LIST]) for start, diffs in self]
+        diff_array = np.concatenate(chunks, axis=1) if chunks else np.zeros((len(TRACE_LIST), 0))
+        return diff_array.shape[1], {letter: diff_array[CHANNEL_INDEX[letter]] for letter in TRACE_LIST}
+# End DiffChunks Class
+
+# (first, end) base indexes of the best stretch of a trace, by Mott's algorithm:
+# each base scores how much better than the limit it is, and the stretch with the
+# highest total is kept. mode 'quality' uses the per-base quality values (error
+# probability under TRIM_ERROR_LIMIT is good), 'signal' the height of each base's
+# tallest peak (under TRIM_SIGNAL_FRACTION of the median is weak), and 'auto' the
+# quality values if the trace has them. Gives (0, 0) if no base is good.
+def trim_interval(trace, mode='auto'):
+    if mode not in TRIM_MODES:
+        raise ValueError('unknown trim mode: ' + str(mode))
+    base_pos = np.asarray(trace['base_pos'], dtype=np.int64)
+    count = min(len(trace['sequence']), len(base_pos))
+    quality = trace.get('quality')
+    if mode == 'quality' and quality is None:
+        raise ValueError('trace has no quality values')
+    if mode != 'signal' and quality is not None:
+        count = min(count, len(quality))
+        scores = TRIM_ERROR_LIMIT - 10.0 ** (-np.asarray(quality[:count], dtype=np.float64) / 10)
+    else:
+        peaks = trace.data[:, np.clip(base_pos[:count], 0, max(trace['seq_length'] - 1, 0))].max(axis=0) \
+            if trace['seq_length'] else np.zeros(count)
+        strong = peaks >= TRIM_SIGNAL_FRACTION * (np.median(peaks) if count else 0)
+        scores = np.where(strong, 1.0, -1.0)
+    totals = np.concatenate(([0.0], np.cumsum(scores)))
+    lowest = np.minimum.accumulate(totals)
+    end = int(np.argmax(totals - lowest))
+    if totals[end] - lowest[end] <= 0:
+        return 0, 0
+    first = int(np.argmin(totals[:end + 1]))
+    return first, end
+
+# The datapoints [start, end) of a trace as a Trace of their own, with the base
+# calls inside them (positions counted from start)
+def trace_window(trace, start, end):
+    base_pos = np.asarray(trace['base_pos'], dtype=np.int64)
+    inside = np.flatnonzero((base_pos >= start) & (base_pos < end))
+    inside = inside[inside < len(trace['sequence'])]
+    first, last = (int(inside[0]), int(inside[-1]) + 1) if len(inside) else (0, 0)
+    window = Trace(trace.data[:, start:end], trace.sequence[first:last], base_pos[first:last] - start)
+    if trace.get('normalized'):
+        window['normalized'] = True
+    if trace.get('quality') is not None:
+        window['quality'] = trace['quality'][first:last]
+    return window
+
+# First and last index of the reference sequence that a site covers: the target when
+# site is None, otherwise an off-target position as given to Sequalizer (negative for
+# the antisense strand)
+def site_span(ref_sequence, target_sequence, site):
+    if site is None:
+        align_start, align_end = locate_target(ref_sequence, target_sequence)
+        return align_start, align_end
+    if site > 0:
+        return site - 20, site
+    align_start = (len(ref_sequence) + site) + 3
+    return align_start, align_start + 20
+
+# Forward-strand start of an off-target site, as PamIndex gives it: the first index
+# of the reference sequence that the protospacer and its PAM cover. site is the
+# position as given to Sequalizer, the index of the PAM on the sense strand or,
+# negative, on the antisense strand (read forward, the CCN comes first there)
+def site_position(ref_sequence, site):
+    if site > 0:
+        return site - 20
+    return len(ref_sequence) + site - 3
+
+# Finds where a target sequence sits in a reference sequence, giving the same start and
+# end as the first best pairwise2 local alignment (match 2, mismatch -1, gap -1/-0.1)
+# without a full alignment against the whole reference every time. In order it tries:
+#  - an exact match (if there are several, pairwise2 picks the last one)
+#  - a score-only pass over the whole reference, done a target base at a time on
+#    arrays, which finds where the best alignment ends. Only a band of reference
+#    ending there is then aligned to get the start and end
+#  - a first-best-only pairwise2 alignment against the whole reference, when the
+#    best score is tied between places
+# pairwise2 gives the start and end in alignment columns, which run ahead of the
+# reference index when more of the target than of the reference comes before the
+# aligned part; the faster paths reproduce that.
+class TargetLocator(object):
+    def __init__(self, ref_sequence):
+        self.ref_sequence = ref_sequence
+        self.ref_codes = np.frombuffer(ref_sequence.encode(), dtype=np.uint8)
+        self.locations = {}
+
+    def locate(self, target_sequence):
+        if target_sequence not in self.locations:
+            location = self._exact_match(target_sequence)
+            if location is None:
+                location = self._banded_match(target_sequence)
+            if location is None:
+                location = self._local_align(self.ref_sequence, target_sequence, 0)[:2]
+            self.locations[target_sequence] = location
+        return self.locations[target_sequence]
+
+    def _exact_match(self, target_sequence):
+        start = self.ref_sequence.rfind(target_sequence)
+        if not target_sequence or start < 0:
+            return None
+        return start, start + len(target_sequence)
+
+    def _best_score(self, target_sequence):
+        # Smith-Waterman scores (affine gaps) for the target against the whole
+        # reference, one row per target base. Returns the best score and the
+        # (target, reference) ends of every alignment reaching it
+        (match, mismatch, gap_open, gap_extend) = LOCAL_ALIGN_SCORES
+        ref_length = len(self.ref_codes)
+        columns = np.arange(ref_length + 1)
+        prev_h = np.zeros(ref_length + 1)
+        prev_f = np.full(ref_length + 1, -np.inf)
+        best_score = 0
+        row_best = []
+        for code in target_sequence.encode():
+            h = np.zeros(ref_length + 1)
+            h[1:] = prev_h[:-1] + np.where(self.ref_codes == code, match, mismatch)
+            # gap in the reference (target base skipped)
+            f = np.maximum(prev_h + gap_open, prev_f + gap_extend)
+            h = np.maximum(np.maximum(h, 0), f)
+            # gap in the target (reference bases skipped): the best gap into column j
+            # opens after some k < j, found with a running maximum
+            opened = np.maximum.accumulate(h - gap_extend * columns)
+            e = np.full(ref_length + 1, -np.inf)
+            e[1:] = gap_open + gap_extend * (columns[1:] - 1) + opened[:-1]
+            h = np.maximum(h, e)
+            row_best.append(h)
+            best_score = max(best_score, h.max())
+            prev_h, prev_f = h, f
+        ends = [(row, int(column)) for row, h in enumerate(row_best)
+                for column in np.flatnonzero(h >= best_score - 1e-6)]
+        return best_score, ends
+
+    def _banded_match(self, target_sequence):
+        best_score, ends = self._best_score(target_sequence)
+        if best_score <= 0 or len(ends) != 1:
+            return None
+        target_end, ref_end = ends[0]
+        # an alignment scoring best_score skips few enough reference bases to start
+        # within this band
+        (match, mismatch, gap_open, gap_extend) = LOCAL_ALIGN_SCORES
+        target_length = len(target_sequence)
+        max_gap = int((match*target_length + gap_open - best_score) / -gap_extend) + 2
+        start = max(ref_end - target_end - 1 - max_gap, 0)
+        location = self._local_align(self.ref_sequence[start:ref_end], target_sequence, start)
+        if abs(location[2] - best_score) > 1e-6:
+            return None
+        return location[:2]
+
+    def _local_align(self, ref_sequence, target_sequence, offset):
+        # first best local alignment of a stretch of the reference starting at offset,
+        # in the columns the same alignment against the whole reference would give
+        # (plus the alignment score)
+        from Bio import pairwise2
+        alignments = pairwise2.align.localms(ref_sequence, target_sequence, *LOCAL_ALIGN_SCORES,
+                                             one_alignment_only=True)
+        aligned_ref, aligned_target, score, begin, end = alignments[0]
+        ref_start = begin - (len(aligned_ref) - len(aligned_ref.lstrip('-')))
+        target_start = begin - (len(aligned_target) - len(aligned_target.lstrip('-')))
+        begin_column = max(offset + ref_start, target_start)
+        return begin_column, begin_column + (end - begin), score
+# End TargetLocator Class
+
+# TargetLocators of recently used reference sequences
+_locators = {}
+
+@_profiled('locate_target', lambda ref_sequence, target_sequence: {
+    'ref_length': len(ref_sequence), 'target_length': len(target_sequence)})
+def locate_target(ref_sequence, target_sequence):
+    # (start, end) of the target's best local alignment to the reference, memoized
+    # per reference and target
+    locator = _locators.pop(ref_sequence, None)
+    if locator is None:
+        locator = TargetLocator(ref_sequence)
+    _locators[ref_sequence] = locator
+    while len(_locators) > MAX_LOCATORS:
+        del _locators[next(iter(_locators))]
+    return locator.locate(target_sequence)
+
 # This class uses Timothy K. Lu lab's sequalizer formula to caclulate point mutation frequency
 # converted to python and modified for integration with SeqDoc and for off-target analysis
 class Sequalizer(object):
-    def __init__(self, ref_data, test_data, diff_data, target_sequence, target_range):
+    def __init__(self, ref_data, test_data, diff_data, target_sequence, target_range, executor=None):
         self.ref_data = ref_data
         self.test_data = test_data
         self.diff_data = diff_data
         self.target_sequence = target_sequence
         self.target_range = target_range
+        # a SampleExecutor that get_mutation_freqs can split many sites over, if any
+        self.executor = executor
         self.align_start = None
         self.align_end = None
         self.mutation_freq = []
@@ -307,11 +1683,10 @@ class Sequalizer(object):
                 self.align_start = (len(self.ref_data['sequence']) + match_override) + 3
                 self.align_end = self.align_start + 20
         else:
-            # uses pairwise2 module to find best target<->sequence alignment, records start and stop index
-            alignments = pairwise2.align.localms(self.ref_data['sequence'], self.target_sequence, 2, -1, -1, -0.1)
-            self.align_start = alignments[0][3]
-            self.align_end = alignments[0][4]
+            # finds the best target<->sequence local alignment, records start and stop index
+            self.align_start, self.align_end = locate_target(self.ref_data['sequence'], self.target_sequence)
 
+    @_profiled('mutation_freq', lambda self, match_override=None: {'sites': 1, 'positions': len(self.target_range)})
     def get_mutation_freq(self, match_override=None):
         # finds where the target sequence occurs in the reference trace
         self.mutation_freq = []
@@ -334,34 +1709,139 @@ class Sequalizer(object):
             # calculates the muation frequency for each target base
             if target_base == 'G':
                 trace_range = [self.ref_data['base_pos'][current_position]-2, self.ref_data['base_pos'][current_position]+2]
-                g_diff = max(self.diff_data['G'][trace_range[0]:trace_range[1]])
-                a_diff = min(self.diff_data['A'][trace_range[0]:trace_range[1]])
-                g_ref = max(self.ref_data['G'][trace_range[0]:trace_range[1]])
+                g_diff = float(np.max(self.diff_data['G'][trace_range[0]:trace_range[1]]))
+                a_diff = float(np.min(self.diff_data['A'][trace_range[0]:trace_range[1]]))
+                g_ref = int(np.max(self.ref_data['G'][trace_range[0]:trace_range[1]]))
                 self.mutation_freq.append(round(math.sqrt(abs((g_diff-a_diff)/(8*g_ref))),3))
             elif target_base == 'C':
                 trace_range = [self.ref_data['base_pos'][current_position]-2, self.ref_data['base_pos'][current_position]+2]
-                c_diff = max(self.diff_data['C'][trace_range[0]:trace_range[1]])
-                t_diff = min(self.diff_data['T'][trace_range[0]:trace_range[1]])
-                c_ref = max(self.ref_data['C'][trace_range[0]:trace_range[1]])
+                c_diff = float(np.max(self.diff_data['C'][trace_range[0]:trace_range[1]]))
+                t_diff = float(np.min(self.diff_data['T'][trace_range[0]:trace_range[1]]))
+                c_ref = int(np.max(self.ref_data['C'][trace_range[0]:trace_range[1]]))
                 self.mutation_freq.append(round(math.sqrt(abs((c_diff-t_diff)/(8*c_ref))),3))
             else:
                 self.mutation_freq.append(0)
         return self.mutation_freq
+
+    def _site_bounds(self, match_override, diff_length=None):
+        # start and end of a site in the reference sequence, as in _align_seqs but
+        # without keeping state: an off-target position that _align_seqs would not
+        # move to gives (None, None) instead of reusing the previous site
+        if diff_length is None:
+            diff_length = len(self.diff_data['A'])
+        if (match_override is None or 0 < match_override < diff_length or
+                match_override < -(len(self.ref_data['A']) - diff_length)):
+            return site_span(self.ref_data['sequence'], self.target_sequence, match_override)
+        return None, None
+
+    @_profiled('mutation_freq', lambda self, sites: {'sites': len(sites), 'positions': len(self.target_range)})
+    def get_mutation_freqs(self, sites):
+        # mutation frequencies for many sites at once. sites is a list of None (the
+        # target) and off-target positions as given to get_mutation_freq; returns a
+        # sites x target_range array. A frequency get_mutation_freq could not compute
+        # (site off the ends of the trace, empty window, no reference peak) is nan.
+        # The difference traces can be a DiffChunks, which is read through once
+        # keeping only the datapoints any of the sites could use (those they would
+        # if the differences were as long as the reference). With an executor, many
+        # sites are split into groups that are done side by side.
+        executor = getattr(self, 'executor', None)
+        groups = min(len(sites) // PARALLEL_MIN_SITES, executor.workers) if executor is not None else 0
+        if (not isinstance(self.diff_data, DiffChunks) and executor is not None and
+                executor.parallel(len(self.ref_data['A']), groups)):
+            bounds = np.linspace(0, len(sites), groups + 1).astype(int)
+            jobs = [(self.ref_data, self.test_data, self.diff_data, self.target_sequence, self.target_range,
+                     list(sites[start:end])) for start, end in zip(bounds[:-1], bounds[1:])]
+            return np.concatenate(executor.map(_site_freqs_job, jobs, len(self.ref_data['A'])))
+        if isinstance(self.diff_data, DiffChunks):
+            columns = np.unique(np.append(self._site_windows(sites, len(self.ref_data['A']))[-1], 0))
+            diff = self.diff_data.gather(columns)
+            diff_length = self.diff_data.length
+        else:
+            columns = None
+            diff = np.array([self.diff_data[letter] for letter in TRACE_LIST], dtype=np.float64)
+            diff_length = diff.shape[1]
+        shape = (len(sites), len(self.target_range))
+        is_g, is_c, valid, measured, window = self._site_windows(sites, diff_length)
+
+        high = np.where(is_g, CHANNEL_INDEX['G'], CHANNEL_INDEX['C'])[..., None]
+        low = np.where(is_g, CHANNEL_INDEX['A'], CHANNEL_INDEX['T'])[..., None]
+        ref_length = len(self.ref_data['A'])
+        in_diff = window < diff_length
+        in_ref = window < ref_length
+        diff_window = np.minimum(window, diff_length - 1)
+        if columns is not None:
+            diff_window = np.minimum(np.searchsorted(columns, diff_window), len(columns) - 1)
+        # (the reference is read where it is, not copied)
+        ref_window = np.minimum(window, ref_length - 1)
+        ref_peaks = np.where(is_g[..., None], np.asarray(self.ref_data['G'], dtype=np.int64)[ref_window],
+                             np.asarray(self.ref_data['C'], dtype=np.int64)[ref_window])
+        high_diff = np.where(in_diff, diff[high, diff_window], -np.inf).max(axis=-1)
+        low_diff = np.where(in_diff, diff[low, diff_window], np.inf).min(axis=-1)
+        high_ref = np.where(in_ref, ref_peaks, np.iinfo(np.int64).min).max(axis=-1)
+        measured &= in_diff[..., 0] & in_ref[..., 0] & (high_ref != 0)
+
+        # G->A and C->T use the same formula on their own channels
+        freqs = np.full(shape, np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.sqrt(np.abs((high_diff - low_diff) / (8 * high_ref.astype(np.float64))))
+        freqs[measured] = [round(float(value), 3) for value in values[measured]]
+        freqs[valid & ~is_g & ~is_c] = 0
+        return freqs
+
+    def _site_windows(self, sites, diff_length):
+        # the base of every (site, target base) pair (is_g, is_c), whether it is in
+        # the sequence (valid) and could be measured, and its window of datapoints
+        # [base_pos-2, base_pos+2)
+        base_index = np.asarray(self.target_range, dtype=np.int64)
+        sequence = self.ref_data['sequence']
+        seq_codes = np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)
+        target_codes = np.frombuffer(self.target_sequence.encode('ascii'), dtype=np.uint8)
+        base_pos = np.asarray(self.ref_data['base_pos'], dtype=np.int64)
+        shape = (len(sites), len(base_index))
+
+        # sequence position and base of every (site, target base) pair
+        positions = np.zeros(shape, dtype=np.int64)
+        bases = np.zeros(shape, dtype=np.uint8)
+        valid = np.zeros(shape, dtype=bool)
+        for row, site in enumerate(sites):
+            align_start, align_end = self._site_bounds(site, diff_length)
+            if align_start is None:
+                continue
+            if site is None or site > 0:
+                positions[row] = align_start + base_index
+            else:
+                positions[row] = align_end - base_index
+            # negative positions index from the end, like the sequence string does
+            in_seq = (positions[row] >= -len(seq_codes)) & (positions[row] < len(seq_codes))
+            if site is None:
+                bases[row] = target_codes[base_index]
+                valid[row] = True
+            else:
+                bases[row, in_seq] = seq_codes[positions[row, in_seq] % len(seq_codes)]
+                valid[row] = in_seq
+        is_g = bases == ord('G')
+        is_c = bases == ord('C')
+        measured = valid & (is_g | is_c)
+        measured &= (positions >= -len(base_pos)) & (positions < len(base_pos))
+
+        # every window of datapoints [base_pos-2, base_pos+2) in one gather
+        peaks = base_pos[np.where(measured, positions, 0) % max(len(base_pos), 1)]
+        measured &= peaks >= 2
+        window = peaks[..., None] + np.arange(-2, 2)
+        return is_g, is_c, valid, measured, window
 # End Sequalizer Class
 
 # This class finds and ranks all possible target sites in a sanger sequence
 # ranking system is based off of the model from the Howard M. Salis Lab
 # and the follow up work done by UBC 2017 iGEM team
 class OfftargetFinder(object):
-    def __init__(self, ref_data, target_sequence):
-        self.pos_weights = (0.554111551727719,0.999999999999958,0.999859588152223,0.999997460325925,0.414113900546951,
-                            0.999495056671895,0.0220208959410121,0.589953049071977,0.324385855364402,2.26201959820539e-06,
-                            0.0825699665148698,0.0890566149734565,0.234751499655325,3.77820298630600e-14,0.214631126793305,
-                            7.04574142003494e-06,0.156869096216009,0.129156230982504,0.0428145130615625,1.58135744395507e-05,
-                            0.100000000000000)
+    def __init__(self, ref_data, target_sequence, rev_ref_sequence=None):
+        self.pos_weights = POS_WEIGHTS
         self.ref_data = ref_data
-        sequence = Seq.Seq(''.join(ref_data['sequence']))
-        self.rev_ref_sequence = str(sequence.reverse_complement())
+        # the reverse complement can be given if it is already known (see SharedReference)
+        if rev_ref_sequence is None:
+            rev_ref_sequence = reverse_complement(ref_data['sequence'])
+        self.rev_ref_sequence = rev_ref_sequence
         self.target_sequence = target_sequence        
 
     def _match_ngg(self):
@@ -377,45 +1857,801 @@ class OfftargetFinder(object):
             match_indexes.append(-match.span(0)[0])
         return match_indexes
 
+    @_profiled('offtarget_scoring', lambda self, guides=None, match_indexes=None: {
+        'guides': 1 if guides is None else len(guides), 'ref_length': len(self.ref_data['sequence'])})
+    def score_sites(self, guides=None, match_indexes=None):
+        # Scores every PAM site against every guide (by default just the target
+        # sequence) in one pass, by approx. gibson energies. Returns a structured array
+        # with one (guide, strand, position, score) row per guide and site: guide is
+        # the guide's index, strand is 1 or -1 and position is the signed start index
+        # used by Sequalizer's match_override. Sites too close to the end of the
+        # sequence to be compared with the whole guide are left out.
+        if guides is None:
+            guides = [self.target_sequence]
+        if match_indexes is None:
+            match_indexes = self._match_ngg()
+        guide_words, guide_ambiguous, guide_length = pack_guides(guides)
+        if guide_length >= len(self.pos_weights):
+            raise ValueError('guides can be at most %d bases long' % (len(self.pos_weights) - 1))
+
+        # a start index of 0 (on either strand) is never scored
+        starts = np.array([start for start in match_indexes if start != 0], dtype=np.int64)
+        # Each guide base i is compared with the base at start - (guide_length - i) on
+        # that site's strand, a negative index counting back from the end of the
+        # strand, so each site is the circular window of its strand starting at
+        # (start - guide_length) mod length
+        length = len(self.ref_data['sequence'])
+        valid = (starts - guide_length >= -length) & (starts - min(guide_length, 1) < length)
+        starts = starts[valid]
+        on_sense = starts > 0
+        window = (starts - guide_length) % max(length, 1)
+        sense = PackedSequence(self.ref_data['sequence'])
+        site_words = np.zeros(len(starts), dtype=np.uint64)
+        site_ambiguous = np.zeros(len(starts), dtype=np.uint32)
+        for strand, packed in ((on_sense, sense), (~on_sense, sense.reverse_complement())):
+            if strand.any():
+                site_words[strand], site_ambiguous[strand] = packed.windows(window[strand], guide_length)
+
+        masks = mismatch_masks(guide_words, guide_ambiguous, site_words, site_ambiguous, guide_length)
+        scores = mismatch_scores(masks, self.pos_weights)
+
+        sites = np.zeros(scores.size, dtype=OFFTARGET_DTYPE)
+        sites['guide'] = np.repeat(np.arange(len(guides)), len(starts))
+        sites['strand'] = np.tile(np.where(on_sense, 1, -1), len(guides))
+        sites['position'] = np.tile(starts, len(guides))
+        sites['score'] = scores.ravel()
+        return sites
+
+    def get_sites(self, guides=None, cutoff=.6):
+        # like score_sites, keeping only likely off-target sites: a score above the
+        # cutoff is too poor a match, and a score of 0 is the target itself
+        sites = self.score_sites(guides)
+        return sites[(sites['score'] <= cutoff) & (sites['score'] != 0)]
+
     def _calc_binding(self, match_indexes):
-        # scores possibles sites by approx. gibson energies
+        # scores possibles sites by approx. gibson energies (keyed by score, so a
+        # site with the same score as an earlier one replaces it)
         match_dict = {}
-        norm_factor = sum(self.pos_weights)
-        for match_index in match_indexes:
-            score = 0
-            start = match_index
-            if start > 0:
-                for i in range(0, len(self.target_sequence)):
-                    position = len(self.target_sequence) - i
-                    if self.target_sequence[i] == self.ref_data['sequence'][start - position]:
-                        score += 0
-                    else:
-                        score += self.pos_weights[position]
-                score = score/norm_factor
-                match_dict[score] = start
-            elif start < 0:
-                for i in range(0, len(self.target_sequence)):
-                    position = len(self.target_sequence) - i
-                    if self.target_sequence[i] == self.rev_ref_sequence[start - position]:
-                        score += 0
-                    else:
-                        score += self.pos_weights[position]
-                score = score/norm_factor
-                match_dict[score] = start
-        print(match_dict);
+        for site in self.score_sites(match_indexes=match_indexes):
+            match_dict[float(site['score'])] = int(site['position'])
         return match_dict
 
     def get_targets(self):
         match_indexes = self._match_ngg()
         match_dict = self._calc_binding(match_indexes)
         for k,v in match_dict.copy().items():
-            # print("score is: ")
-            # print(k)
-            # print("starting at:")
-            # print(v)
             if (k > .6) or (k == 0):
-                # print("deleted")
                 del match_dict[k]
-            # print("\n")
         return match_dict
 # End OfftargetFinder Class
+
+# 2-bit code and ambiguity of each byte value, and the reverse complement of a
+# packed byte (four bases)
+_BASE_CODES = np.zeros(256, dtype=np.uint8)
+_BASE_CODES[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4)
+_AMBIGUOUS_BASE = np.ones(256, dtype=bool)
+_AMBIGUOUS_BASE[np.frombuffer(b'ACGT', dtype=np.uint8)] = False
+_FLIPPED = 255 - np.arange(256)
+_REVCOMP_BYTE = (((_FLIPPED & 3) << 6) | ((_FLIPPED >> 2 & 3) << 4) |
+                 ((_FLIPPED >> 4 & 3) << 2) | (_FLIPPED >> 6 & 3)).astype(np.uint8)
+# For one byte of two XORed words, a bit for each of its four bases that differ
+_BYTE_MISMATCHES = sum(((np.arange(256) >> (2 * pair) & 3) != 0).astype(np.uint32) << pair
+                       for pair in range(4)).astype(np.uint32)
+# Number of bits set in each byte value (for numpy without bitwise_count)
+_BYTE_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1).astype(np.uint8)
+
+# 2-bit base calls: A, C, G and T are 0 to 3, packed four to a byte with the first
+# base in the top bits, so the complement of a base (or a whole byte) is its bits
+# flipped. Anything else (N, other IUPAC codes, lower case) is marked in a separate
+# ambiguity mask and never matches a guide. A window of up to 32 bases packs into one
+# 64-bit word the same way (first base in the top bits), with its ambiguity mask as
+# one bit per base (first base highest).
+class PackedSequence(object):
+    def __init__(self, sequence):
+        if isinstance(sequence, str):
+            sequence = sequence.encode('ascii', 'replace')
+        bases = np.frombuffer(sequence, dtype=np.uint8)
+        self.length = len(bases)
+        codes = _BASE_CODES[bases]
+        padded = np.zeros(-(-self.length // 4) * 4, dtype=np.uint8)
+        padded[:self.length] = codes
+        padded = padded.reshape(-1, 4)
+        self.packed = (padded[:, 0] << 6) | (padded[:, 1] << 4) | (padded[:, 2] << 2) | padded[:, 3]
+        self.ambiguous = np.packbits(_AMBIGUOUS_BASE[bases])
+
+    @classmethod
+    def _from_packed(cls, packed, ambiguous, length):
+        sequence = cls.__new__(cls)
+        sequence.packed = packed
+        sequence.ambiguous = ambiguous
+        sequence.length = length
+        return sequence
+
+    def __len__(self):
+        return self.length
+
+    def codes(self):
+        # one 2-bit code per base (0 at ambiguous bases)
+        shifts = np.array([6, 4, 2, 0], dtype=np.uint8)
+        return ((self.packed[:, np.newaxis] >> shifts) & 3).ravel()[:self.length]
+
+    def ambiguous_mask(self):
+        return np.unpackbits(self.ambiguous, count=self.length).astype(bool)
+
+    def __str__(self):
+        letters = np.frombuffer(b'ACGT', dtype=np.uint8)[self.codes()]
+        letters[self.ambiguous_mask()] = ord('N')
+        return letters.tobytes().decode('ascii')
+
+    def reverse_complement(self):
+        # Each byte is reverse complemented by table lookup and the byte order
+        # reversed; the padding at the end then sits at the start, so the bases
+        # are shifted back up by it
+        packed = _REVCOMP_BYTE[self.packed[::-1]]
+        pad = 2 * (4 * len(packed) - self.length)
+        if pad:
+            packed = ((packed << pad) | np.append(packed[1:], 0) >> (8 - pad)).astype(np.uint8)
+        ambiguous = np.packbits(self.ambiguous_mask()[::-1])
+        return PackedSequence._from_packed(packed, ambiguous, self.length)
+
+    def windows(self, starts, k):
+        # (words, ambiguity masks) of the k-base windows at the given starts, which
+        # carry on from the start of the sequence where they run off the end. For
+        # a few windows this is cheaper than kmers, which packs all of them
+        if not self.length:
+            return np.zeros(len(starts), dtype=np.uint64), np.zeros(len(starts), dtype=np.uint32)
+        index = (np.asarray(starts)[:, np.newaxis] + np.arange(k)) % self.length
+        return _pack_rows(self.codes()[index], self.ambiguous_mask()[index])
+
+    def kmers(self, k, circular=False):
+        # (words, ambiguity masks) of every k-base window, by start. With circular
+        # set there is one window per base, and windows running off the end carry
+        # on from the start (as Python's negative indexes do)
+        if k > 32:
+            raise ValueError('windows can be at most 32 bases long')
+        codes = self.codes()
+        ambiguous = self.ambiguous_mask()
+        if circular:
+            count = self.length
+            if count:
+                codes = np.resize(codes, count + k - 1)
+                ambiguous = np.resize(ambiguous, count + k - 1)
+        else:
+            count = max(self.length - k + 1, 0)
+        words = np.zeros(count, dtype=np.uint64)
+        masks = np.zeros(count, dtype=np.uint32)
+        for i in range(k):
+            words = (words << np.uint64(2)) | codes[i:i + count]
+            masks = (masks << np.uint32(1)) | ambiguous[i:i + count]
+        return words, masks
+# End PackedSequence Class
+
+def pack_guides(guides):
+    # (words, ambiguity masks, length) of guides of the same length
+    guide_length = len(guides[0]) if len(guides) else 0
+    for guide in guides:
+        if len(guide) != guide_length:
+            raise ValueError('guides must all be the same length')
+    if guide_length > 32:
+        raise ValueError('guides can be at most 32 bases long')
+    bases = np.frombuffer(''.join(guides).encode('ascii', 'replace'), dtype=np.uint8)
+    bases = bases.reshape(len(guides), guide_length)
+    words, masks = _pack_rows(_BASE_CODES[bases], _AMBIGUOUS_BASE[bases])
+    return words, masks, guide_length
+
+def _pack_rows(codes, ambiguous):
+    # one (word, ambiguity mask) per row of 2-bit codes and ambiguity flags
+    shifts = np.arange(codes.shape[1] - 1, -1, -1, dtype=np.uint64)
+    words = np.bitwise_or.reduce(codes.astype(np.uint64) << (2 * shifts), axis=1)
+    masks = np.bitwise_or.reduce(ambiguous.astype(np.uint32) << shifts.astype(np.uint32), axis=1)
+    return words.astype(np.uint64), masks.astype(np.uint32)
+
+def mismatch_masks(guide_words, guide_ambiguous, site_words, site_ambiguous, length):
+    # Guides x sites masks of the mismatched positions (bit length-1-i for guide
+    # base i, as in the ambiguity masks): the words are XORed, and each byte of the
+    # result gives four positions by table lookup. An ambiguous base in either
+    # never matches
+    differ = guide_words[:, np.newaxis] ^ site_words[np.newaxis, :]
+    masks = np.zeros(differ.shape, dtype=np.uint32)
+    for chunk in range((length + 3) // 4):
+        masks |= _BYTE_MISMATCHES[(differ >> np.uint64(8 * chunk)) & np.uint64(0xFF)] << np.uint32(4 * chunk)
+    return masks | guide_ambiguous[:, np.newaxis] | site_ambiguous[np.newaxis, :]
+
+def mismatch_counts(masks):
+    # number of mismatched positions in each mask
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(masks)
+    counts = np.zeros(masks.shape, dtype=np.uint8)
+    for chunk in range(4):
+        counts += _BYTE_POPCOUNT[(masks >> np.uint32(8 * chunk)) & np.uint32(0xFF)]
+    return counts
+
+# Weight tables for mismatch_scores, by pos_weights
+_weight_tables = {}
+
+def mismatch_scores(masks, pos_weights=POS_WEIGHTS):
+    # Scores mismatch masks by the OfftargetFinder model: the weights of the
+    # mismatched positions (bit b of a mask, counting from the PAM end, has weight
+    # pos_weights[b + 1]) over the sum of all weights. Each byte of a mask is
+    # looked up in a table of the weight sums of its eight positions
+    key = tuple(pos_weights)
+    if key not in _weight_tables:
+        bits = np.arange(256)
+        tables = []
+        for chunk in range(4):
+            table = np.zeros(256)
+            for bit in range(8):
+                if 8 * chunk + bit + 1 < len(pos_weights):
+                    table += np.where(bits >> bit & 1, pos_weights[8 * chunk + bit + 1], 0.0)
+            tables.append(table)
+        _weight_tables[key] = (tables, sum(pos_weights))
+    tables, total = _weight_tables[key]
+    scores = tables[0][masks & np.uint32(0xFF)]
+    for chunk in range(1, 4):
+        if (masks >> np.uint32(8 * chunk)).any():
+            scores += tables[chunk][(masks >> np.uint32(8 * chunk)) & np.uint32(0xFF)]
+    return scores / total
+
+# the reverse complement of a base call string (IUPAC codes included, as Bio.Seq does it)
+def reverse_complement(sequence):
+    return ''.join(sequence).translate(_IUPAC_COMPLEMENT)[::-1]
+
+_IUPAC_COMPLEMENT = str.maketrans('ACGTURYSWKMBDHVNacgturyswkmbdhvn', 'TGCAAYRSWMKVHDBNtgcaayrswmkvhdbn')
+
+# A prepared reference published in one block of shared memory, so that any number
+# of worker processes can compare test traces against it without each parsing,
+# normalizing and keeping its own copy. The block holds the normalized channels,
+# base calls and positions (and quality values, if any), the reverse complement of
+# the base calls and an off-target site table (e.g. from OfftargetFinder.get_sites). Pickling a
+# SharedReference (e.g. as a Pool initializer argument) only sends the block's name
+# and layout; unpickling attaches to the block. Traces and finders made from it are
+# read-only views of the shared arrays. The process that published the reference
+# frees the block with close() once the workers are done with it. Start the
+# resource tracker (multiprocessing.resource_tracker.ensure_running()) before the
+# worker pool, so the workers attach through the publisher's tracker rather than
+# each starting one of their own that would free the block when the worker exits.
+class SharedReference(object):
+    def __init__(self, ref_trace, sites=None):
+        if not ref_trace.get('normalized'):
+            SeqDoc.__new__(SeqDoc).prepare_trace(ref_trace)
+        if sites is None:
+            sites = np.zeros(0, dtype=OFFTARGET_DTYPE)
+        arrays = {'data': np.ascontiguousarray(ref_trace.data),
+                  'base_pos': np.ascontiguousarray(ref_trace.base_pos, dtype=np.int64),
+                  'sequence': np.frombuffer(ref_trace.sequence.encode(), dtype=np.uint8),
+                  'rev_sequence': np.frombuffer(reverse_complement(ref_trace.sequence).encode(),
+                                                dtype=np.uint8),
+                  'sites': np.ascontiguousarray(sites),
+                  'quality': np.ascontiguousarray(ref_trace.get('quality', np.zeros(0)), dtype=np.uint8)}
+        # (offset, dtype, shape) of each array, each starting on a 64-byte boundary
+        self.layout = {}
+        size = 0
+        for name, array in arrays.items():
+            self.layout[name] = (size, array.dtype, array.shape)
+            size += -(-array.nbytes // 64) * 64
+        self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.owner = True
+        for name, array in arrays.items():
+            offset, dtype, shape = self.layout[name]
+            np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=offset)[...] = array
+        self._attach()
+
+    def _attach(self):
+        self.arrays = {}
+        for name, (offset, dtype, shape) in self.layout.items():
+            array = np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=offset)
+            array.flags.writeable = False
+            self.arrays[name] = array
+        self.sequence = self.arrays['sequence'].tobytes().decode()
+        self.rev_sequence = self.arrays['rev_sequence'].tobytes().decode()
+
+    def __getstate__(self):
+        return {'name': self.memory.name, 'layout': self.layout}
+
+    def __setstate__(self, state):
+        self.layout = state['layout']
+        self.memory = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+        self._attach()
+
+    @property
+    def sites(self):
+        return self.arrays['sites']
+
+    def trace(self):
+        # A normalized reference Trace viewing the shared channels. Each call gives a
+        # new Trace (its own extra values) over the same arrays, so one can be
+        # handed to each SeqDoc
+        trace = Trace.view(self.arrays['data'], self.sequence, self.arrays['base_pos'])
+        trace['normalized'] = True
+        if len(self.arrays['quality']):
+            trace['quality'] = self.arrays['quality']
+        return trace
+
+    def offtarget_finder(self, target_sequence):
+        return OfftargetFinder(self.trace(), target_sequence, self.rev_sequence)
+
+    def close(self):
+        # Detaches from the block (and, in the publishing process, frees it). Traces
+        # made from this reference must not be used afterwards
+        self.arrays = {}
+        if self.owner:
+            self.memory.unlink()
+            self.owner = False
+        try:
+            self.memory.close()
+        except BufferError:
+            # a trace still views the block; it is unmapped when that goes away
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+# End SharedReference Class
+
+# On-disk index of every NGG PAM site in a FASTA file (plasmid maps, small genomes),
+# on both strands, for ranking off-targets beyond the sequenced read. Each site keeps
+# its record, strand, the forward-strand start of its 23 bases (protospacer and PAM)
+# and its 20-base protospacer read 5' to 3' on its own strand, packed into one word
+# with its ambiguity mask (see PackedSequence). Unlike _match_ngg,
+# overlapping PAMs (NGGG) are all kept. An index is a directory of .npy files that
+# are memory-mapped when it is opened, so it is built once and shared by any number
+# of queries and processes.
+class PamIndex(object):
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'index.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != PAM_INDEX_VERSION:
+            raise ValueError('%s was built by a different version of CrisPy' % index_dir)
+        self.records = meta['records']
+        self.words = self._load('words')
+        self.ambiguous = self._load('ambiguous')
+        self.record_index = self._load('records')
+        self.strands = self._load('strands')
+        self.positions = self._load('positions')
+
+    def _load(self, name):
+        return np.load(os.path.join(self.index_dir, name + '.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.positions)
+
+    @staticmethod
+    def _record_sites(sequence):
+        # (protospacer words, ambiguity masks, strands, positions) of the PAM sites
+        # in one record
+        bases = np.frombuffer(sequence.upper().encode('ascii', 'replace'), dtype=np.uint8)
+        length = PROTOSPACER_LENGTH
+        site_length = length + 3
+        if len(bases) < site_length:
+            return (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int8),
+                    np.zeros(0, dtype=np.int64))
+        # sense: protospacer, then NGG (the sites start at 0 .. len - 23)
+        g = bases == ord('G')
+        sense = np.flatnonzero(g[length + 1:len(bases) - 1] & g[length + 2:])
+        # antisense: CCN, then the reverse complement of the protospacer, which
+        # starts at len - (start + 23) on the reverse strand
+        c = bases == ord('C')
+        antisense = np.flatnonzero(c[:len(bases) - site_length + 1] & c[1:len(bases) - site_length + 2])
+        packed = PackedSequence(bases.tobytes())
+        sense_words, sense_ambiguous = packed.kmers(length)
+        reverse_words, reverse_ambiguous = packed.reverse_complement().kmers(length)
+        reverse_starts = len(bases) - site_length - antisense
+        words = np.concatenate([sense_words[sense], reverse_words[reverse_starts]])
+        ambiguous = np.concatenate([sense_ambiguous[sense], reverse_ambiguous[reverse_starts]])
+        strands = np.concatenate([np.ones(len(sense), dtype=np.int8),
+                                  -np.ones(len(antisense), dtype=np.int8)])
+        positions = np.concatenate([sense, antisense]).astype(np.int64)
+        order = np.argsort(positions, kind='stable')
+        return words[order], ambiguous[order], strands[order], positions[order]
+
+    @classmethod
+    def build(cls, fasta_path, index_dir):
+        # scans every record of a FASTA file once and writes its index to index_dir
+        from Bio import SeqIO
+        os.makedirs(index_dir, exist_ok=True)
+        records = []
+        parts = {'words': [], 'ambiguous': [], 'records': [], 'strands': [], 'positions': []}
+        for record in SeqIO.parse(fasta_path, 'fasta'):
+            words, ambiguous, strands, positions = cls._record_sites(str(record.seq))
+            parts['words'].append(words)
+            parts['ambiguous'].append(ambiguous)
+            parts['records'].append(np.full(len(positions), len(records), dtype=np.int32))
+            parts['strands'].append(strands)
+            parts['positions'].append(positions)
+            records.append(record.id)
+        empty = {'words': np.zeros(0, dtype=np.uint64), 'ambiguous': np.zeros(0, dtype=np.uint32),
+                 'records': np.zeros(0, dtype=np.int32), 'strands': np.zeros(0, dtype=np.int8),
+                 'positions': np.zeros(0, dtype=np.int64)}
+        # files are written under a temporary name and moved into place, with the
+        # index.json that marks a finished index written last
+        for name, arrays in parts.items():
+            array = np.concatenate(arrays) if arrays else empty[name]
+            handle, temp_path = tempfile.mkstemp(dir=index_dir, suffix='.tmp')
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, array)
+            os.replace(temp_path, os.path.join(index_dir, name + '.npy'))
+        handle, temp_path = tempfile.mkstemp(dir=index_dir, suffix='.tmp')
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'version': PAM_INDEX_VERSION, 'records': records}, f)
+        os.replace(temp_path, os.path.join(index_dir, 'index.json'))
+        return cls(index_dir)
+
+    def score_range(self, guides, start, end, cutoff=None, max_mismatches=None):
+        # scores sites start..end-1 against guides (from pack_guides), keeping sites
+        # with a score at or below the cutoff and at most max_mismatches mismatches.
+        # A guide shorter than the protospacers is compared with their PAM end
+        guide_words, guide_ambiguous, guide_length = guides
+        site_words = np.asarray(self.words[start:end]) & np.uint64((1 << 2 * guide_length) - 1)
+        site_ambiguous = np.asarray(self.ambiguous[start:end]) & np.uint32((1 << guide_length) - 1)
+        masks = mismatch_masks(guide_words, guide_ambiguous, site_words, site_ambiguous, guide_length)
+        keep = np.ones(masks.shape, dtype=bool)
+        if max_mismatches is not None:
+            keep &= mismatch_counts(masks) <= max_mismatches
+        scores = mismatch_scores(masks)
+        if cutoff is not None:
+            keep &= scores <= cutoff
+        guide, site = np.nonzero(keep)
+        sites = np.zeros(len(site), dtype=PAM_SITE_DTYPE)
+        sites['guide'] = guide
+        sites['site'] = start + site
+        sites['record'] = self.record_index[start:end][site]
+        sites['strand'] = self.strands[start:end][site]
+        sites['position'] = self.positions[start:end][site]
+        sites['score'] = scores[guide, site]
+        return sites
+
+    @_profiled('pam_index_scoring', lambda self, guides, cutoff=.6, chunk_size=1 << 16, workers=1,
+               max_mismatches=None: {'guides': 1 if isinstance(guides, str) else len(guides), 'sites': len(self)})
+    def score(self, guides, cutoff=.6, chunk_size=1 << 16, workers=1, max_mismatches=None):
+        # Scores every site of the index against each guide with the OfftargetFinder
+        # model, chunk_size sites at a time so memory stays bounded, on up to workers
+        # processes. Returns a PAM_SITE_DTYPE array of the sites scoring at or below
+        # the cutoff (None keeps them all), by guide and then in index order; with
+        # max_mismatches set, sites with more mismatches are left out too. Unlike
+        # OfftargetFinder.get_sites, perfect matches (score 0) are kept: in a genome
+        # the guide's own site is one, and any other is an off-target.
+        if isinstance(guides, str):
+            guides = [guides]
+        packed = pack_guides([guide.upper() for guide in guides])
+        if packed[2] > PROTOSPACER_LENGTH:
+            raise ValueError('guides can be at most %d bases long' % PROTOSPACER_LENGTH)
+        bounds = [(start, min(start + chunk_size, len(self)))
+                  for start in range(0, len(self), chunk_size)]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(bounds)))
+        jobs = [(self.index_dir, packed, start, end, cutoff, max_mismatches) for start, end in bounds]
+        if workers == 1:
+            chunks = [self.score_range(packed, start, end, cutoff, max_mismatches) for start, end in bounds]
+        else:
+            import multiprocessing
+            with multiprocessing.Pool(workers) as pool:
+                chunks = pool.map(_score_index_chunk, jobs)
+        sites = np.concatenate(chunks) if chunks else np.zeros(0, dtype=PAM_SITE_DTYPE)
+        return sites[np.argsort(sites['guide'], kind='stable')]
+
+    def protospacer(self, site):
+        # the protospacer of a scored site, as a string (N at ambiguous bases)
+        word = int(self.words[site['site']])
+        ambiguous = int(self.ambiguous[site['site']])
+        return ''.join('N' if ambiguous >> (PROTOSPACER_LENGTH - 1 - i) & 1 else
+                       'ACGT'[word >> 2 * (PROTOSPACER_LENGTH - 1 - i) & 3] for i in range(PROTOSPACER_LENGTH))
+# End PamIndex Class
+
+# Indexes opened by each pool worker, by directory
+_pam_indexes = {}
+
+def _score_index_chunk(job):
+    index_dir, guides, start, end, cutoff, max_mismatches = job
+    if index_dir not in _pam_indexes:
+        _pam_indexes[index_dir] = PamIndex(index_dir)
+    return _pam_indexes[index_dir].score_range(guides, start, end, cutoff, max_mismatches)
+
+# Staged analysis of one reference and one test trace: parse -> normalize -> align ->
+# diff -> locate -> off-targets -> frequencies. Each stage's result is kept, keyed by
+# its inputs, so asking again with only a later input changed (e.g. another guide or
+# target range) redoes just the stages that depend on it. Files are known by their
+# path, modification time and size, so editing or replacing one (or pointing ref_file
+# or test_file at another) throws away everything worked out from the old one.
+# Results are shared between calls and shouldn't be modified. With a SampleExecutor,
+# the independent pieces of each stage are done side by side (both traces are then
+# normalized together).
+class Pipeline(object):
+    def __init__(self, ref_file, test_file, offset_search='batched', executor=None):
+        # either file can also be a Trace, which is then taken as never changing
+        self.ref_file = ref_file
+        self.test_file = test_file
+        self.offset_search = offset_search
+        self.executor = executor
+        self._results = {}
+        self._current = None
+
+    def _signature(self, source):
+        if isinstance(source, Trace):
+            return ('trace', id(source))
+        stat = os.stat(source)
+        return (os.path.abspath(source), stat.st_mtime_ns, stat.st_size)
+
+    def _signatures(self):
+        # signatures of the current files. Results made from any other file are dropped
+        signatures = {'ref': self._signature(self.ref_file), 'test': self._signature(self.test_file)}
+        if signatures != self._current:
+            current = set(signatures.values())
+            for key in list(self._results):
+                if not set(key[1]) <= current:
+                    del self._results[key]
+            self._current = signatures
+        return signatures
+
+    def _memo(self, stage, files, params, compute):
+        # the stage's result for these files and parameters, worked out once
+        signatures = self._signatures()
+        key = (stage, tuple(signatures[name] for name in files), params)
+        if key not in self._results:
+            self._results[key] = compute()
+        return self._results[key]
+
+    def parse(self, which):
+        # raw trace of 'ref' or 'test'
+        def compute():
+            source = self.ref_file if which == 'ref' else self.test_file
+            if isinstance(source, Trace):
+                return source.copy()
+            return ABIparse(source).trace
+        return self._memo('parse', (which,), (), compute)
+
+    def normalize(self, which):
+        # normalized trace of 'ref' or 'test'
+        def compute():
+            trace = self.parse(which).copy()
+            SeqDoc(trace, trace, self.offset_search).prepare_trace(trace)
+            return trace
+        return self._memo('normalize', (which,), (), compute)
+
+    def _normalize_both(self):
+        # normalizes whichever of the two traces isn't yet, side by side
+        signatures = self._signatures()
+        missing = [which for which in ('ref', 'test')
+                   if ('normalize', (signatures[which],), ()) not in self._results]
+        traces = [self.parse(which).copy() for which in missing]
+        if traces:
+            SeqDoc(traces[0], traces[-1], self.offset_search, executor=self.executor).prepare_traces(*traces)
+        for which, trace in zip(missing, traces):
+            self._memo('normalize', (which,), (), lambda trace=trace: trace)
+
+    def align(self):
+        # (reference, test) traces aligned to each other
+        def compute():
+            if self.executor is not None:
+                self._normalize_both()
+            seqdoc = SeqDoc(self.normalize('ref').copy(), self.normalize('test').copy(), self.offset_search,
+                            executor=self.executor)
+            seqdoc.get_best_align(seqdoc.ref_trace, seqdoc.test_trace)
+            return seqdoc.ref_trace, seqdoc.test_trace
+        return self._memo('align', ('ref', 'test'), (self.offset_search,), compute)
+
+    def diff(self):
+        # (aligned length, difference traces), as SeqDoc.get_all_data gives them
+        def compute():
+            ref_trace, test_trace = self.align()
+            return SeqDoc(ref_trace, test_trace, self.offset_search).differences(ref_trace, test_trace)
+        return self._memo('diff', ('ref', 'test'), (self.offset_search,), compute)
+
+    def locate(self, target_sequence):
+        # (start, end) of the target in the reference sequence
+        target_sequence = target_sequence.upper()
+        return self._memo('locate', ('ref',), (target_sequence,),
+                          lambda: locate_target(self.parse('ref')['sequence'], target_sequence))
+
+    def offtargets(self, target_sequence):
+        # likely off-target sites in the reference, as OfftargetFinder.get_targets
+        # gives them ({score: position})
+        target_sequence = target_sequence.upper()
+        return self._memo('offtargets', ('ref',), (target_sequence,),
+                          lambda: OfftargetFinder(self.parse('ref'), target_sequence).get_targets())
+
+    def sites(self, target_sequence):
+        # (strand, position, score) of the target and each off-target site, in the
+        # order of sorted(frequencies(...)); scores are 1 for a perfect match
+        # (positions are forward-strand starts, see site_position)
+        align_start, align_end = self.locate(target_sequence)
+        match_dict = self.offtargets(target_sequence)
+        sequence = self.parse('ref')['sequence']
+        sites = [(1, align_start, 1.0)]
+        for k in sorted(match_dict):
+            sites.append((1 if match_dict[k] > 0 else -1, site_position(sequence, match_dict[k]), 1 - k))
+        return sites
+
+    def frequencies(self, target_sequence, target_range):
+        # mutation frequencies of the target (key 0) and each off-target site (keyed
+        # by its score), one list per site with a value for each base in target_range
+        target_sequence = target_sequence.upper()
+        target_range = tuple(target_range)
+
+        def compute():
+            match_dict = self.offtargets(target_sequence)
+            ref_trace, test_trace = self.align()
+            align_length, diffs = self.diff()
+            sequalizer = Sequalizer(ref_trace, test_trace, diffs, target_sequence, list(target_range),
+                                    executor=self.executor)
+            scores = sorted(match_dict)
+            mut_freqs = sequalizer.get_mutation_freqs([None] + [match_dict[k] for k in scores])
+            freq_dict = {0: mut_freqs[0].tolist()}
+            for k, freqs in zip(scores, mut_freqs[1:]):
+                freq_dict[k] = freqs.tolist()
+            return freq_dict
+        return self._memo('frequencies', ('ref', 'test'), (self.offset_search, target_sequence, target_range), compute)
+
+    def clear(self):
+        self._results = {}
+        self._current = None
+# End Pipeline Class
+
+# Streams long-format results (see RESULT_COLUMNS) to disk one sample at a time, so
+# memory stays the same however many samples a run has. 'csv' writes a CSV file with
+# the sample's name in the sample column. 'columnar' writes a directory with one raw
+# little-endian file per column, the sample names in samples.txt (the sample column
+# is the line number) and, once closed, columns.json describing them; read it back
+# with read_results. With diffs_path set, each sample's difference traces are kept
+# too (see DiffStore).
+class ResultsWriter(object):
+    def __init__(self, path, format='csv', diffs_path=None):
+        if format not in RESULT_FORMATS:
+            raise ValueError('unknown results format: ' + str(format))
+        self.path = path
+        self.format = format
+        self.samples = 0
+        self.rows = 0
+        if format == 'csv':
+            self._file = open(path, 'w', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow([name for name, dtype in RESULT_COLUMNS])
+        else:
+            os.makedirs(path, exist_ok=True)
+            self._columns = [(name, np.dtype(dtype).newbyteorder('<'), open(os.path.join(path, name + '.bin'), 'wb'))
+                             for name, dtype in RESULT_COLUMNS]
+            self._file = open(os.path.join(path, 'samples.txt'), 'w')
+        self.diffs = DiffStore(diffs_path) if diffs_path is not None else None
+
+    def write_sample(self, sample, sites, target_range, freqs, diffs=None):
+        # Writes one sample. sites gives (strand, position, score) for each row of
+        # freqs (sites x target_range, as Sequalizer.get_mutation_freqs returns), and
+        # diffs (a dict of difference traces) is kept if there is a DiffStore
+        freqs = np.asarray(freqs, dtype=np.float64).reshape(len(sites), len(target_range))
+        site_info = np.array(sites, dtype=np.float64).reshape(len(sites), 3)
+        columns = {'sample': np.full(freqs.size, self.samples),
+                   'site': np.repeat(np.arange(len(sites)), len(target_range)),
+                   'strand': np.repeat(site_info[:, 0], len(target_range)),
+                   'position': np.repeat(site_info[:, 1], len(target_range)),
+                   'score': np.repeat(site_info[:, 2], len(target_range)),
+                   'base_index': np.tile(target_range, len(sites)),
+                   'frequency': freqs.ravel()}
+        if self.format == 'csv':
+            names = [name for name, dtype in RESULT_COLUMNS]
+            values = [columns[name].astype(dtype).tolist() for name, dtype in RESULT_COLUMNS]
+            values[names.index('sample')] = [sample] * freqs.size
+            self._writer.writerows(zip(*values))
+        else:
+            for name, dtype, column_file in self._columns:
+                column_file.write(columns[name].astype(dtype).tobytes())
+            self._file.write(str(sample).replace('\n', ' ') + '\n')
+        if self.diffs is not None and diffs is not None:
+            self.diffs.add(self.samples, sample, diffs)
+        self.samples += 1
+        self.rows += freqs.size
+
+    def flush(self):
+        self._file.flush()
+        if self.format == 'columnar':
+            for name, dtype, column_file in self._columns:
+                column_file.flush()
+        if self.diffs is not None:
+            self.diffs.flush()
+
+    def close(self):
+        self._file.close()
+        if self.format == 'columnar':
+            for name, dtype, column_file in self._columns:
+                column_file.close()
+            with open(os.path.join(self.path, 'columns.json'), 'w') as f:
+                json.dump({'version': RESULTS_VERSION, 'rows': self.rows,
+                           'columns': [[name, dtype.str] for name, dtype, column_file in self._columns]}, f)
+        if self.diffs is not None:
+            self.diffs.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+# End ResultsWriter Class
+
+# Reads columnar results back: (sample names, {column: memory-mapped array})
+def read_results(path):
+    with open(os.path.join(path, 'columns.json')) as f:
+        meta = json.load(f)
+    if meta.get('version') != RESULTS_VERSION:
+        raise ValueError('%s was written by a different version of CrisPy' % path)
+    columns = {}
+    for name, dtype in meta['columns']:
+        if meta['rows']:
+            columns[name] = np.memmap(os.path.join(path, name + '.bin'), dtype=dtype, mode='r',
+                                      shape=(meta['rows'],))
+        else:
+            columns[name] = np.zeros(0, dtype=dtype)
+    with open(os.path.join(path, 'samples.txt')) as f:
+        samples = [line.rstrip('\n') for line in f]
+    return samples, columns
+
+# Difference traces of many samples in one file, for plotting later. Each sample's
+# four channels (TRACE_LIST order, as float32) are appended to diffs.bin as one
+# chunk (a DiffChunks stream is read through as it is added), and index.tsv gets a line with its number, name, offset and length. A
+# DiffStore opened with mode='r' reads them back with get.
+class DiffStore(object):
+    def __init__(self, path, mode='w'):
+        self.path = path
+        self.mode = mode
+        if mode == 'w':
+            os.makedirs(path, exist_ok=True)
+            self._data = open(os.path.join(path, 'diffs.bin'), 'wb')
+            self._index = open(os.path.join(path, 'index.tsv'), 'w')
+            self._index.write('version\t%d\n' % RESULTS_VERSION)
+            self._offset = 0
+        else:
+            self.chunks = {}
+            with open(os.path.join(path, 'index.tsv')) as f:
+                version = f.readline().rstrip('\n').split('\t')
+                if version != ['version', str(RESULTS_VERSION)]:
+                    raise ValueError('%s was written by a different version of CrisPy' % path)
+                for line in f:
+                    number, name, offset, length = line.rstrip('\n').split('\t')
+                    self.chunks[int(number)] = (name, int(offset), int(length))
+
+    def add(self, number, name, diffs):
+        if isinstance(diffs, DiffChunks):
+            length = self._add_chunks(diffs)
+        else:
+            data = np.array([diffs[letter] for letter in TRACE_LIST], dtype='<f4')
+            self._data.write(data.tobytes())
+            length = data.shape[1]
+        self._index.write('%d\t%s\t%d\t%d\n' % (number, str(name).replace('\t', ' ').replace('\n', ' '),
+                                                self._offset, length))
+        self._offset += length * len(TRACE_LIST) * 4
+
+    def _add_chunks(self, chunks):
+        # A streamed sample's channels are each spooled to a temporary file as the
+        # chunks are read, then copied into diffs.bin one after the other
+        spools = [tempfile.TemporaryFile() for letter in TRACE_LIST]
+        try:
+            for start, diffs in chunks:
+                for letter, spool in zip(TRACE_LIST, spools):
+                    spool.write(np.asarray(diffs[letter], dtype='<f4').tobytes())
+            for spool in spools:
+                spool.seek(0)
+                shutil.copyfileobj(spool, self._data)
+        finally:
+            for spool in spools:
+                spool.close()
+        return chunks.length
+
+    def get(self, number):
+        # (name, {letter: difference trace}) of a sample, memory-mapped
+        name, offset, length = self.chunks[number]
+        data = np.memmap(os.path.join(self.path, 'diffs.bin'), dtype='<f4', mode='r', offset=offset,
+                         shape=(len(TRACE_LIST), length)) if length else np.zeros((len(TRACE_LIST), 0), '<f4')
+        return name, {letter: data[CHANNEL_INDEX[letter]] for letter in TRACE_LIST}
+
+    def flush(self):
+        self._data.flush()
+        self._index.flush()
+
+    def close(self):
+        if self.mode == 'w':
+            self._data.close()
+            self._index.close()
+# End DiffStore Class
@@ -1,8 +1,8 @@
 import matplotlib.pyplot as plt
 from tkinter import *
 from tkinter import filedialog, simpledialog
-import csv
 import CrisPy
+import CrisPyPlot
 
 class App(Frame):
     def __init__(self, master=None):
@@ -10,6 +10,9 @@ class App(Frame):
         self.pack()
         self.createWidgets()
         self.mut_freq_dict = {}
+        self.pipeline = None
+        # pieces of each analysis are done side by side on a few threads
+        self.executor = CrisPy.SampleExecutor()
         # user can set a default target sequence here
         #self.target_sequence = 'CCGGCAAGCTGCCCGTGCCC'
         self.target_sequence = 'GGGCACGGGCAGCTTGCCGG'
@@ -90,22 +93,24 @@ class App(Frame):
         self.analyze.destroy()
 
         # Calls on CrisPy
-        # Initializes SeqDoc object with reference and test file
-        self.seqdoc = CrisPy.SeqDoc(self.ref_path, self.test_path)
-        align_length, self.diffs = self.seqdoc.get_all_data()
-
-        # Initializes OfftargetFinder
-        offtargeter = CrisPy.OfftargetFinder(self.seqdoc.ref_trace, self.target_sequence)
-        match_dict = offtargeter.get_targets()
-
-        # Initializes Sequalizer object
-        sequalizer = CrisPy.Sequalizer(self.seqdoc.ref_trace, self.seqdoc.test_trace, self.diffs, self.target_sequence, self.target_range)
-        self.mut_freq_dict[0] = sequalizer.get_mutation_freq()
+        # The pipeline is kept between analyses, so only the stages affected by a new
+        # file, target sequence or range are worked out again
+        if self.pipeline is None:
+            self.pipeline = CrisPy.Pipeline(self.ref_path, self.test_path, executor=self.executor)
+        else:
+            self.pipeline.ref_file = self.ref_path
+            self.pipeline.test_file = self.test_path
+        align_length, self.diffs = self.pipeline.diff()
+        self.ref_trace, test_trace = self.pipeline.align()
+
+        # mutation frequencies of the target (key 0) and every off-target site
+        self.mut_freq_dict = self.pipeline.frequencies(self.target_sequence, self.target_range)
         print('Target Sequence:')
         print('Score is ', 1)
         print(self.mut_freq_dict[0], '\n')
-        for k in sorted(match_dict):
-            self.mut_freq_dict[k] = sequalizer.get_mutation_freq(match_override=match_dict[k])
+        for k in sorted(self.mut_freq_dict):
+            if k == 0:
+                continue
             print('Off-Target Sequence:')
             print('Score is ' , 1-k)
             print(self.mut_freq_dict[k],'\n')
@@ -122,27 +127,23 @@ class App(Frame):
         self.display.pack(side="right", padx=30, pady=30, fill="both", expand=1)
 
     def displayOutput(self):
-        # display difference data on a plot
-        plt.xticks(self.seqdoc.ref_trace['base_pos'])
-        plt.title('Difference Between Traces')
-        plt.xlabel('Base Index')
-        plt.ylabel('Relative Frequency')
-        line1 = plt.plot(self.diffs['A'], label = 'Adenine')
-        line2 = plt.plot(self.diffs['G'], label = 'Guanine')
-        line3 = plt.plot(self.diffs['C'], label = 'Cytosine')
-        line4 = plt.plot(self.diffs['T'], label = 'Thymine')
-        plt.legend()
+        # display difference data: the whole trace, and a close-up of each site
+        match_dict = self.pipeline.offtargets(self.target_sequence)
+        scores = sorted(match_dict)
+        figure = plt.figure(figsize=(12, 8))
+        CrisPyPlot.draw_sample(figure, self.diffs, self.ref_trace, self.target_sequence.upper(), self.target_range,
+                               [match_dict[k] for k in scores], [1 - k for k in scores])
         plt.show()
-        pass
 
     def saveOutput(self):
         self.save.destroy()
         self.display.destroy()
 
-        with open('CrisPy_Output.csv', 'w') as f:  # Just use 'w' mode in 3.x
-            w = csv.DictWriter(f, self.mut_freq_dict.keys())
-            w.writeheader()
-            w.writerow(self.mut_freq_dict)
+        # one row per site and base, with each site's strand, position and score
+        sites = self.pipeline.sites(self.target_sequence)
+        freqs = [self.mut_freq_dict[k] for k in sorted(self.mut_freq_dict)]
+        with CrisPy.ResultsWriter('CrisPy_Output.csv') as results:
+            results.write_sample(self.test_path, sites, self.target_range, freqs)
 
         self.left["text"] += "Would you like to  analyze another file, or are you done?"
 
@@ -152,7 +153,7 @@ class App(Frame):
         self.again.pack(side="left", padx=30, pady=30, fill="both", expand=1)
         
         self.quit = Button(self, text="Quit",
-                           command=root.destroy, width=10, height=3,
+                           command=self.quitApp, width=10, height=3,
                            border=3, font=["calibri",24,"bold"])
         self.quit.pack(side="right", padx=30, pady=30, fill="both", expand=1)
 
@@ -180,6 +181,11 @@ class App(Frame):
 
         self.createWidgets()
 
+    def quitApp(self):
+        # stop the executor's worker threads before the window goes
+        self.executor.close()
+        self.master.destroy()
+
 
 
 # The main loop of the program
@@ -192,4 +198,6 @@ textBoxText = "Welcome to CrisPy!\nPlease select your sanger files and input tar
 myapp = App(master=root)
 myapp.master.title("Pitt iGEM 2018")
 myapp.master.minsize(640, 320)
+# closing the window quits the same way as the Quit button
+myapp.master.protocol("WM_DELETE_WINDOW", myapp.quitApp)
 myapp.mainloop()   
@@ -0,0 +1,331 @@
+# Headless batch runner for CrisPy: compares one reference trace against many test
+# traces without the GUI. The reference is parsed and normalized once, then the test
+# traces are spread over a process pool and one CSV row is written per sample as
+# soon as it is finished. The prepared reference is published in shared memory
+# (see CrisPy.SharedReference), so workers don't each keep a copy of it.
+#
+# example:
+#   python CrisPyBatch.py ref.ab1 plate_dir/ --guide GGGCACGGGCAGCTTGCCGG --range 4,6
+import argparse
+import csv
+import multiprocessing
+import multiprocessing.resource_tracker
+import os
+import sys
+import time
+import numpy as np
+import CrisPy
+
+# State shared by every sample of a run, set up once per worker process
+_run = {}
+
+def parse_range(target_range, target_sequence):
+    # turns 'start,end' into the list of base indexes used by Sequalizer
+    try:
+        bounds = list(map(int, target_range.split(',')))
+    except ValueError:
+        raise ValueError('not a valid range')
+    if len(bounds) != 2 or bounds[0] > bounds[1]:
+        raise ValueError('not a valid range')
+    for bound in bounds:
+        if bound not in range(0, len(target_sequence)):
+            raise ValueError('not a valid range')
+    return list(range(bounds[0], bounds[1]+1))
+
+def check_sequence(target_sequence):
+    target_sequence = target_sequence.upper()
+    for letter in target_sequence:
+        if letter not in CrisPy.TRACE_LIST:
+            raise ValueError('not a valid nucleotide sequence')
+    return target_sequence
+
+def find_samples(source, ref_path=None):
+    # a directory gives every .ab1 file in it; anything else is read as a manifest
+    # with one file per line (relative to the manifest, '#' starts a comment)
+    if os.path.isdir(source):
+        samples = [os.path.join(source, name) for name in sorted(os.listdir(source))
+                   if name.lower().endswith('.ab1')]
+    else:
+        samples = []
+        base_dir = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    samples.append(os.path.join(base_dir, line))
+    if ref_path is not None:
+        # the reference is often kept alongside the samples
+        samples = [path for path in samples if os.path.abspath(path) != os.path.abspath(ref_path)]
+    return samples
+
+def prepare_reference(ref_path, target_sequence):
+    # parses and normalizes the reference, finds its off-target sites (best first)
+    # and publishes both as a CrisPy.SharedReference, which the caller closes
+    ref_trace = CrisPy.ABIparse(ref_path).trace
+    seqdoc = CrisPy.SeqDoc.__new__(CrisPy.SeqDoc)
+    seqdoc.prepare_trace(ref_trace)
+    sites = CrisPy.OfftargetFinder(ref_trace, target_sequence).get_sites()
+    sites = sites[np.argsort(sites['score'], kind='stable')]
+    return CrisPy.SharedReference(ref_trace, sites)
+
+def offtarget_list(reference):
+    # (score, position) of each off-target site of a prepared reference
+    return [(float(site['score']), int(site['position'])) for site in reference.sites]
+
+def _init_worker(run):
+    _run.clear()
+    _run.update(run)
+    _run['offtargets'] = offtarget_list(run['reference'])
+    # workers use the same trace cache and profiler settings as the parent
+    CrisPy.trace_cache = run['trace_cache']
+    CrisPy.profiler = run['profiler']
+
+def analyze_sample(test_path, run=None):
+    # runs one test trace against the shared reference, with the settings of run
+    # (by default the ones this worker was set up with). Any error is returned in
+    # the row, so one bad sample does not stop the run
+    if run is None:
+        run = _run
+    row = {'sample': test_path, 'status': 'ok', 'error': ''}
+    CrisPy.profiler.context['sample'] = test_path
+    with CrisPy.profiler.stage('sample'):
+        return _analyze(test_path, row, run)
+
+def _analyze(test_path, row, run):
+    try:
+        # the reference channels are a read-only view of the shared block
+        seqdoc = CrisPy.SeqDoc(run['reference'].trace(), test_path, run['offset_search'],
+                               trim=run.get('trim'))
+        positions = [position for score, position in run['offtargets']]
+        if run['roi']:
+            align_length, diffs = seqdoc.get_roi_data(run['target_sequence'], positions)
+        elif run.get('stream'):
+            # read through once by Sequalizer, so only a chunk is held at a time
+            diffs = seqdoc.stream_differences()
+        else:
+            align_length, diffs = seqdoc.get_all_data()
+        sequalizer = CrisPy.Sequalizer(seqdoc.ref_trace, seqdoc.test_trace, diffs,
+                                       run['target_sequence'], run['target_range'])
+        freqs = sequalizer.get_mutation_freqs([None] + positions)
+    except Exception as e:
+        row['status'] = 'failed'
+        row['error'] = '%s: %s' % (type(e).__name__, e)
+        return row
+
+    # frequencies that could not be worked out are nan
+    row['freqs'] = freqs
+    if run['keep_diffs']:
+        row['diffs'] = diffs
+    row['target'] = freqs[0].tolist()
+    site_errors = []
+    if np.isnan(freqs[0]).any():
+        row['status'] = 'failed'
+        site_errors.append('target: frequency not computed')
+    for position, site_freqs in zip(positions, freqs[1:]):
+        row[position] = site_freqs.tolist()
+        if np.isnan(site_freqs).any():
+            site_errors.append('site %d: frequency not computed' % position)
+    if run['plots'] is not None:
+        # figures are drawn here, in the worker, so they are made in parallel
+        try:
+            import CrisPyPlot
+            name = os.path.splitext(os.path.basename(test_path))[0] + '.' + run['plot_format']
+            CrisPyPlot.save_sample(os.path.join(run['plots'], name), diffs, seqdoc.ref_trace,
+                                   run['target_sequence'], run['target_range'], positions,
+                                   [1 - score for score, position in run['offtargets']],
+                                   title=os.path.basename(test_path))
+        except Exception as e:
+            site_errors.append('plot: %s: %s' % (type(e).__name__, e))
+    row['error'] = '; '.join(site_errors)
+    return row
+
+def site_table(ref_trace, target_sequence, offtargets):
+    # (strand, position, score) of the target and each off-target site, in the order
+    # Sequalizer's rows come in; scores are 1 for a perfect match and positions are
+    # forward-strand starts (see CrisPy.site_position)
+    align_start, align_end = CrisPy.locate_target(ref_trace['sequence'], target_sequence)
+    sites = [(1, align_start, 1.0)]
+    for score, position in offtargets:
+        sites.append((1 if position > 0 else -1, CrisPy.site_position(ref_trace['sequence'], position), 1 - score))
+    return sites
+
+def site_columns(offtargets):
+    # column names for the target and each off-target site (by position and score)
+    columns = [('target', 'target')]
+    for score, position in offtargets:
+        columns.append((position, 'offtarget_%d_score_%.3f' % (position, 1 - score)))
+    return columns
+
+def run_batch(ref_path, samples, target_sequence, target_range, out_file,
+              workers=None, offset_search='batched', progress=sys.stderr, roi=False, results=None,
+              plots=None, plot_format='png', trim=None, stream=False):
+    # analyzes every sample and writes one row per sample to out_file as they finish
+    # (in order of completion). With roi set, only the trace around the target and
+    # off-target sites is analyzed. With results (a CrisPy.ResultsWriter), each
+    # finished sample's frequencies are also written to it in long format, and with
+    # plots (a directory) a figure of each sample is saved there. With trim (one of
+    # CrisPy.TRIM_MODES), only the stretch where both traces are good is compared,
+    # and with stream set the difference traces are worked out a chunk at a time
+    # (for very long traces). Returns the number of samples that failed.
+    reference = prepare_reference(ref_path, target_sequence)
+    try:
+        return _run_batch(reference, samples, target_sequence, target_range, out_file, workers,
+                          offset_search, progress, roi, results, plots, plot_format, trim, stream)
+    finally:
+        reference.close()
+
+def _run_batch(reference, samples, target_sequence, target_range, out_file, workers, offset_search,
+               progress, roi, results, plots, plot_format, trim=None, stream=False):
+    offtargets = offtarget_list(reference)
+    run = {'reference': reference, 'offset_search': offset_search,
+           'target_sequence': target_sequence, 'target_range': target_range,
+           'trace_cache': CrisPy.trace_cache, 'profiler': CrisPy.profiler, 'roi': roi,
+           'keep_diffs': results is not None and results.diffs is not None,
+           'plots': plots, 'plot_format': plot_format, 'trim': trim, 'stream': stream}
+    if plots is not None:
+        os.makedirs(plots, exist_ok=True)
+    sites = site_table(reference.trace(), target_sequence, offtargets)
+    columns = site_columns(offtargets)
+    writer = csv.writer(out_file)
+    writer.writerow(['sample', 'status', 'error'] + [name for key, name in columns])
+    out_file.flush()
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(samples)))
+    if workers == 1:
+        _init_worker(run)
+        finished = map(analyze_sample, samples)
+        pool = None
+    else:
+        # (workers attach to the shared reference through this process's resource
+        # tracker, see CrisPy.SharedReference)
+        multiprocessing.resource_tracker.ensure_running()
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(run,))
+        finished = pool.imap_unordered(analyze_sample, samples)
+
+    failed = 0
+    start_time = time.time()
+    try:
+        for done, row in enumerate(finished, 1):
+            cells = [row['sample'], row['status'], row['error']]
+            for key, name in columns:
+                freqs = row.get(key)
+                cells.append('' if freqs is None else ';'.join('%g' % freq for freq in freqs))
+            writer.writerow(cells)
+            out_file.flush()
+            if results is not None and 'freqs' in row:
+                results.write_sample(row['sample'], sites, target_range, row['freqs'], row.get('diffs'))
+                results.flush()
+            if row['status'] != 'ok':
+                failed += 1
+            if progress is not None:
+                progress.write('[%d/%d] %s %s (%.1fs)\n' % (done, len(samples), row['status'],
+                                                            os.path.basename(row['sample']),
+                                                            time.time() - start_time))
+                progress.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return failed
+
+def print_profile(summary, out_file):
+    # one line per stage, the slowest (by total wall time) first
+    out_file.write('%-20s %8s %10s %10s %10s %12s\n' % ('stage', 'runs', 'wall (s)', 'cpu (s)',
+                                                       'max (s)', 'peak (MB)'))
+    for stage, totals in sorted(summary.items(), key=lambda x: -x[1]['wall']):
+        peak = '%.1f' % (totals['peak_bytes'] / 1e6) if 'peak_bytes' in totals else '-'
+        out_file.write('%-20s %8d %10.3f %10.3f %10.3f %12s\n' % (stage, totals['count'], totals['wall'],
+                                                                 totals['cpu'], totals['max_wall'], peak))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare one reference trace against many test traces.')
+    parser.add_argument('reference', help='reference .ab1 file')
+    parser.add_argument('tests', help='directory of test .ab1 files, or a manifest listing one per line')
+    parser.add_argument('--guide', required=True, help='target (guide) sequence')
+    parser.add_argument('--range', required=True, dest='target_range',
+                        help='start and end index in the guide (ex: 13,15)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: one per core)')
+    parser.add_argument('--output', default='-', help='CSV file to write (default: stdout)')
+    parser.add_argument('--offset-search', choices=CrisPy.OFFSET_SEARCH_MODES, default='batched',
+                        help='how the starting offset of each test trace is found')
+    parser.add_argument('--results', metavar='PATH',
+                        help='also write every frequency as one row per sample, site and base to PATH')
+    parser.add_argument('--results-format', choices=CrisPy.RESULT_FORMATS, default='csv',
+                        help="'csv' file, or 'columnar' directory of binary columns (default: csv)")
+    parser.add_argument('--diffs', metavar='DIR', help="keep each sample's difference traces in DIR")
+    parser.add_argument('--plots', metavar='DIR',
+                        help='save a figure of the differences around each site for every sample in DIR')
+    parser.add_argument('--plot-format', choices=('png', 'svg'), default='png', help='figure format (default: png)')
+    parser.add_argument('--roi', action='store_true',
+                        help='only align and compare the trace around the target and off-target sites')
+    parser.add_argument('--trim', choices=CrisPy.TRIM_MODES,
+                        help="only compare where both traces are good, by 'quality' values, peak "
+                             "'signal' or 'auto' (quality if the files have it)")
+    parser.add_argument('--stream', action='store_true',
+                        help='work out the differences a chunk at a time, for very long traces')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or write the parsed/normalized trace cache")
+    parser.add_argument('--clear-cache', action='store_true', help='empty the trace cache first')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write the time (and memory) taken by each stage to FILE as JSON lines')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='also record peak memory in the --profile file (slower)')
+    parser.add_argument('--quiet', action='store_true', help='no progress output')
+    args = parser.parse_args(argv)
+
+    if args.clear_cache:
+        CrisPy.trace_cache.clear()
+    if args.no_cache:
+        CrisPy.trace_cache.enabled = False
+
+    try:
+        target_sequence = check_sequence(args.guide)
+        target_range = parse_range(args.target_range, target_sequence)
+    except ValueError as e:
+        parser.error(str(e))
+    samples = find_samples(args.tests, args.reference)
+    if not samples:
+        parser.error('no test files found in ' + args.tests)
+    if args.diffs and not args.results:
+        parser.error('--diffs needs --results')
+    if args.trim and args.roi:
+        parser.error("--trim can't be used with --roi")
+    if args.stream and (args.roi or args.trim or args.diffs or args.plots):
+        parser.error("--stream can't be used with --roi, --trim, --diffs or --plots")
+    # (the profile file can also be named by CRISPY_PROFILE)
+    if args.profile_memory and not args.profile and CrisPy.profiler.path is None:
+        parser.error('--profile-memory needs --profile')
+
+    if args.profile:
+        # each run starts a new profile
+        open(args.profile, 'w').close()
+        CrisPy.profiler.path = args.profile
+        CrisPy.profiler.enabled = True
+    if args.profile_memory:
+        CrisPy.profiler.memory = True
+
+    progress = None if args.quiet else sys.stderr
+    results = CrisPy.ResultsWriter(args.results, args.results_format, args.diffs) if args.results else None
+    try:
+        if args.output == '-':
+            failed = run_batch(args.reference, samples, target_sequence, target_range, sys.stdout,
+                               args.workers, args.offset_search, progress, args.roi, results,
+                               args.plots, args.plot_format, args.trim, args.stream)
+        else:
+            with open(args.output, 'w', newline='') as out_file:
+                failed = run_batch(args.reference, samples, target_sequence, target_range, out_file,
+                                   args.workers, args.offset_search, progress, args.roi, results,
+                                   args.plots, args.plot_format, args.trim, args.stream)
+    finally:
+        if results is not None:
+            results.close()
+    if CrisPy.profiler.path is not None and progress is not None:
+        CrisPy.profiler.close()
+        print_profile(CrisPy.summarize_profile(CrisPy.read_profile(CrisPy.profiler.path)), progress)
+    return 1 if failed == len(samples) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+# Synthetic traces and benchmarks for CrisPy. synthetic_trace builds a trace with
+# known peaks, noise and edits, and write_abif saves one as an ab1 file that
+# ABIparse (or any ABIF reader) can open, so every stage can be measured without
+# private sequencing data. Run as a script to time each stage over a range of trace
+# lengths, sample counts and guide counts; one JSON object is written per result.
+#
+# example:
+#   python CrisPyBench.py --lengths 500,1000,2000 --samples 1,8 --guides 1,32 --output bench.jsonl
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import numpy as np
+import CrisPy
+
+# Order of the ABIF tags written for each channel (DATA9..DATA12)
+ABIF_CHANNELS = ['G', 'A', 'T', 'C']
+
+def synthetic_trace(length=500, sequence=None, spacing=12, peak_width=2.0, height=(600, 1400),
+                    noise=20, edits=(), offset=0, stretch=0.0, jitter=1.5, seed=0):
+    # Builds a Trace with one gaussian peak per base. length is the number of bases
+    # (a random sequence is used unless sequence is given), spacing the datapoints
+    # between peaks and peak_width the standard deviation of each peak. Peak heights
+    # are drawn from the height range, and uniform noise of up to +/-noise is added
+    # to every datapoint. edits is a list of (base index, base, fraction): that much
+    # of the peak is moved to the other base, as in a mixed population. offset adds
+    # (or, if negative, removes) datapoints before the first peak, stretch spreads
+    # the peaks out by that fraction along the trace (drift) and jitter moves each
+    # peak by up to that many datapoints.
+    rng = np.random.default_rng(seed)
+    if sequence is None:
+        sequence = ''.join(np.array(CrisPy.TRACE_LIST)[rng.integers(0, 4, length)])
+    sequence = sequence.upper()
+    length = len(sequence)
+    reach = int(np.ceil(peak_width * 4))
+    peaks = spacing + offset + np.arange(length) * spacing * (1 + stretch)
+    peaks = np.round(peaks + rng.uniform(-jitter, jitter, length)).astype(np.int64)
+    seq_length = int(spacing * 2 + max(offset, 0) + length * spacing * (1 + stretch))
+    base_pos = np.clip(peaks, 0, seq_length - 1)
+
+    # share of each peak in each channel
+    shares = np.zeros((length, len(CrisPy.TRACE_LIST)))
+    shares[np.arange(length), [CrisPy.CHANNEL_INDEX.get(base, 0) for base in sequence]] = 1
+    for index, base, fraction in edits:
+        shares[index] *= 1 - fraction
+        shares[index, CrisPy.CHANNEL_INDEX[base.upper()]] += fraction
+    heights = rng.uniform(height[0], height[1], length)
+
+    channels = np.zeros((len(CrisPy.TRACE_LIST), seq_length))
+    distance = np.arange(-reach, reach + 1)
+    columns = peaks[:, np.newaxis] + distance[np.newaxis, :]
+    shape = np.exp(-distance * distance / (2 * peak_width * peak_width))
+    in_trace = (columns >= 0) & (columns < seq_length)
+    for row in range(len(CrisPy.TRACE_LIST)):
+        values = heights[:, np.newaxis] * shares[:, row, np.newaxis] * shape[np.newaxis, :]
+        np.add.at(channels[row], columns[in_trace], values[in_trace])
+    channels += rng.uniform(-noise, noise, channels.shape)
+    channels = np.clip(np.trunc(channels), 0, 32767)
+    return CrisPy.Trace(channels.astype(np.int64), sequence, base_pos)
+
+def write_abif(path, trace, quality=40, sample_name='synthetic'):
+    # Saves a trace as an ABIF (ab1) file with the four data channels, base calls,
+    # base positions, per-base quality (one value for every base, or one each) and
+    # sample name
+    if trace['seq_length'] > 32767:
+        raise ValueError('ABIF traces can be at most 32767 datapoints long')
+    sequence = trace['sequence'].encode('ascii')
+    tags = [('DATA', 9 + i, 4, np.asarray(trace[letter], dtype='>i2').tobytes(), trace['seq_length'])
+            for i, letter in enumerate(ABIF_CHANNELS)]
+    tags += [('PBAS', 2, 2, sequence, len(sequence)),
+             ('PLOC', 2, 4, np.asarray(trace['base_pos'], dtype='>i2').tobytes(), len(trace['base_pos'])),
+             ('PCON', 2, 2, np.broadcast_to(np.asarray(quality, dtype=np.uint8), len(sequence)).tobytes(),
+              len(sequence)),
+             ('SMPL', 1, 18, bytes([len(sample_name)]) + sample_name.encode('ascii'), len(sample_name) + 1)]
+    # element type -> element size (short, char, pString)
+    sizes = {4: 2, 2: 1, 18: 1}
+    data = b''
+    entries = b''
+    for name, number, elem_type, raw, count in tags:
+        if len(raw) <= 4:
+            # small data is kept in the directory entry itself
+            entries += struct.pack('>4sihhii4si', name.encode('ascii'), number, elem_type,
+                                   sizes[elem_type], count, len(raw), raw.ljust(4, b'\0'), 0)
+        else:
+            entries += struct.pack('>4sihhiiii', name.encode('ascii'), number, elem_type,
+                                   sizes[elem_type], count, len(raw), 128 + len(data), 0)
+            data += raw
+    header = b'ABIF' + struct.pack('>h4sihhiiii', 101, b'tdir', 1, 1023, 28,
+                                   len(tags), len(entries), 128 + len(data), 0)
+    with open(path, 'wb') as f:
+        f.write(header.ljust(128, b'\0') + data + entries)
+
+def _timed(function, repeat):
+    # (best, median) seconds over repeat calls; function returns the zero-argument
+    # callable to time, so any setup it does is left out
+    times = []
+    for run in range(repeat):
+        call = function()
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times))
+
+def _guides(sequence, count, rng):
+    # count 20-base guides taken from the sequence, each with a few mismatches
+    guides = []
+    for index in range(count):
+        start = rng.randrange(0, len(sequence) - 20)
+        guide = list(sequence[start:start+20])
+        for mismatch in range(rng.randrange(0, 4)):
+            guide[rng.randrange(0, 20)] = rng.choice(CrisPy.TRACE_LIST)
+        guides.append(''.join(guide))
+    return guides
+
+def run_benchmarks(lengths=(500, 1000, 2000), samples=(1, 4), guides=(1, 16), repeat=3,
+                   workers=1, seed=0):
+    # Times every stage for each trace length (in bases), each guide count (for
+    # off-target scoring) and each sample count (for the whole batch run). Yields one
+    # result dict per measurement, with the best and median time in seconds.
+    rng = random.Random(seed)
+    work_dir = tempfile.mkdtemp(prefix='crispy-bench-')
+    # parsing and normalizing are measured, so the trace cache is kept out of it
+    cache_enabled = CrisPy.trace_cache.enabled
+    CrisPy.trace_cache.enabled = False
+    try:
+        for length in lengths:
+            ref = synthetic_trace(length, seed=seed)
+            target_index = length // 2
+            target = ref['sequence'][target_index:target_index+20]
+            edits = [(target_index + 5, 'A', 0.4), (target_index + 12, 'T', 0.2)]
+            test = synthetic_trace(sequence=ref['sequence'], edits=edits, offset=30, stretch=0.002,
+                                   seed=seed + 1)
+            ref_path = os.path.join(work_dir, 'ref_%d.ab1' % length)
+            test_path = os.path.join(work_dir, 'test_%d.ab1' % length)
+            write_abif(ref_path, ref)
+            write_abif(test_path, test)
+            result = {'length': length, 'datapoints': ref['seq_length']}
+
+            seqdoc = CrisPy.SeqDoc(ref.copy(), test.copy())
+            yield dict(result, stage='parse', seconds=_timed(lambda: lambda: CrisPy.ABIparse(test_path), repeat))
+            if ref['seq_length'] < 1100:
+                # too short for the whole-trace analysis
+                continue
+
+            def normalize():
+                trace = test.copy()
+                return lambda: seqdoc.normalize_data(trace)
+            yield dict(result, stage='normalize', seconds=_timed(normalize, repeat))
+            norm_ref = ref.copy()
+            norm_test = test.copy()
+            seqdoc.normalize_data(norm_ref)
+            seqdoc.normalize_data(norm_test)
+
+            yield dict(result, stage='best_offset',
+                       seconds=_timed(lambda: lambda: seqdoc._batched_offset(norm_ref, norm_test, True), repeat))
+            offset = seqdoc._batched_offset(norm_ref, norm_test, True)
+
+            def align():
+                aligned_ref = norm_ref.copy()
+                aligned_test = norm_test.copy()
+                return lambda: seqdoc._align(aligned_ref, aligned_test, offset, aligned_test['seq_length'] + offset)
+            yield dict(result, stage='align', seconds=_timed(align, repeat))
+            aligned_ref, aligned_test = seqdoc._align(norm_ref.copy(), norm_test.copy(), offset,
+                                                      norm_test['seq_length'] + offset)
+
+            yield dict(result, stage='differences',
+                       seconds=_timed(lambda: lambda: seqdoc.differences(aligned_ref, aligned_test), repeat))
+            align_length, diffs = seqdoc.differences(aligned_ref, aligned_test)
+
+            finder = CrisPy.OfftargetFinder(ref, target)
+            for guide_count in guides:
+                guide_list = _guides(ref['sequence'], guide_count, rng)
+                yield dict(result, stage='offtarget_scoring', guides=guide_count,
+                           seconds=_timed(lambda: lambda: finder.score_sites(guide_list), repeat))
+
+            sites = [int(site['position']) for site in finder.get_sites()]
+            sequalizer = CrisPy.Sequalizer(aligned_ref, aligned_test, diffs, target, list(range(20)))
+            yield dict(result, stage='mutation_freq', sites=len(sites) + 1,
+                       seconds=_timed(lambda: lambda: sequalizer.get_mutation_freqs([None] + sites), repeat))
+
+            import CrisPyBatch
+            for sample_count in samples:
+                sample_dir = os.path.join(work_dir, 'samples_%d_%d' % (length, sample_count))
+                os.makedirs(sample_dir, exist_ok=True)
+                for sample in range(sample_count):
+                    sample_trace = synthetic_trace(sequence=ref['sequence'], edits=edits,
+                                                   offset=rng.randrange(-20, 60), seed=seed + 10 + sample)
+                    write_abif(os.path.join(sample_dir, 's%d.ab1' % sample), sample_trace)
+                sample_paths = CrisPyBatch.find_samples(sample_dir)
+
+                def batch():
+                    out_file = open(os.devnull, 'w')
+                    return lambda: (CrisPyBatch.run_batch(ref_path, sample_paths, target, [4, 5, 6], out_file,
+                                                          workers, progress=None), out_file.close())
+                yield dict(result, stage='batch', samples=sample_count, workers=workers,
+                           seconds=_timed(batch, repeat))
+    finally:
+        CrisPy.trace_cache.enabled = cache_enabled
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def _int_list(text):
+    return [int(value) for value in text.split(',') if value]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time each CrisPy stage on synthetic traces.')
+    parser.add_argument('--lengths', type=_int_list, default=[500, 1000, 2000],
+                        help='trace lengths in bases (ex: 500,1000,2000)')
+    parser.add_argument('--samples', type=_int_list, default=[1, 4], help='sample counts for the batch run')
+    parser.add_argument('--guides', type=_int_list, default=[1, 16], help='guide counts for off-target scoring')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each measurement (best and median kept)')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for the batch run')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic traces')
+    parser.add_argument('--output', default='-', help='JSON lines file to append to (default: stdout)')
+    args = parser.parse_args(argv)
+
+    # recorded with every result, so results from different runs can be compared
+    run = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+           'numpy': np.__version__, 'machine': platform.machine(), 'repeat': args.repeat}
+    out_file = sys.stdout if args.output == '-' else open(args.output, 'a')
+    try:
+        for result in run_benchmarks(args.lengths, args.samples, args.guides, args.repeat,
+                                     args.workers, args.seed):
+            best, median = result.pop('seconds')
+            out_file.write(json.dumps(dict(run, best=best, median=median, **result)) + '\n')
+            out_file.flush()
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+# Client for the CrisPy analysis service (CrisPyServer.py). Requests and replies are
+# JSON objects, one per line, over a Unix socket or a localhost TCP port. Only the
+# standard library is imported here, so a script that submits samples starts fast.
+# When the service's queue is full it answers 'busy', and requests are sent again
+# (after a short wait) for up to busy_wait seconds before giving up.
+#
+# example:
+#   with CrisPyClient.CrisPyClient() as client:
+#       reply = client.analyze('ref.ab1', 'sample1.ab1', 'GGGCACGGGCAGCTTGCCGG', (4, 6))
+import itertools
+import json
+import os
+import socket
+import tempfile
+import time
+
+# Where the service listens unless told otherwise
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'crispy-%d.sock' % os.getuid())
+# First and longest wait (in seconds) before sending a request again when busy
+BUSY_RETRY = (0.05, 1.0)
+
+class ServiceError(Exception):
+    # a request the service could not carry out (bad arguments, missing files, ...)
+    pass
+
+class CrisPyClient(object):
+    def __init__(self, socket_path=None, port=None, timeout=None, busy_wait=60.0):
+        if port is not None:
+            self.sock = socket.create_connection(('127.0.0.1', port), timeout)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(socket_path or DEFAULT_SOCKET)
+        self.file = self.sock.makefile('rwb')
+        self.busy_wait = busy_wait
+        self._ids = itertools.count(1)
+
+    def _send(self, request):
+        self.file.write(json.dumps(request).encode() + b'\n')
+        self.file.flush()
+
+    def _receive(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('the CrisPy service closed the connection')
+        return json.loads(line)
+
+    def request(self, op, **fields):
+        # Sends one request and waits for its reply, sending it again while the
+        # service is busy. Raises ServiceError if it fails
+        return next(self.request_many([dict(fields, op=op)]))
+
+    def request_many(self, requests, window=16):
+        # Sends requests with up to window of them waiting at once, and yields
+        # each reply as it comes in (not necessarily in order; each reply has the
+        # 'request' it answers). A request the service is too busy for is held
+        # back and sent again as soon as another reply comes in (or, if none are
+        # waiting, after a wait that doubles while the service stays busy)
+        pending = {}
+        waiting = list(reversed(list(requests)))
+        held = []
+        busy_since = None
+        delay = BUSY_RETRY[0]
+        while waiting or pending or held:
+            while waiting and not held and len(pending) < window:
+                self._submit(waiting.pop(), pending)
+            if not pending:
+                time.sleep(delay)
+                delay = min(delay * 2, BUSY_RETRY[1])
+                self._submit(held.pop(0), pending)
+                continue
+            reply = self._receive()
+            request = pending.pop(reply.get('id'))
+            del request['id']
+            if reply['status'] == 'busy':
+                if busy_since is None:
+                    busy_since = time.time()
+                elif time.time() - busy_since > self.busy_wait:
+                    raise ServiceError('the CrisPy service stayed busy for %gs' % self.busy_wait)
+                held.append(request)
+                continue
+            busy_since = None
+            delay = BUSY_RETRY[0]
+            if held:
+                self._submit(held.pop(0), pending)
+            if reply['status'] == 'error':
+                raise ServiceError(reply.get('error', 'request failed'))
+            reply['request'] = request
+            yield reply
+
+    def _submit(self, request, pending):
+        request = dict(request, id=next(self._ids))
+        pending[request['id']] = request
+        self._send(request)
+
+    def analyze(self, reference, test, guide, target_range, **options):
+        # Compares one test trace with a reference (both paths the service can
+        # read). target_range is (start, end) in the guide. Options are roi,
+        # offset_search, trim, plots (a directory) and plot_format. The reply has the
+        # sample's status and error, its sites as [strand, position, score] and
+        # one row of frequencies per site (None where not computed)
+        return self.request('analyze', **self._analyze_fields(reference, test, guide, target_range, options))
+
+    def analyze_many(self, reference, tests, guide, target_range, window=16, **options):
+        # like analyze for each of tests, yielding replies as they finish
+        return self.request_many([dict(self._analyze_fields(reference, test, guide, target_range, options),
+                                       op='analyze') for test in tests], window)
+
+    def _analyze_fields(self, reference, test, guide, target_range, options):
+        fields = {'reference': os.path.abspath(reference), 'test': os.path.abspath(test), 'guide': guide,
+                  'range': list(target_range)}
+        fields.update(options)
+        if fields.get('plots') is not None:
+            fields['plots'] = os.path.abspath(fields['plots'])
+        return fields
+
+    def score_index(self, index_dir, guides, cutoff=.6, limit=100):
+        # Scores guides against a CrisPy.PamIndex the service keeps open. The reply's
+        # sites are [guide, record, strand, position, score], best first
+        return self.request('score_index', index=os.path.abspath(index_dir), guides=list(guides),
+                            cutoff=cutoff, limit=limit)
+
+    def status(self):
+        # queue depth ('queued', 'running', 'limit'), workers, cached references and counts
+        return self.request('status')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+# End CrisPyClient Class
@@ -0,0 +1,113 @@
+# Plots of the difference traces without a GUI. Each figure has an overview of the
+# whole trace, reduced to the min and max of each pixel column so it stays quick to
+# draw however long the trace is, and a zoomed panel around the target and each
+# off-target site labelled with the reference bases. Figures are drawn with
+# matplotlib's Figure and Agg canvas directly (not pyplot), so they can be written
+# to PNG or SVG from any number of worker processes, with no display or Tk.
+#
+# example:
+#   CrisPyPlot.save_sample('s1.png', diffs, ref_trace, target_sequence, target_range, sites)
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import numpy as np
+import CrisPy
+
+# Color and label of each channel
+CHANNEL_STYLE = {'A': ('green', 'Adenine'), 'G': ('black', 'Guanine'),
+                 'C': ('blue', 'Cytosine'), 'T': ('red', 'Thymine')}
+# Datapoints shown either side of a site in its zoomed panel
+ZOOM_PAD = 60
+# Most off-target panels drawn for one sample (the best matches come first)
+MAX_PANELS = 8
+
+def decimate(values, width):
+    # Reduces a trace to about width columns, each drawn as a vertical stroke from
+    # the column's min to its max, so no peak is lost. Returns (x, y) to plot
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) <= 2 * width:
+        return np.arange(len(values)), values
+    bucket = int(np.ceil(len(values) / float(width)))
+    columns = int(np.ceil(len(values) / float(bucket)))
+    padded = np.full(columns * bucket, np.nan)
+    padded[:len(values)] = values
+    padded = padded.reshape(columns, bucket)
+    x = np.repeat(np.arange(columns) * bucket + bucket // 2, 2)
+    y = np.empty(columns * 2)
+    y[0::2] = np.nanmin(padded, axis=1)
+    y[1::2] = np.nanmax(padded, axis=1)
+    return x, y
+
+def site_panels(ref_trace, target_sequence, sites=(), scores=None):
+    # (title, first base index, last base index, site) for the target and each
+    # off-target site (positions as given to Sequalizer) that is on
+    # the reference. scores, if given, holds each site's score (1 is a perfect match)
+    panels = []
+    sequence = ref_trace['sequence']
+    base_pos = ref_trace['base_pos']
+    for number, site in enumerate([None] + list(sites)[:MAX_PANELS]):
+        first, last = CrisPy.site_span(sequence, target_sequence, site)
+        if first < 0 or last >= min(len(sequence), len(base_pos)):
+            continue
+        if site is None:
+            title = 'Target'
+        else:
+            title = 'Off-target at %d (%s strand)' % (site, 'sense' if site > 0 else 'antisense')
+            if scores is not None:
+                title += ', score %.3f' % scores[number - 1]
+        panels.append((title, first, last, site))
+    return panels
+
+def draw_sample(figure, diffs, ref_trace, target_sequence, target_range=(), sites=(), scores=None,
+                title=None, overview_width=None):
+    # Draws the overview and one zoomed panel per site into a matplotlib Figure
+    panels = site_panels(ref_trace, target_sequence, sites, scores)
+    sequence = ref_trace['sequence']
+    base_pos = np.asarray(ref_trace['base_pos'])
+    if overview_width is None:
+        overview_width = int(figure.get_figwidth() * figure.dpi)
+    # fixed spacing (tight_layout would draw the whole figure an extra time)
+    grid = figure.add_gridspec(1 + (len(panels) + 1) // 2, 2, hspace=0.6, wspace=0.15,
+                               left=0.08, right=0.98, top=0.95, bottom=0.04)
+
+    overview = figure.add_subplot(grid[0, :])
+    for letter in CrisPy.TRACE_LIST:
+        color, label = CHANNEL_STYLE[letter]
+        x, y = decimate(diffs[letter], overview_width)
+        overview.plot(x, y, color=color, linewidth=0.6, label=label)
+    for panel_title, first, last, site in panels:
+        overview.axvspan(base_pos[first], base_pos[last], color='orange' if site is None else 'grey', alpha=0.3)
+    overview.set_title(title or 'Difference Between Traces')
+    overview.set_xlabel('Datapoint')
+    overview.set_ylabel('Relative Frequency')
+    overview.legend(loc='upper right', fontsize='small')
+
+    for number, (panel_title, first, last, site) in enumerate(panels):
+        axes = figure.add_subplot(grid[1 + number // 2, number % 2])
+        start = max(int(base_pos[first]) - ZOOM_PAD, 0)
+        end = min(int(base_pos[last]) + ZOOM_PAD, len(diffs['A']))
+        for letter in CrisPy.TRACE_LIST:
+            color, label = CHANNEL_STYLE[letter]
+            axes.plot(np.arange(start, end), diffs[letter][start:end], color=color, linewidth=0.8)
+        # the bases in target_range are the ones Sequalizer measures
+        for base_index in target_range:
+            position = first + base_index if site is None or site > 0 else last - base_index
+            if 0 <= position < len(base_pos):
+                axes.axvspan(base_pos[position] - 2, base_pos[position] + 2, color='orange', alpha=0.4)
+        shown = np.flatnonzero((base_pos >= start) & (base_pos < end))
+        shown = shown[shown < len(sequence)]
+        axes.set_xticks(base_pos[shown])
+        axes.set_xticklabels([sequence[index] for index in shown], fontsize='x-small')
+        axes.set_xlim(start, max(end - 1, start + 1))
+        axes.set_title(panel_title, fontsize='small')
+    return figure
+
+def save_sample(path, diffs, ref_trace, target_sequence, target_range=(), sites=(), scores=None,
+                title=None, size=(12, 8), dpi=100):
+    # Writes the figure for one sample to path (PNG, SVG, or anything else matplotlib
+    # can write, by extension)
+    panel_rows = (len(site_panels(ref_trace, target_sequence, sites)) + 1) // 2
+    figure = Figure(figsize=(size[0], size[1] * (1 + panel_rows) / 3.0), dpi=dpi)
+    FigureCanvasAgg(figure)
+    draw_sample(figure, diffs, ref_trace, target_sequence, target_range, sites, scores, title)
+    figure.savefig(path)
+    return path
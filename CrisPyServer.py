@@ -0,0 +1,321 @@
+# Long-lived local analysis service for CrisPy, for pipelines that submit samples one
+# at a time (e.g. as they come off the sequencer) and shouldn't pay for a new
+# interpreter and its imports each time. Worker processes are started once, with
+# Biopython (and matplotlib, for plots) already imported. Prepared references (see
+# CrisPy.SharedReference) are kept between requests, and PAM indexes stay open in
+# the workers, each evicting the least recently used past a limit. Requests are
+# taken by an asyncio front end from any number of connections and handed to the
+# worker pool; once more than max_queue are waiting, new ones are answered 'busy'
+# straight away. Every reply reports the queue depth. The protocol is one JSON
+# object per line each way over a Unix socket (or a localhost TCP port); see
+# CrisPyClient.py.
+#
+# example:
+#   python CrisPyServer.py --workers 4 --socket /tmp/crispy.sock
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import json
+import os
+import signal
+import sys
+import time
+from multiprocessing import resource_tracker
+import numpy as np
+import CrisPy
+import CrisPyBatch
+import CrisPyClient
+
+# Prepared references kept by the service (each is its normalized trace and site table)
+MAX_REFERENCES = 8
+# PAM indexes kept open by each worker
+MAX_INDEXES = 4
+# Longest request line accepted, in bytes
+MAX_REQUEST = 1 << 20
+
+# PAM indexes open in this worker, least recently used first
+_indexes = collections.OrderedDict()
+
+def _init_worker(trace_cache, profiler, warm_plots):
+    CrisPy.trace_cache = trace_cache
+    CrisPy.profiler = profiler
+    # the service stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # imported now so the first request doesn't wait for them
+    from Bio import Seq, SeqIO, pairwise2
+    if warm_plots:
+        import CrisPyPlot
+
+def _ready():
+    return os.getpid()
+
+def _score_index(index_dir, guides, cutoff, limit):
+    # the best limit sites of the index for the guides, as [guide, record, strand,
+    # position, score]. An index rebuilt since it was opened is opened again
+    key = (index_dir, os.stat(os.path.join(index_dir, 'index.json')).st_mtime_ns)
+    index = _indexes.pop(key, None)
+    if index is None:
+        index = CrisPy.PamIndex(index_dir)
+    _indexes[key] = index
+    while len(_indexes) > MAX_INDEXES:
+        _indexes.popitem(last=False)
+    sites = index.score(guides, cutoff)
+    sites = sites[np.argsort(sites['score'], kind='stable')][:limit]
+    return [[int(site['guide']), index.records[site['record']], int(site['strand']),
+             int(site['position']), float(site['score'])] for site in sites]
+
+def _reply_value(value):
+    # numpy results as JSON values (a frequency that wasn't computed is None)
+    if isinstance(value, np.ndarray):
+        return [_reply_value(item) for item in value.tolist()]
+    if isinstance(value, list):
+        return [_reply_value(item) for item in value]
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+class AnalysisService(object):
+    def __init__(self, workers=None, max_queue=None, max_references=MAX_REFERENCES, warm_plots=False):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue if max_queue is not None else 4 * self.workers
+        self.max_references = max_references
+        # workers attach to shared references through this process's resource
+        # tracker (see CrisPy.SharedReference), so it has to be running first
+        resource_tracker.ensure_running()
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            self.workers, initializer=_init_worker,
+            initargs=(CrisPy.trace_cache, CrisPy.profiler, warm_plots))
+        # prepared references by (file signature, guide): each entry is
+        # {'reference', 'offtargets', 'sites', 'users'}, least recently used first
+        self.references = collections.OrderedDict()
+        self._preparing = {}
+        self.pending = 0
+        self.counts = {'completed': 0, 'failed': 0, 'busy': 0, 'errors': 0}
+        self.started = time.time()
+
+    async def start(self):
+        # starts every worker now (the pool would otherwise start them as needed)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, _ready) for _ in range(self.workers)])
+
+    def queue(self):
+        running = min(self.pending, self.workers)
+        return {'queued': self.pending - running, 'running': running, 'limit': self.max_queue,
+                'workers': self.workers}
+
+    async def handle(self, request):
+        # the reply to one request (a dict)
+        reply = {'id': request.get('id')}
+        op = request.get('op')
+        try:
+            if op == 'status':
+                reply.update(self.status(), status='ok')
+            elif op in ('analyze', 'score_index'):
+                if self.pending >= self.max_queue:
+                    self.counts['busy'] += 1
+                    reply.update(status='busy', error='queue full')
+                else:
+                    self.pending += 1
+                    try:
+                        if op == 'analyze':
+                            reply.update(await self.analyze(request))
+                        else:
+                            reply.update(await self.score_index(request))
+                    finally:
+                        self.pending -= 1
+            else:
+                raise ValueError('unknown op: %s' % op)
+        except Exception as e:
+            self.counts['errors'] += 1
+            reply.update(status='error', error='%s: %s' % (type(e).__name__, e))
+        reply['queue'] = self.queue()
+        return reply
+
+    def status(self):
+        return {'references': [list(key) for key in self.references], 'uptime': time.time() - self.started,
+                'counts': dict(self.counts)}
+
+    async def analyze(self, request):
+        target_sequence = CrisPyBatch.check_sequence(request['guide'])
+        target_range = request['range']
+        if not isinstance(target_range, str):
+            target_range = ','.join(map(str, target_range))
+        target_range = CrisPyBatch.parse_range(target_range, target_sequence)
+        offset_search = request.get('offset_search', 'batched')
+        if offset_search not in CrisPy.OFFSET_SEARCH_MODES:
+            raise ValueError('unknown offset search mode: ' + str(offset_search))
+        trim = request.get('trim')
+        if trim is not None and trim not in CrisPy.TRIM_MODES:
+            raise ValueError('unknown trim mode: ' + str(trim))
+        if trim is not None and request.get('roi'):
+            raise ValueError("trim can't be used with roi")
+        plot_format = request.get('plot_format', 'png')
+        if plot_format not in ('png', 'svg'):
+            raise ValueError('unknown plot format: ' + str(plot_format))
+        if request.get('plots') is not None:
+            os.makedirs(request['plots'], exist_ok=True)
+
+        key, entry = await self._reference(request['reference'], target_sequence)
+        entry['users'] += 1
+        try:
+            run = {'reference': entry['reference'], 'offtargets': entry['offtargets'],
+                   'offset_search': offset_search, 'target_sequence': target_sequence,
+                   'target_range': target_range, 'roi': bool(request.get('roi')), 'keep_diffs': False,
+                   'plots': request.get('plots'), 'plot_format': plot_format, 'trim': trim}
+            loop = asyncio.get_running_loop()
+            row = await loop.run_in_executor(self.pool, CrisPyBatch.analyze_sample, request['test'], run)
+        finally:
+            entry['users'] -= 1
+            self._evict()
+        self.counts['completed' if row['status'] == 'ok' else 'failed'] += 1
+        return {'status': row['status'], 'error': row['error'], 'sample': row['sample'],
+                'sites': entry['sites'], 'target_range': target_range,
+                'frequencies': _reply_value(row.get('freqs', []))}
+
+    async def score_index(self, request):
+        guides = [CrisPyBatch.check_sequence(guide) for guide in request['guides']]
+        loop = asyncio.get_running_loop()
+        sites = await loop.run_in_executor(self.pool, _score_index, request['index'], guides,
+                                           float(request.get('cutoff', .6)), int(request.get('limit', 100)))
+        self.counts['completed'] += 1
+        return {'status': 'ok', 'error': '', 'sites': sites}
+
+    async def _reference(self, ref_path, target_sequence):
+        # The prepared reference for the file as it is now and the guide. It is
+        # prepared once (in a thread, so other requests carry on meanwhile), however
+        # many requests for it come in while it is being prepared
+        stat = os.stat(ref_path)
+        key = (os.path.abspath(ref_path), stat.st_mtime_ns, stat.st_size, target_sequence)
+        if key in self.references:
+            self.references.move_to_end(key)
+            return key, self.references[key]
+        if key not in self._preparing:
+            loop = asyncio.get_running_loop()
+            self._preparing[key] = loop.run_in_executor(None, self._prepare, ref_path, target_sequence)
+        try:
+            entry = await asyncio.shield(self._preparing[key])
+        finally:
+            self._preparing.pop(key, None)
+        if key not in self.references:
+            self.references[key] = entry
+            self._evict()
+        return key, self.references[key]
+
+    def _prepare(self, ref_path, target_sequence):
+        reference = CrisPyBatch.prepare_reference(ref_path, target_sequence)
+        offtargets = CrisPyBatch.offtarget_list(reference)
+        sites = CrisPyBatch.site_table(reference.trace(), target_sequence, offtargets)
+        return {'reference': reference, 'offtargets': offtargets,
+                'sites': [[int(strand), int(position), float(score)] for strand, position, score in sites],
+                'users': 0}
+
+    def _evict(self):
+        # frees the least recently used references past max_references (the newest,
+        # and any a request is still using, are kept)
+        for key in list(self.references)[:-1]:
+            if len(self.references) <= self.max_references:
+                break
+            if self.references[key]['users'] == 0:
+                self.references.pop(key)['reference'].close()
+
+    def close(self):
+        self.pool.shutdown()
+        for entry in self.references.values():
+            entry['reference'].close()
+        self.references.clear()
+# End AnalysisService Class
+
+async def _serve_connection(service, reader, writer):
+    # Each request on a connection is handled as soon as it comes in, and its reply
+    # sent when it is done, so replies can come back in any order (matched by id)
+    tasks = set()
+
+    async def answer(request):
+        reply = await service.handle(request)
+        writer.write(json.dumps(reply).encode() + b'\n')
+        await writer.drain()
+
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # longer than MAX_REQUEST
+                writer.write(json.dumps({'id': None, 'status': 'error', 'error': 'request too long'}).encode() + b'\n')
+                break
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('a request is a JSON object')
+            except ValueError as e:
+                writer.write(json.dumps({'id': None, 'status': 'error', 'error': 'bad request: %s' % e}).encode() + b'\n')
+                continue
+            task = asyncio.ensure_future(answer(request))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    except ConnectionError:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        writer.close()
+
+async def serve(service, socket_path=None, port=None, ready=None):
+    # Runs the service until SIGINT or SIGTERM. With port set it listens on
+    # 127.0.0.1:port, otherwise on the Unix socket (readable by this user only)
+    await service.start()
+    handler = functools.partial(_serve_connection, service)
+    if port is not None:
+        server = await asyncio.start_server(handler, '127.0.0.1', port, limit=MAX_REQUEST)
+    else:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(handler, socket_path, limit=MAX_REQUEST)
+        os.chmod(socket_path, 0o600)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop.set)
+    if ready is not None:
+        ready.write('listening on %s\n' % ('127.0.0.1:%d' % port if port is not None else socket_path))
+        ready.flush()
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        if port is None and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a local CrisPy analysis service.')
+    parser.add_argument('--socket', default=CrisPyClient.DEFAULT_SOCKET,
+                        help='Unix socket to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=None, help='listen on this localhost TCP port instead')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: one per core)')
+    parser.add_argument('--max-queue', type=int, default=None,
+                        help="requests waiting before new ones are answered 'busy' (default: 4 per worker)")
+    parser.add_argument('--max-references', type=int, default=MAX_REFERENCES,
+                        help='prepared references kept in memory (default: %(default)s)')
+    parser.add_argument('--warm-plots', action='store_true', help='import matplotlib in the workers up front')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or write the parsed/normalized trace cache")
+    args = parser.parse_args(argv)
+
+    if args.no_cache:
+        CrisPy.trace_cache.enabled = False
+    service = AnalysisService(args.workers, args.max_queue, args.max_references, args.warm_plots)
+    try:
+        asyncio.run(serve(service, args.socket, args.port, sys.stderr))
+    finally:
+        service.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
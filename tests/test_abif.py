@@ -0,0 +1,133 @@
+# The lean ABIF reader against Biopython's, on files written by CrisPyBench
+import numpy as np
+import pytest
+from Bio import SeqIO
+
+import CrisPy
+import CrisPyBench
+
+pytestmark = pytest.mark.filterwarnings('ignore::Warning')
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    # a cached parse would hide which reader did the work
+    monkeypatch.setattr(CrisPy.trace_cache, 'enabled', False)
+
+
+@pytest.fixture
+def biopython_reads(monkeypatch):
+    # counts the files handed to Biopython's parser
+    calls = []
+    read = SeqIO.read
+    def counting_read(*args, **kwargs):
+        calls.append(args)
+        return read(*args, **kwargs)
+    monkeypatch.setattr(SeqIO, 'read', counting_read)
+    return calls
+
+
+def ab1_file(tmp_path, bases=150, seed=0):
+    trace = CrisPyBench.synthetic_trace(bases, seed=seed)
+    quality = np.random.default_rng(seed).integers(0, 60, bases)
+    path = tmp_path / 'sample.ab1'
+    CrisPyBench.write_abif(str(path), trace, quality=quality)
+    return path, trace, quality
+
+
+def parse(path, reader):
+    # the parsed trace, or the type of error the reader gave up with
+    try:
+        return CrisPy.ABIparse(str(path), reader=reader).trace
+    except Exception as error:
+        return type(error)
+
+
+def assert_same_trace(trace, other):
+    assert np.array_equal(trace.data, other.data)
+    assert trace.sequence == other.sequence
+    assert np.array_equal(trace.base_pos, other.base_pos)
+    assert np.array_equal(trace['quality'], other['quality'])
+
+
+def assert_same_result(result, other):
+    if isinstance(result, CrisPy.Trace) and isinstance(other, CrisPy.Trace):
+        assert_same_trace(result, other)
+    else:
+        assert result == other
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_readers_agree(tmp_path, biopython_reads, seed):
+    path, trace, quality = ab1_file(tmp_path, seed=seed)
+    lean = parse(path, 'lean')
+    assert not biopython_reads
+    biopython = parse(path, 'biopython')
+    assert biopython_reads
+    assert_same_trace(lean, biopython)
+    assert np.array_equal(lean.data, trace.data)
+    assert lean.sequence == trace.sequence
+    assert np.array_equal(lean['quality'], quality)
+
+
+def test_raw_tags_agree(tmp_path):
+    path, trace, quality = ab1_file(tmp_path)
+    content = path.read_bytes()
+    lean = CrisPy.read_abif_tags(content, CrisPy.ABIF_TAGS, CrisPy.ABIF_OPTIONAL_TAGS)
+    biopython = SeqIO.read(str(path), 'abi').annotations['abif_raw']
+    for tag in CrisPy.ABIF_TAGS + CrisPy.ABIF_OPTIONAL_TAGS:
+        if isinstance(lean[tag], bytes):
+            assert lean[tag] == bytes(biopython[tag])
+        else:
+            assert lean[tag].tolist() == list(biopython[tag])
+
+
+@pytest.mark.parametrize('content', [b'', b'not an ab1 file\n' * 10, b'ABIF' + bytes(200)])
+def test_not_abif_falls_back(tmp_path, biopython_reads, content):
+    path = tmp_path / 'sample.ab1'
+    path.write_bytes(content)
+    result = parse(path, 'lean')
+    assert biopython_reads
+    # whatever Biopython makes of the file, not an error of the lean reader's own
+    assert_same_result(result, parse(path, 'biopython'))
+
+
+@pytest.mark.parametrize('fraction', [0.01, 0.3, 0.6, 0.9, 0.99])
+def test_truncated_file_falls_back(tmp_path, biopython_reads, fraction):
+    path = ab1_file(tmp_path)[0]
+    content = path.read_bytes()
+    path.write_bytes(content[:int(len(content) * fraction)])
+    result = parse(path, 'lean')
+    assert biopython_reads
+    assert_same_result(result, parse(path, 'biopython'))
+
+
+def test_inconsistent_tags_fall_back(tmp_path, biopython_reads):
+    # a channel whose element count was cut in half reads, but doesn't make a
+    # trace with the other three
+    path = ab1_file(tmp_path)[0]
+    content = bytearray(path.read_bytes())
+    dir_count, _, dir_offset = np.frombuffer(bytes(content[18:30]), '>i4')
+    for entry in range(dir_count):
+        offset = dir_offset + entry * 28
+        if content[offset:offset + 4] == b'DATA' and int.from_bytes(content[offset + 4:offset + 8], 'big') == 9:
+            count = int.from_bytes(content[offset + 12:offset + 16], 'big')
+            content[offset + 12:offset + 16] = (count // 2).to_bytes(4, 'big')
+    path.write_bytes(bytes(content))
+    result = parse(path, 'lean')
+    assert biopython_reads
+    assert_same_result(result, parse(path, 'biopython'))
+
+
+def test_biopython_reader_skips_the_cache(tmp_path, biopython_reads, monkeypatch):
+    # a lean parse cached first mustn't stand in for Biopython's
+    monkeypatch.setattr(CrisPy, 'trace_cache', CrisPy.TraceCache(str(tmp_path / 'cache'), enabled=True))
+    path = ab1_file(tmp_path)[0]
+    lean = parse(path, 'lean')
+    assert parse(path, 'lean').get('cache_key') is not None
+    assert not biopython_reads
+    for repeat in range(2):
+        biopython = parse(path, 'biopython')
+        assert len(biopython_reads) == repeat + 1
+        assert biopython.get('cache_key') is None
+        assert_same_trace(lean, biopython)
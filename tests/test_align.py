@@ -0,0 +1,157 @@
+# SeqDoc._align and get_best_align against the list-based alignment they replaced
+import numpy as np
+import pytest
+
+import CrisPy
+import CrisPyBench
+
+TRACE_LIST = CrisPy.TRACE_LIST
+
+
+# The original alignment on dicts of per-base lists, kept as the reference the
+# index-map version has to match exactly. Scoring reads past either end of a
+# list as 'no_score', while a negative index (the pre-score at datapoint 0) wraps
+# round to the last column.
+def reference_get_score(start, end, offset, ref, test):
+    score = 0
+    for i in range(start, end):
+        try:
+            for letter in TRACE_LIST:
+                score += abs(ref[letter][i] - test[letter][i + offset])
+        except IndexError:
+            return 'no_score'
+    return score
+
+
+def reference_align(ref, test, min_index, trace_length):
+    if min_index < 0:
+        for i in range(min_index, 0):
+            for letter in TRACE_LIST:
+                test[letter].insert(0, test[letter][0])
+    elif min_index > 0:
+        for letter in TRACE_LIST:
+            del test[letter][:min_index]
+
+    for i in range(0, trace_length-1):
+        if i%3:
+            continue
+        start_pos = i
+        end_pos = i + 30
+        score = reference_get_score(start_pos, end_pos, 0, ref, test)
+        pre_score = reference_get_score(start_pos, end_pos, -1, ref, test)
+        post_score = reference_get_score(start_pos, end_pos, 1, ref, test)
+        if (score == 'no_score') or (pre_score == 'no_score') or (post_score == 'no_score'):
+            break
+        if (score < pre_score) and (score < post_score):
+            offset = 0
+        elif (pre_score < score) and (pre_score < post_score):
+            offset = -1
+        elif (post_score < pre_score) and (post_score < score):
+            offset = 1
+        else:
+            offset = 0
+        if offset == 1:
+            for letter in TRACE_LIST:
+                del test[letter][i]
+        elif offset == -1:
+            for letter in TRACE_LIST:
+                test[letter].insert(i, test[letter][i])
+    return ref, test
+
+
+def reference_best_align(ref_trace, test_trace):
+    # gives the offset picked; test_trace is aligned as a side effect
+    scores = {}
+    temp_ref = {}
+    temp_test = {}
+    for offset in range(-200, 200, 20):
+        for letter in TRACE_LIST:
+            temp_ref[letter] = ref_trace[letter].copy()
+            temp_test[letter] = test_trace[letter].copy()
+        temp_ref, temp_test = reference_align(temp_ref, temp_test, offset, 1000)
+        scores[offset] = reference_get_score(200, 1000, 0, temp_ref, temp_test)
+    offset = sorted(scores.items(), key=lambda x:x[1])
+    reference_align(ref_trace, test_trace, offset[0][0], len(test_trace['A'])+offset[0][0])
+    return offset[0][0]
+
+
+def as_lists(trace):
+    return {letter: [int(value) for value in trace[letter]] for letter in TRACE_LIST}
+
+
+def as_array(lists):
+    return np.array([lists[letter] for letter in TRACE_LIST], dtype=np.int64)
+
+
+def trace_pair(seed, test_bases=160, offset=0, stretch=0.0):
+    # a reference and a test trace of the same sequence (with a few edits), which
+    # can start earlier or later and drift
+    ref = CrisPyBench.synthetic_trace(160, seed=seed)
+    sequence = (ref['sequence'] * 2)[:test_bases]
+    edits = [(index, 'A', 0.5) for index in range(60, 64)]
+    test = CrisPyBench.synthetic_trace(test_bases, sequence=sequence, edits=edits, offset=offset,
+                                       stretch=stretch, seed=seed + 50)
+    return ref, test
+
+
+def seqdoc():
+    return CrisPy.SeqDoc.__new__(CrisPy.SeqDoc)
+
+
+@pytest.mark.parametrize('min_index', [-200, -37, -1, 0, 1, 20, 143, 200])
+@pytest.mark.parametrize('trace_length', [1000, None])
+def test_align(min_index, trace_length):
+    ref, test = trace_pair(0, offset=11, stretch=0.01)
+    if trace_length is None:
+        trace_length = test['seq_length'] + min_index
+    expected_ref, expected_test = as_lists(ref), as_lists(test)
+    reference_align(expected_ref, expected_test, min_index, trace_length)
+
+    seqdoc()._align(ref, test, min_index, trace_length)
+    assert np.array_equal(test.data, as_array(expected_test))
+    assert test['initial_offset'] == min_index
+    assert np.array_equal(ref.data, as_array(expected_ref))
+
+
+@pytest.mark.parametrize('test_bases', [120, 160, 200])
+def test_align_unequal_lengths(test_bases):
+    # the alignment stops where the shorter trace runs out
+    ref, test = trace_pair(1, test_bases=test_bases, offset=-6, stretch=-0.01)
+    expected_test = as_lists(test)
+    reference_align(as_lists(ref), expected_test, 0, test['seq_length'])
+    seqdoc()._align(ref, test, 0, test['seq_length'])
+    assert np.array_equal(test.data, as_array(expected_test))
+
+
+def test_align_at_the_first_datapoint():
+    # a test trace one column ahead of the reference wants a column deleted right
+    # away, and the pre-score at datapoint 0 reads the last column
+    ref, test = trace_pair(2)
+    test.data = np.concatenate((ref.data[:, :1], ref.data), axis=1)
+    test.data[:, -1] = 0
+    expected_test = as_lists(test)
+    reference_align(as_lists(ref), expected_test, 0, 1000)
+    seqdoc()._align(ref, test, 0, 1000)
+    assert np.array_equal(test.data, as_array(expected_test))
+
+
+@pytest.mark.parametrize('seed, offset, stretch', [(0, 0, 0.0), (1, 57, 0.005), (2, -40, -0.005), (3, 130, 0.0)])
+def test_best_align(seed, offset, stretch):
+    ref, test = trace_pair(seed, offset=offset, stretch=stretch)
+    expected_test = as_lists(test)
+    expected_offset = reference_best_align(as_lists(ref), expected_test)
+
+    for mode in CrisPy.OFFSET_SEARCH_MODES:
+        aligned_ref, aligned_test = ref.copy(), test.copy()
+        seqdoc().get_best_align(aligned_ref, aligned_test, mode)
+        if mode == 'stepped':
+            # the original search, so the same offset
+            assert aligned_test['initial_offset'] == expected_offset
+            assert np.array_equal(aligned_test.data, as_array(expected_test))
+        else:
+            # whichever offset it picks, the alignment from it is the original one
+            picked = as_lists(test)
+            chosen = aligned_test['initial_offset']
+            reference_align(as_lists(ref), picked, chosen, test['seq_length'] + chosen)
+            assert np.array_equal(aligned_test.data, as_array(picked))
+        assert np.array_equal(aligned_ref.data, ref.data)
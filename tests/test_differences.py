@@ -0,0 +1,130 @@
+# SeqDoc.differences and get_all_data against the per-datapoint formula the
+# whole-array version replaced
+import math
+
+import numpy as np
+import pytest
+
+import CrisPy
+import CrisPyBench
+
+TRACE_LIST = CrisPy.TRACE_LIST
+
+
+# The per-datapoint difference traces from before the whole-array version, kept
+# as the reference it has to match. Channels are accentuated in TRACE_LIST order,
+# and one that was already accentuated counts with its new value for the next.
+def reference_differences(ref, test):
+    min_index = min(test['seq_length'], ref['seq_length'])
+    diffs = {}
+    for letter in TRACE_LIST:
+        diffs[letter] = []
+    for i in range(0, min_index):
+        for letter in TRACE_LIST:
+            diff = int(ref[letter][i]) - int(test[letter][i])
+            sign = (diff > 0) - (diff < 0)
+            if abs(diff) > 5000:
+                diff = 5000 * sign
+            diffs[letter].append(diff)
+
+        for letter in TRACE_LIST:
+            diff = diffs[letter][i]
+            sign = (diff > 0) - (diff < 0)
+            otherchannels = 1
+            for channel in TRACE_LIST:
+                if channel == letter:
+                    continue
+                value = diffs[channel][i]
+                if value * sign > 0:
+                    continue
+                otherchannels += value
+            finaldiff = (sign * diff * diff * math.sqrt(abs(otherchannels))) / 5000
+            if abs(finaldiff) > 5000:
+                finaldiff = sign * 5000
+            diffs[letter][i] = finaldiff
+    return min_index, diffs
+
+
+def seqdoc(ref, test):
+    return CrisPy.SeqDoc(ref, test)
+
+
+def trace(data):
+    return CrisPy.Trace(data, '', [])
+
+
+def assert_same(result, expected):
+    assert result[0] == expected[0]
+    for letter in TRACE_LIST:
+        assert len(result[1][letter]) == result[0]
+        assert np.array_equal(np.asarray(result[1][letter]), np.array(expected[1][letter], dtype=np.float64))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_random_traces(seed):
+    rng = np.random.default_rng(seed)
+    ref = trace(rng.integers(-3000, 3000, (len(TRACE_LIST), 700)))
+    test = trace(rng.integers(-3000, 3000, (len(TRACE_LIST), 700)))
+    assert_same(seqdoc(ref, test).differences(ref, test), reference_differences(ref, test))
+
+
+def test_raw_difference_is_clipped():
+    # differences beyond +/-5000 are cut back before they are squared
+    ref = trace(np.array([[9000, -9000, 5001, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, -8000]]))
+    test = trace(np.zeros((len(TRACE_LIST), 4), dtype=np.int64))
+    expected = reference_differences(ref, test)
+    assert_same(seqdoc(ref, test).differences(ref, test), expected)
+    assert expected[1]['A'][:3] == [5000, -5000, 5000]
+
+
+def test_accentuated_difference_is_clipped():
+    # a difference well under 5000 that the other channels push past 5000
+    ref = trace(np.array([[3000, -3000], [-4000, 4000], [-4000, 4000], [0, 0]]))
+    test = trace(np.zeros((len(TRACE_LIST), 2), dtype=np.int64))
+    expected = reference_differences(ref, test)
+    assert_same(seqdoc(ref, test).differences(ref, test), expected)
+    assert expected[1]['A'] == [5000, -5000]
+
+
+def test_channel_order():
+    # A is accentuated first and G then counts A's new value, so the result isn't
+    # the same as accentuating every channel from the raw differences
+    ref = trace(np.array([[2000], [-100], [-3000], [0]]))
+    test = trace(np.zeros((len(TRACE_LIST), 1), dtype=np.int64))
+    result = seqdoc(ref, test).differences(ref, test)
+    assert_same(result, reference_differences(ref, test))
+
+    # (A's accentuated difference is cut back to 5000, and G's opposite-signed
+    # other channels are A and T)
+    assert result[1]['A'][0] == 5000
+    assert result[1]['G'][0] == -(100 ** 2 * math.sqrt(1 + 5000 + 0)) / 5000
+    assert result[1]['G'][0] != -(100 ** 2 * math.sqrt(1 + 2000 + 0)) / 5000
+
+    # so the same differences come out differently in the other channel order
+    swapped = trace(ref.data[[1, 0, 2, 3]])
+    assert not np.array_equal(np.asarray(seqdoc(swapped, test).differences(swapped, test)[1]['A']),
+                              np.asarray(result[1]['G']))
+
+
+@pytest.mark.parametrize('ref_length, test_length', [(900, 650), (650, 900)])
+def test_unequal_lengths(ref_length, test_length):
+    # only the datapoints both traces have are compared
+    rng = np.random.default_rng(ref_length)
+    ref = trace(rng.integers(0, 4000, (len(TRACE_LIST), ref_length)))
+    test = trace(rng.integers(0, 4000, (len(TRACE_LIST), test_length)))
+    result = seqdoc(ref, test).differences(ref, test)
+    assert result[0] == min(ref_length, test_length)
+    assert_same(result, reference_differences(ref, test))
+
+
+@pytest.mark.parametrize('test_bases', [400, 380, 430])
+def test_get_all_data(test_bases):
+    # the difference traces of a full run are the formula applied to the
+    # normalized, aligned traces it leaves behind, including traces of
+    # different lengths
+    ref = CrisPyBench.synthetic_trace(400, seed=1)
+    test = CrisPyBench.synthetic_trace(test_bases, sequence=(ref['sequence'] + 'ACGT' * 10)[:test_bases],
+                                       edits=[(200, 'A', 0.5)], offset=7, seed=2)
+    doc = seqdoc(ref, test)
+    result = doc.get_all_data()
+    assert_same(result, reference_differences(doc.ref_trace, doc.test_trace))
@@ -0,0 +1,79 @@
+# SampleExecutor: pieces of a sample done on thread and process pools give
+# exactly the serial results
+import numpy as np
+import pytest
+
+import CrisPy
+import CrisPyBench
+
+pytestmark = pytest.mark.filterwarnings('ignore::Warning')
+
+TARGET_RANGE = [4, 5, 6]
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    monkeypatch.setattr(CrisPy.trace_cache, 'enabled', False)
+
+
+@pytest.fixture(scope='module', params=CrisPy.EXECUTOR_KINDS)
+def executor(request):
+    # every piece of work is handed out, however small the traces
+    with CrisPy.SampleExecutor(workers=2, kind=request.param, min_datapoints=0) as executor:
+        yield executor
+
+
+def trace_pair(seed):
+    ref = CrisPyBench.synthetic_trace(400, seed=seed)
+    edits = [(index, 'A', 0.4) for index in range(150, 160)]
+    test = CrisPyBench.synthetic_trace(400, sequence=ref['sequence'], edits=edits, offset=23,
+                                       stretch=0.003, seed=seed + 10)
+    return ref, test
+
+
+def assert_same_diffs(result, expected):
+    assert result[0] == expected[0]
+    for letter in CrisPy.TRACE_LIST:
+        assert np.array_equal(result[1][letter], expected[1][letter])
+
+
+@pytest.mark.parametrize('offset_search', CrisPy.OFFSET_SEARCH_MODES)
+@pytest.mark.parametrize('seed', [0, 1])
+def test_get_all_data(executor, offset_search, seed):
+    ref, test = trace_pair(seed)
+    serial = CrisPy.SeqDoc(ref.copy(), test.copy(), offset_search)
+    expected = serial.get_all_data()
+    parallel = CrisPy.SeqDoc(ref.copy(), test.copy(), offset_search, executor=executor)
+    assert_same_diffs(parallel.get_all_data(), expected)
+    assert parallel.test_trace['initial_offset'] == serial.test_trace['initial_offset']
+    assert np.array_equal(parallel.ref_trace.data, serial.ref_trace.data)
+    assert np.array_equal(parallel.test_trace.data, serial.test_trace.data)
+
+
+def test_mutation_freqs(executor):
+    ref, test = trace_pair(2)
+    seqdoc = CrisPy.SeqDoc(ref, test)
+    length, diffs = seqdoc.get_all_data()
+    guide = ref['sequence'][140:160]
+    # every sense and antisense site along the reference, enough for several groups
+    positions = list(range(21, len(ref['sequence']))) + list(range(-21, -len(ref['sequence']), -1))
+    sites = [None] + positions
+    assert len(sites) > executor.workers * CrisPy.PARALLEL_MIN_SITES
+
+    expected = CrisPy.Sequalizer(seqdoc.ref_trace, seqdoc.test_trace, diffs, guide,
+                                 TARGET_RANGE).get_mutation_freqs(sites)
+    freqs = CrisPy.Sequalizer(seqdoc.ref_trace, seqdoc.test_trace, diffs, guide, TARGET_RANGE,
+                              executor=executor).get_mutation_freqs(sites)
+    assert np.array_equal(freqs, expected, equal_nan=True)
+    assert not np.isnan(expected).all()
+
+
+@pytest.mark.parametrize('kind', CrisPy.EXECUTOR_KINDS)
+def test_work_is_handed_out(kind):
+    # with min_datapoints=0 the pool is really used, rather than the serial shortcut
+    ref, test = trace_pair(3)
+    with CrisPy.SampleExecutor(workers=2, kind=kind, min_datapoints=0) as executor:
+        assert executor._pool is None
+        CrisPy.SeqDoc(ref, test, executor=executor).get_all_data()
+        assert executor._pool is not None
+    assert executor._pool is None
@@ -0,0 +1,103 @@
+# TargetLocator against the first best pairwise2 local alignment it stands in for
+import numpy as np
+import pytest
+
+import CrisPy
+
+pytestmark = pytest.mark.filterwarnings('ignore::Warning')
+
+BASES = np.array(list('ACGT'))
+
+
+def random_sequence(rng, length):
+    return ''.join(BASES[rng.integers(0, 4, length)])
+
+
+def reference_location(ref_sequence, target_sequence):
+    # what Sequalizer used to do: the start and end of pairwise2's first alignment
+    from Bio import pairwise2
+    alignments = pairwise2.align.localms(ref_sequence, target_sequence, 2, -1, -1, -0.1)
+    return tuple(alignments[0][3:5])
+
+
+def mismatched(rng, target, count):
+    target = list(target)
+    for index in rng.choice(len(target), count, replace=False):
+        target[index] = rng.choice([base for base in 'ACGT' if base != target[index]])
+    return ''.join(target)
+
+
+def deleted(rng, target):
+    index = int(rng.integers(1, len(target) - 1))
+    return target[:index] + target[index + 1:]
+
+
+def inserted(rng, target):
+    index = int(rng.integers(1, len(target) - 1))
+    return target[:index] + rng.choice(BASES) + target[index:]
+
+
+def targets(kind, seed):
+    # (reference, target) pairs of one kind; the target is taken from the
+    # reference at a random place, including right at either end
+    rng = np.random.default_rng(seed)
+    pairs = []
+    for case in range(12):
+        ref = random_sequence(rng, int(rng.integers(150, 500)))
+        start = [0, len(ref) - 20][case] if case < 2 else int(rng.integers(0, len(ref) - 20))
+        target = ref[start:start + 20]
+        if kind == 'mismatched':
+            target = mismatched(rng, target, 1 + case % 3)
+        elif kind == 'deleted':
+            target = deleted(rng, target)
+        elif kind == 'inserted':
+            target = inserted(rng, target)
+        elif kind == 'unrelated':
+            target = random_sequence(rng, 20)
+        elif kind == 'overhanging':
+            # part of the target runs off the start or end of the reference
+            target = random_sequence(rng, 6) + ref[:14] if case % 2 else ref[-14:] + random_sequence(rng, 6)
+        elif kind == 'repeated':
+            # several exact copies (the last one is pairwise2's first alignment)
+            ref = ref[:start] + target + ref[start:] + target
+        pairs.append((ref, target))
+    return pairs
+
+
+@pytest.mark.parametrize('kind', ['exact', 'mismatched', 'deleted', 'inserted', 'unrelated', 'overhanging',
+                                  'repeated'])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_matches_pairwise2(kind, seed):
+    for ref, target in targets(kind, seed):
+        assert CrisPy.TargetLocator(ref).locate(target) == reference_location(ref, target), (ref, target)
+
+
+def test_every_path_is_used(monkeypatch):
+    # the cases above go through the exact match, the banded alignment and (when
+    # that can't settle it) the alignment against the whole reference
+    used = set()
+    exact_match = CrisPy.TargetLocator._exact_match
+    banded_match = CrisPy.TargetLocator._banded_match
+    def counting_exact_match(self, target_sequence):
+        location = exact_match(self, target_sequence)
+        if location is not None:
+            used.add('exact')
+        return location
+    def counting_banded_match(self, target_sequence):
+        location = banded_match(self, target_sequence)
+        used.add('banded' if location is not None else 'whole')
+        return location
+    monkeypatch.setattr(CrisPy.TargetLocator, '_exact_match', counting_exact_match)
+    monkeypatch.setattr(CrisPy.TargetLocator, '_banded_match', counting_banded_match)
+    for kind in ('exact', 'mismatched', 'overhanging'):
+        for ref, target in targets(kind, 0):
+            CrisPy.TargetLocator(ref).locate(target)
+    assert used == {'exact', 'banded', 'whole'}
+
+
+def test_locate_target_is_memoized():
+    rng = np.random.default_rng(5)
+    ref = random_sequence(rng, 300)
+    target = mismatched(rng, ref[100:120], 2)
+    assert CrisPy.locate_target(ref, target) == reference_location(ref, target)
+    assert CrisPy.locate_target(ref, target) == reference_location(ref, target)
@@ -0,0 +1,123 @@
+# SeqDoc.normalize_data (running totals) against the per-point loop it replaced
+import numpy as np
+import pytest
+
+import CrisPy
+import CrisPyBench
+
+
+# The per-point normalization from before the running totals, kept as the
+# reference the vectorized version has to match exactly
+def reference_normalize(data):
+    orig_trace = np.array(data, dtype=np.int64)
+    normalized = orig_trace.copy()
+    seq_length = orig_trace.shape[1]
+
+    for datapoint in range(500, seq_length-501):
+        total_sum = int(orig_trace[:, datapoint-500:datapoint+500].sum())
+        if total_sum == 0:
+            total_sum = 1000
+        normalized[:, datapoint] = np.trunc((orig_trace[:, datapoint] / total_sum) * 4000 * 100)
+
+    total_sum = int(orig_trace[:, 0:500].sum())
+    if total_sum == 0:
+        total_sum = 1000
+    for datapoint in range(0, 499):
+        end = datapoint + 500
+        if total_sum == 0:
+            total_sum = 1000
+        normalized[:, datapoint] = np.trunc((orig_trace[:, datapoint] / total_sum) * end * 4 * 100)
+        total_sum += int(orig_trace[:, end + 1].sum())
+
+    total_sum = int(orig_trace[:, seq_length - 1000: seq_length - 1].sum())
+    (first, last) = (seq_length-500, seq_length - 1)
+    for datapoint in range(first, last):
+        start = datapoint - 500
+        if total_sum == 0:
+            total_sum = 1000
+        normalized[:, datapoint] = np.trunc((orig_trace[:, datapoint] / total_sum) * (last-start) * 4 * 100)
+        total_sum -= int(np.abs(orig_trace[:, start]).sum())
+    return normalized
+
+
+def normalize(data):
+    # normalize_data only needs the SeqDoc's helpers, not its files
+    seqdoc = CrisPy.SeqDoc.__new__(CrisPy.SeqDoc)
+    trace = CrisPy.Trace(data, '', [])
+    seqdoc.normalize_data(trace)
+    assert trace['normalized']
+    return trace.data
+
+
+def sparse_trace(length, peaks, seed):
+    # a few isolated peaks with long blank stretches between them, so many of the
+    # 1000-point windows (and running totals at the ends) add up to zero
+    rng = np.random.default_rng(seed)
+    data = np.zeros((len(CrisPy.TRACE_LIST), length), dtype=np.int64)
+    data[rng.integers(0, 4, peaks), rng.integers(0, length, peaks)] = rng.integers(1, 2000, peaks)
+    return data
+
+
+@pytest.mark.parametrize('length', [1100, 1101, 2000, 3517])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_random_traces(length, seed):
+    data = np.random.default_rng(seed).integers(0, 3000, (len(CrisPy.TRACE_LIST), length))
+    assert np.array_equal(normalize(data), reference_normalize(data))
+
+
+def test_negative_values():
+    # baseline-subtracted traces can dip below zero; the end region takes the
+    # absolute value of what it drops from its total
+    data = np.random.default_rng(3).integers(-200, 1500, (len(CrisPy.TRACE_LIST), 2400))
+    assert np.array_equal(normalize(data), reference_normalize(data))
+
+
+def test_synthetic_trace():
+    data = CrisPyBench.synthetic_trace(300, seed=4).data
+    assert np.array_equal(normalize(data), reference_normalize(data))
+
+
+@pytest.mark.parametrize('length', [1100, 2500])
+def test_blank_trace(length):
+    data = np.zeros((len(CrisPy.TRACE_LIST), length), dtype=np.int64)
+    assert np.array_equal(normalize(data), reference_normalize(data))
+    assert not normalize(data).any()
+
+
+@pytest.mark.parametrize('peaks', [1, 3, 10])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_sparse_traces(peaks, seed):
+    data = sparse_trace(4000, peaks, seed)
+    assert np.array_equal(normalize(data), reference_normalize(data))
+
+
+def test_blank_ends():
+    # signal only in the middle: the totals of both end regions start at zero and
+    # pick up (or drop) the signal part way through
+    data = np.zeros((len(CrisPy.TRACE_LIST), 3000), dtype=np.int64)
+    data[:, 900:2100] = np.random.default_rng(5).integers(0, 1000, (len(CrisPy.TRACE_LIST), 1200))
+    assert np.array_equal(normalize(data), reference_normalize(data))
+
+
+def test_short_trace_is_rejected():
+    with pytest.raises(Exception, match='too short'):
+        normalize(np.ones((len(CrisPy.TRACE_LIST), 1099), dtype=np.int64))
+
+
+def test_channels_stay_compact():
+    data = np.random.default_rng(6).integers(0, 3000, (len(CrisPy.TRACE_LIST), 2000)).astype(np.int16)
+    trace = CrisPy.Trace(data, '', [])
+    assert trace.data.dtype == CrisPy.CHANNEL_DTYPE
+    assert normalize(data).dtype == CrisPy.CHANNEL_DTYPE
+
+
+def test_values_past_32_bits():
+    # a window whose values nearly cancel out normalizes a peak to more than 32
+    # bits can hold; the channels are widened rather than wrapping round
+    data = np.zeros((len(CrisPy.TRACE_LIST), 2000), dtype=np.int64)
+    data[0, 1000] = 30000
+    data[1, 1000] = -29999
+    normalized = normalize(data)
+    assert normalized.dtype == np.int64
+    assert normalized.max() > np.iinfo(np.int32).max
+    assert np.array_equal(normalized, reference_normalize(data))
@@ -0,0 +1,46 @@
+# SharedReference handed to process pools: workers read the published block, and
+# the publisher's close() frees it without the resource tracker complaining
+import os
+import subprocess
+import sys
+import textwrap
+import multiprocessing
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = textwrap.dedent('''
+    import concurrent.futures, multiprocessing, os, sys
+    from multiprocessing import resource_tracker
+    import numpy as np
+    import CrisPy, CrisPyBench
+
+    def checksum(reference):
+        return int(reference.trace().data.sum())
+
+    if __name__ == '__main__':
+        CrisPy.trace_cache.enabled = False
+        reference = CrisPy.SharedReference(CrisPyBench.synthetic_trace(200, seed=1))
+        name = reference.memory.name
+        expected = int(reference.trace().data.sum())
+        resource_tracker.ensure_running()
+        context = multiprocessing.get_context(sys.argv[1])
+        with concurrent.futures.ProcessPoolExecutor(2, mp_context=context) as pool:
+            assert list(pool.map(checksum, [reference] * 4)) == [expected] * 4
+        reference.close()
+        if os.path.isdir('/dev/shm'):
+            assert not os.path.exists(os.path.join('/dev/shm', name))
+        print('ok')
+''')
+
+@pytest.mark.parametrize('method', multiprocessing.get_all_start_methods())
+def test_pool_shutdown_is_clean(method, tmp_path):
+    script = tmp_path / 'shared_reference_pool.py'
+    script.write_text(SCRIPT)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, str(script), method], cwd=ROOT, env=env,
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == 'ok'
+    # any traceback or leak warning from the resource tracker ends up here
+    assert result.stderr == ''
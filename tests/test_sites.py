@@ -0,0 +1,57 @@
+# Site positions in the results: one forward-strand coordinate for the target and
+# both strands' off-target sites, the same as PamIndex gives
+import numpy as np
+import pytest
+
+import CrisPy
+import CrisPyBatch
+import CrisPyBench
+
+pytestmark = pytest.mark.filterwarnings('ignore::Warning')
+
+
+def random_sequence(length, seed):
+    return ''.join(np.array(CrisPy.TRACE_LIST)[np.random.default_rng(seed).integers(0, 4, length)])
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_offtarget_positions_match_pam_index(seed):
+    sequence = random_sequence(600, seed)
+    guide = sequence[200:220]
+    words, ambiguous, strands, positions = CrisPy.PamIndex._record_sites(sequence)
+    indexed = set(zip(strands.tolist(), positions.tolist()))
+    sites = CrisPy.OfftargetFinder(CrisPy.Trace(np.zeros((4, 1)), sequence, []), guide).score_sites()
+    checked = 0
+    for site in sites:
+        position = CrisPy.site_position(sequence, int(site['position']))
+        # (sites running off either end are scored, but PamIndex leaves them out)
+        if 0 <= position and position + 23 <= len(sequence):
+            assert (int(site['strand']), position) in indexed
+            checked += 1
+    assert checked > 20
+
+
+def test_sense_and_antisense_positions():
+    # the protospacer and PAM read forward from position on either strand
+    sequence = 'T' * 30 + 'ACGTACGTACGTACGTACGT' + 'TGG' + 'T' * 30 + 'CCA' + 'GGTTGGTTGGTTGGTTGGTT' + 'T' * 30
+    sense = CrisPy.OfftargetFinder(CrisPy.Trace(np.zeros((4, 1)), sequence, []), 'A' * 20)._match_ngg()
+    antisense = -CrisPy.reverse_complement(sequence).index('TGG')
+    assert 50 in sense and antisense in sense
+    assert CrisPy.site_position(sequence, 50) == 30
+    assert sequence[30:53] == 'ACGTACGTACGTACGTACGTTGG'
+    assert CrisPy.site_position(sequence, antisense) == 83
+    assert sequence[83:106] == 'CCA' + 'GGTTGGTTGGTTGGTTGGTT'
+
+
+def test_batch_and_pipeline_sites_agree():
+    ref = CrisPyBench.synthetic_trace(400, seed=3)
+    guide = ref['sequence'][150:170]
+    pipeline = CrisPy.Pipeline(ref, ref.copy())
+    sites = pipeline.sites(guide)
+    offtargets = sorted((score, position) for score, position in pipeline.offtargets(guide).items())
+    assert CrisPyBatch.site_table(ref, guide, offtargets) == sites
+    # the target is where locate_target puts it
+    assert sites[0] == (1, CrisPy.locate_target(ref['sequence'], guide)[0], 1.0)
+    sequence = ref['sequence']
+    for score, position in offtargets:
+        assert CrisPy.site_position(sequence, position) in [site[1] for site in sites[1:]]
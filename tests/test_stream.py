@@ -0,0 +1,74 @@
+# SeqDoc.stream_differences against get_all_data: the chunks put together are
+# the full difference traces, and Sequalizer gives the same frequencies from them
+import numpy as np
+import pytest
+
+import CrisPy
+import CrisPyBench
+
+pytestmark = pytest.mark.filterwarnings('ignore::Warning')
+
+TARGET_RANGE = [4, 5, 6]
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    monkeypatch.setattr(CrisPy.trace_cache, 'enabled', False)
+
+
+def trace_pair(seed):
+    # a reference and an edited test trace that starts a little later and drifts
+    ref = CrisPyBench.synthetic_trace(400, seed=seed)
+    edits = [(index, 'A' if ref['sequence'][index] == 'G' else 'T', 0.4) for index in range(150, 160)]
+    test = CrisPyBench.synthetic_trace(400, sequence=ref['sequence'], edits=edits, offset=9,
+                                       stretch=0.004, seed=seed + 100)
+    return ref, test
+
+
+def target(ref):
+    # a guide taken from the reference, with a G or C in the target range
+    for start in range(140, 200):
+        guide = ref['sequence'][start:start + 20]
+        if any(guide[index] in 'GC' for index in TARGET_RANGE):
+            return guide
+
+
+@pytest.mark.parametrize('offset_search', CrisPy.OFFSET_SEARCH_MODES)
+@pytest.mark.parametrize('chunk_size', [97, CrisPy.ALIGN_CHUNK, 1000, CrisPy.STREAM_CHUNK])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_chunks_are_get_all_data(offset_search, chunk_size, seed):
+    ref, test = trace_pair(seed)
+    length, diffs = CrisPy.SeqDoc(ref.copy(), test.copy(), offset_search).get_all_data()
+    chunks = CrisPy.SeqDoc(ref.copy(), test.copy(), offset_search).stream_differences(chunk_size)
+    starts = []
+    streamed = {letter: [] for letter in CrisPy.TRACE_LIST}
+    for start, chunk in chunks:
+        starts.append(start)
+        assert len(chunk['A']) <= chunk_size
+        for letter in CrisPy.TRACE_LIST:
+            streamed[letter].append(chunk[letter])
+    assert starts == list(range(0, length, chunk_size))
+    assert chunks.length == length
+    for letter in CrisPy.TRACE_LIST:
+        assert np.array_equal(np.concatenate(streamed[letter]), diffs[letter])
+
+
+@pytest.mark.parametrize('offset_search', CrisPy.OFFSET_SEARCH_MODES)
+@pytest.mark.parametrize('seed', [0, 1])
+def test_frequencies_are_the_same(offset_search, seed):
+    ref, test = trace_pair(seed)
+    guide = target(ref)
+    sites = [None, 120, 260, -150]
+
+    full = CrisPy.SeqDoc(ref.copy(), test.copy(), offset_search)
+    length, diffs = full.get_all_data()
+    expected = CrisPy.Sequalizer(full.ref_trace, full.test_trace, diffs, guide,
+                                 TARGET_RANGE).get_mutation_freqs(sites)
+    assert not np.isnan(expected[0]).all()
+
+    # used as the README describes: the SeqDoc's own reference goes to Sequalizer
+    streaming = CrisPy.SeqDoc(ref.copy(), test.copy(), offset_search)
+    chunks = streaming.stream_differences(1000)
+    freqs = CrisPy.Sequalizer(streaming.ref_trace, streaming.test_trace, chunks, guide,
+                              TARGET_RANGE).get_mutation_freqs(sites)
+    assert np.array_equal(freqs, expected, equal_nan=True)
@@ -0,0 +1,74 @@
+# TraceCache: entries are evicted least recently used first, and the cache is
+# only measured again once the bytes stored push it past max_bytes
+import io
+import os
+
+import numpy as np
+import pytest
+
+import CrisPy
+
+ENTRY = np.arange(1000, dtype=np.int64)
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    # room for three and a half entries of one ENTRY each
+    saved = io.BytesIO()
+    np.save(saved, ENTRY)
+    cache = CrisPy.TraceCache(str(tmp_path / 'cache'), max_bytes=int(len(saved.getvalue()) * 3.5), enabled=True)
+    evictions = []
+    evict = cache.evict
+    def counting_evict():
+        evictions.append(cache.size)
+        evict()
+    monkeypatch.setattr(cache, 'evict', counting_evict)
+    cache.evictions = evictions
+    return cache
+
+
+def entries(cache):
+    return sorted(os.listdir(cache.cache_dir))
+
+
+def age(cache, key, mtime):
+    os.utime(os.path.join(cache.cache_dir, key), (mtime, mtime))
+
+
+def test_least_recently_used_is_evicted_first(cache):
+    for mtime, key in enumerate(['a', 'b', 'c']):
+        cache.store(key, 'channels', ENTRY)
+        age(cache, key, 1000 + mtime)
+    # loading an entry makes it the most recently used
+    assert np.array_equal(cache.load('a', 'channels'), ENTRY)
+    cache.store('d', 'channels', ENTRY)
+    assert entries(cache) == ['a', 'c', 'd']
+    age(cache, 'd', 5000)
+    cache.store('e', 'channels', ENTRY)
+    assert entries(cache) == ['a', 'd', 'e']
+    assert cache.load('b', 'channels') is None
+
+
+def test_cache_is_only_measured_when_full(cache):
+    # measured on the first store, then not again until the total passes max_bytes
+    for key in ['a', 'b', 'c']:
+        cache.store(key, 'channels', ENTRY)
+    assert cache.evictions == [None]
+    cache.store('c', 'normalized', ENTRY[:10])
+    assert len(cache.evictions) == 1
+    cache.store('d', 'channels', ENTRY)
+    assert len(cache.evictions) == 2
+    assert len(entries(cache)) == 3
+    # the total is measured afresh by each eviction
+    assert cache.size == sum(os.path.getsize(os.path.join(cache.cache_dir, key, name))
+                             for key in entries(cache) for name in os.listdir(os.path.join(cache.cache_dir, key)))
+
+
+def test_existing_cache_is_measured_first(cache):
+    # a new TraceCache over a cache that is already full trims it on its first store
+    for mtime, key in enumerate(['a', 'b', 'c']):
+        cache.store(key, 'channels', ENTRY)
+        age(cache, key, 1000 + mtime)
+    other = CrisPy.TraceCache(cache.cache_dir, max_bytes=cache.max_bytes, enabled=True)
+    other.store('d', 'channels', ENTRY)
+    assert entries(cache) == ['b', 'c', 'd']